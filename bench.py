@@ -0,0 +1,568 @@
+"""Micro-benchmarks for the shell in main.py.
+
+Run a single benchmark with `python bench.py <name>`, list them with
+`python bench.py --help`.
+"""
+
+import argparse, os, pty, select, shutil, subprocess, sys, tempfile, time
+
+import main
+
+
+def make_fake_path(root, total, dirs=4):
+    """Create `total` executables spread over `dirs` directories, return PATH"""
+    path_dirs = []
+    for d in range(dirs):
+        dir = os.path.join(root, f"bin{d}")
+        os.makedirs(dir, exist_ok=True)
+        path_dirs.append(dir)
+    for i in range(total):
+        full_path = os.path.join(path_dirs[i % dirs], f"cmd{i:07d}")
+        with open(full_path, "w") as f:
+            f.write("#!/bin/sh\n")
+        os.chmod(full_path, 0o755)
+    return ":".join(path_dirs)
+
+
+def linear_complete(text):
+    # The pre-index completer: list every PATH dir and scan the whole list
+    commands = list(main.BUILTINS)
+    for dir in os.environ.get("PATH", "").split(":"):
+        try:
+            for item in os.listdir(dir):
+                full_path = os.path.join(dir, item)
+                if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
+                    commands.append(item)
+        except OSError:
+            pass
+    return [c for c in commands if c.startswith(text)]
+
+
+def indexed_complete(text):
+    state = 0
+    while main.complete(text, state) is not None:
+        state += 1
+
+
+def timed(func, *args, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_completion(args):
+    """Completion latency against PATH size (linear scan vs sorted index)"""
+    print(f"{'PATH size':>10}  {'linear ms':>10}  {'indexed ms':>10}")
+    for total in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            os.environ["PATH"] = make_fake_path(root, total)
+            main.clear_command_index()
+            main.sorted_command_names()  # Warm the index once
+            linear = timed(linear_complete, "cmd00001")
+            indexed = timed(indexed_complete, "cmd00001")
+        print(f"{total:>10}  {linear * 1000:>10.2f}  {indexed * 1000:>10.3f}")
+
+
+# Run as a module like your_program.sh does, so the compiled main.py is
+# cached in __pycache__ instead of being recompiled on every start
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ["PYTHONPATH"] = os.pathsep.join(
+    filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])
+)
+SHELL = [sys.executable, "-m", "main"]
+SHELL_CLIENT = [sys.executable, "-m", "client"]
+
+
+def write_script(path, lines, external_every=100):
+    """Write a script of echo/pwd/type builtins with an occasional external"""
+    builtins = ["echo hello world", "pwd", "type echo", "echo 'a | b' > /dev/null"]
+    with open(path, "w") as f:
+        for i in range(lines):
+            if external_every and i % external_every == 0:
+                f.write("true\n")
+            else:
+                f.write(builtins[i % len(builtins)] + "\n")
+
+
+def listdir_complete(text):
+    # Path completion without the listing cache: list and stat on every Tab
+    head, _, prefix = text.rpartition("/")
+    matches = []
+    for name in sorted(os.listdir(head)):
+        if name.startswith(prefix):
+            full_path = os.path.join(head, name)
+            matches.append(full_path + "/" if os.path.isdir(full_path) else full_path)
+    return matches
+
+
+def bench_paths(args):
+    """Path completion in a directory of N files: listing and stat'ing on
+    every Tab vs the scandir cache (first Tab, then repeated Tabs), for all
+    entries and for a prefix matching ten"""
+    print(
+        f"{'files':>9}  {'query':>7}  {'listdir ms':>10}  {'cold ms':>8}  {'cached ms':>9}"
+    )
+    for total in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            for i in range(total):
+                os.close(os.open(os.path.join(root, f"file{i:07d}"), os.O_CREAT | os.O_WRONLY))
+            for query, text in (("all", f"{root}/"), ("prefix", f"{root}/file{total // 20:06d}")):
+                baseline = timed(listdir_complete, text, repeat=3)
+                main.dir_listings.clear()
+                start = time.perf_counter()
+                main.path_completions(text)
+                cold = time.perf_counter() - start
+                cached = timed(main.path_completions, text)
+                print(
+                    f"{total:>9}  {query:>7}  {baseline * 1000:>10.1f}  {cold * 1000:>8.1f}"
+                    f"  {cached * 1000:>9.2f}"
+                )
+
+
+def bench_script(args):
+    """Script mode throughput (lines/sec) compared with bash"""
+    print(f"{'lines':>8}  {'shell l/s':>10}  {'bash l/s':>10}")
+    for lines in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            script = os.path.join(root, "bench.sh")
+            write_script(script, lines)
+            rates = []
+            for cmd in (SHELL + [script], ["bash", script]):
+                start = time.perf_counter()
+                subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+                rates.append(lines / (time.perf_counter() - start))
+        print(f"{lines:>8}  {rates[0]:>10.0f}  {rates[1]:>10.0f}")
+
+
+def bench_spawn(args):
+    """Spawn rate of `true`: subprocess.run vs the posix_spawn launcher"""
+    true_path = main.find_in_path("true")
+    fds = {0: 0, 1: 1, 2: 2}
+    print(f"{'runs':>8}  {'subprocess/s':>12}  {'spawn/s':>12}")
+    main.environ_changed()
+    for runs in args.sizes:
+        start = time.perf_counter()
+        for _ in range(runs):
+            subprocess.run(["true"], executable=true_path)
+        old = runs / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            main.wait_child(main.spawn(["true"], true_path, fds))
+        new = runs / (time.perf_counter() - start)
+        print(f"{runs:>8}  {old:>12.0f}  {new:>12.0f}")
+
+
+HISTORY_SESSION = """
+import os, sys, time
+import main
+session, shells, commands, rewrite_every = map(int, sys.argv[1:])
+try:
+    main.command_history.load(os.environ["HISTFILE"])
+except FileNotFoundError:
+    pass
+for i in range(commands):
+    # What the interactive loop does around every command
+    main.merge_history_file()
+    main.command_history.append(f"echo session {session} command {i}")
+    main.append_history_file()
+    if rewrite_every and i % rewrite_every == rewrite_every - 1:
+        main.builtin_history(["-w", os.environ["HISTFILE"]], main.Streams())
+# Then wait for the other sessions' commands to be merged in
+deadline = time.monotonic() + 30
+while len(main.command_history) < shells * commands and time.monotonic() < deadline:
+    time.sleep(0.01)
+    main.merge_history_file()
+print(len(main.command_history))
+"""
+
+
+def bench_history(args):
+    """Shells sharing one HISTFILE: lost, duplicated or torn lines with N
+    concurrent sessions flushing every command (some also run history -w).
+    Fails (exit status 1) if any line was lost, duplicated or torn, or a
+    session didn't end up holding every line."""
+    commands = 200
+    failed = False
+    print(
+        f"{'shells':>7}  {'lines':>7}  {'lost':>5}  {'dup':>5}  {'torn':>5}"
+        f"  {'min seen':>8}  {'seconds':>8}"
+    )
+    for shells in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            env = dict(os.environ, HISTFILE=os.path.join(root, "history"))
+            env.pop("HISTSIZE", None)
+            env.pop("HISTFILESIZE", None)
+            start = time.perf_counter()
+            sessions = [
+                subprocess.Popen(
+                    [sys.executable, "-c", HISTORY_SESSION, str(n), str(shells), str(commands),
+                     "50" if n % 10 == 0 else "0"],
+                    env=env,
+                    cwd=REPO_DIR,
+                    stdout=subprocess.PIPE,
+                )
+                for n in range(shells)
+            ]
+            # Entries each session holds once it merged everyone else's
+            seen = [int(session.communicate()[0]) for session in sessions]
+            elapsed = time.perf_counter() - start
+            with open(env["HISTFILE"]) as f:
+                lines = f.read().splitlines()
+        expected = {
+            f"echo session {n} command {i}"
+            for n in range(shells)
+            for i in range(commands)
+        }
+        torn = sum(1 for line in lines if line not in expected)
+        lost = len(expected - set(lines))
+        dup = len(lines) - torn - len(set(lines) & expected)
+        print(
+            f"{shells:>7}  {len(lines):>7}  {lost:>5}  {dup:>5}  {torn:>5}"
+            f"  {min(seen):>8}  {elapsed:>8.2f}"
+        )
+        if lost or dup or torn or min(seen) < shells * commands:
+            print(f"FAILED with {shells} shells", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+def time_to_prompt(env):
+    """Seconds from spawning an interactive shell on a pty to its first prompt"""
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.execve(SHELL[0], SHELL, env)
+    output = b""
+    try:
+        while not output.endswith(b"$ "):
+            ready, _, _ = select.select([fd], [], [], 10)
+            if not ready:
+                raise RuntimeError("no prompt after 10s")
+            output += os.read(fd, 1024)
+        return time.perf_counter() - start
+    finally:
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+        os.close(fd)
+
+
+def read_until(fd, marker, timeout=30):
+    """Read from a pty until marker shows up, return the seconds it took"""
+    start = time.perf_counter()
+    output = b""
+    while marker not in output:
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if not ready:
+            raise RuntimeError(f"no {marker!r} after {timeout}s")
+        output += os.read(fd, 4096)
+    return time.perf_counter() - start
+
+
+def bench_warmup(args):
+    """Interactive shell with N commands on PATH and 10*N history entries:
+    time to the first prompt, to a Tab completion pressed right away
+    (repeated until the name is complete) and to a Ctrl-R match a second
+    later, which the background warmup of the command table and history
+    index is meant to serve without a rebuild"""
+    print(f"{'commands':>9}  {'history':>8}  {'prompt ms':>10}  {'Tab ms':>8}  {'Ctrl-R ms':>10}")
+    for total in args.sizes:
+        entries = total * 10
+        with tempfile.TemporaryDirectory() as root:
+            path = make_fake_path(root, total, dirs=16)
+            # A unique name in the last directory, so Tab completes it fully
+            target = os.path.join(path.split(":")[-1], "zz-warmup-target")
+            with open(target, "w") as f:
+                f.write("#!/bin/sh\n")
+            os.chmod(target, 0o755)
+            histfile = os.path.join(root, "history")
+            with open(histfile, "w") as f:
+                f.writelines(f"echo history entry {i}\n" for i in range(entries))
+            env = dict(os.environ, PATH=f"{path}:/usr/bin:/bin", HISTFILE=histfile)
+            env.pop("HISTSIZE", None)
+            start = time.perf_counter()
+            pid, fd = pty.fork()
+            if pid == 0:
+                os.execve(SHELL[0], SHELL, env)
+            try:
+                read_until(fd, b"$ ")
+                prompt = time.perf_counter() - start
+                # Before the table is complete a Tab completes from the
+                # directories listed so far; press it again until it's there
+                start = time.perf_counter()
+                os.write(fd, b"zz-warm")
+                while True:
+                    os.write(fd, b"\t")
+                    try:
+                        read_until(fd, b"target", timeout=0.1)
+                        break
+                    except RuntimeError:
+                        pass
+                tab = time.perf_counter() - start
+                time.sleep(1)  # Someone taking a second to press ^R
+                start = time.perf_counter()
+                # ^U, ^R and the query typed at once, as a fast typist would
+                os.write(fd, b"\x15\x12" + f"entry {entries - 7}".encode())
+                read_until(fd, f"echo history entry {entries - 7}".encode())
+                search = time.perf_counter() - start
+                os.write(fd, b"\x07")
+            finally:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+                os.close(fd)
+        print(
+            f"{total:>9}  {entries:>8}  {prompt * 1000:>10.1f}  {tab * 1000:>8.1f}"
+            f"  {search * 1000:>10.1f}"
+        )
+
+
+def bench_startup(args):
+    """Cold start: time to exit for `-c true` (vs bash) and time to the
+    first interactive prompt, best and mean over N runs"""
+    print(
+        f"{'runs':>6}  {'-c true ms':>16}  {'bash -c ms':>16}  {'prompt ms':>16}"
+    )
+    for runs in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            env = dict(os.environ, HISTFILE=os.path.join(root, "history"))
+            results = []
+            for cmd in (SHELL + ["-c", "true"], ["bash", "-c", "true"]):
+                times = []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    subprocess.run(cmd, env=env, check=True)
+                    times.append(time.perf_counter() - start)
+                results.append(times)
+            results.append([time_to_prompt(env) for _ in range(runs)])
+        cells = [
+            f"{min(times) * 1000:>7.1f} /{sum(times) / runs * 1000:>7.1f}"
+            for times in results
+        ]
+        print(f"{runs:>6}  " + "  ".join(f"{cell:>16}" for cell in cells))
+
+
+def bench_coreutils(args):
+    """Lines/sec of a script calling cat, head, wc, test, printf & co:
+    spawned from PATH vs the in-process builtins (--coreutils)"""
+    print(f"{'lines':>8}  {'spawned l/s':>12}  {'builtin l/s':>12}  {'bash l/s':>10}")
+    for lines in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            data = os.path.join(root, "data.txt")
+            with open(data, "w") as f:
+                f.writelines(f"line {i} of some text\n" for i in range(200))
+            commands = [
+                "true",
+                f"test -f {data}",
+                f"[ -d {root} ]",
+                "false",
+                f"basename {data} .txt",
+                f"dirname {data}",
+                "printf '%s=%d\\n' key 42",
+                f"cat {data}",
+                f"head -n 5 {data}",
+                f"wc -l {data}",
+            ]
+            script = os.path.join(root, "bench.sh")
+            with open(script, "w") as f:
+                for i in range(lines):
+                    f.write(commands[i % len(commands)] + "\n")
+            rates = []
+            for cmd in (SHELL + [script], SHELL + ["--coreutils", script], ["bash", script]):
+                start = time.perf_counter()
+                subprocess.run(cmd, stdout=subprocess.DEVNULL)
+                rates.append(lines / (time.perf_counter() - start))
+        print(f"{lines:>8}  {rates[0]:>12.0f}  {rates[1]:>12.0f}  {rates[2]:>10.0f}")
+
+
+LOOP_BODY = 'n=0; for f in a.txt b.txt c.txt d.txt; do [ "${f%.txt}" != c ] && n=$((n+1)); done'
+
+
+def bench_loops(args):
+    """Scripts running N small loops: natively (parsed once, run from the
+    AST; with `[` spawned from PATH or as a --coreutils builtin) vs handing
+    each loop to `bash -c` as before, and bash itself"""
+    print(
+        f"{'loops':>8}  {'native ms':>10}  {'--coreutils ms':>15}  {'bash -c ms':>11}  {'bash ms':>8}"
+    )
+    for loops in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            native = os.path.join(root, "native.sh")
+            delegated = os.path.join(root, "delegated.sh")
+            with open(native, "w") as f:
+                f.write(f"{LOOP_BODY}\n" * loops)
+            with open(delegated, "w") as f:
+                f.write(f"bash -c '{LOOP_BODY}'\n" * loops)
+            times = []
+            for cmd in (
+                SHELL + [native],
+                SHELL + ["--coreutils", native],
+                SHELL + [delegated],
+                ["bash", native],
+            ):
+                start = time.perf_counter()
+                subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+                times.append((time.perf_counter() - start) * 1000)
+        print(
+            f"{loops:>8}  {times[0]:>10.0f}  {times[1]:>15.0f}  {times[2]:>11.0f}  {times[3]:>8.0f}"
+        )
+
+
+def run_measured(cmd):
+    """Run cmd, return (stdout, seconds, max RSS in MB)"""
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    proc.stdout.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError(f"{cmd} exited with {proc.returncode}")
+    return output, time.perf_counter() - start, usage.ru_maxrss / 1024
+
+
+PIPELINE_RSS_MARGIN_MB = 8  # Growth of the shell's peak RSS that fails the check
+
+
+def bench_pipeline(args):
+    """Push N MB through `head -c | cat | wc -c` with head and wc running as
+    --coreutils builtins in the shell (writer thread, last stage in-process)
+    and cat spawned: throughput and the shell's peak RSS, which must stay
+    flat however much data flows, vs bash. Fails (exit status 1) if the RSS
+    at a larger size exceeds that at the smallest by PIPELINE_RSS_MARGIN_MB."""
+    cat = shutil.which("cat")
+    failed = False
+    baseline = None  # Shell RSS at the smallest size
+    print(f"{'MB':>8}  {'shell MB/s':>10}  {'shell RSS MB':>12}  {'bash MB/s':>10}")
+    for megabytes in args.sizes:
+        size = megabytes << 20
+        line = f"head -c {size} /dev/zero | {cat} | wc -c"
+        rates = []
+        for cmd in (SHELL + ["--coreutils", "-c", line], ["bash", "-c", line]):
+            output, seconds, rss = run_measured(cmd)
+            if int(output) != size:
+                raise RuntimeError(f"{cmd}: counted {output!r}, expected {size}")
+            rates.append(megabytes / seconds)
+            if len(rates) == 1:
+                shell_rss = rss
+        print(f"{megabytes:>8}  {rates[0]:>10.0f}  {shell_rss:>12.1f}  {rates[1]:>10.0f}")
+        if baseline is None:
+            baseline = shell_rss
+        elif shell_rss > baseline + PIPELINE_RSS_MARGIN_MB:
+            print(
+                f"FAILED: shell RSS grew from {baseline:.1f} to {shell_rss:.1f} MB"
+                f" at {megabytes} MB",
+                file=sys.stderr,
+            )
+            failed = True
+    return 1 if failed else 0
+
+
+SERVER_COMMAND = "echo hi | cat"
+
+
+def bench_server(args):
+    """N calls of a small command: a cold `main.py -c` per call vs the
+    server mode, through the client.py drop-in and straight over the
+    socket (one caller, then 8 concurrent ones)"""
+    import client, threading
+
+    print(
+        f"{'calls':>7}  {'cold ms':>8}  {'client.py ms':>12}  {'socket ms':>10}"
+        f"  {'8 callers/s':>12}"
+    )
+    for calls in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "shell.sock")
+            env = dict(os.environ, SHELL_SOCKET=path)
+            server = subprocess.Popen(SHELL + ["--server", path], env=env)
+            try:
+                while not os.path.exists(path):
+                    time.sleep(0.01)
+                devnull = os.open(os.devnull, os.O_RDWR)
+                per_call = []
+                for cmd in (SHELL + ["-c", SERVER_COMMAND],
+                            SHELL_CLIENT + ["-c", SERVER_COMMAND]):
+                    start = time.perf_counter()
+                    for _ in range(calls):
+                        subprocess.run(cmd, env=env, stdout=devnull, check=True)
+                    per_call.append((time.perf_counter() - start) / calls)
+
+                def call():
+                    status = client.run(client.connect(path), [SERVER_COMMAND], (None, devnull, devnull))
+                    if status:
+                        raise RuntimeError(f"exit status {status}")
+
+                start = time.perf_counter()
+                for _ in range(calls):
+                    call()
+                per_call.append((time.perf_counter() - start) / calls)
+
+                def caller(count):
+                    for _ in range(count):
+                        call()
+
+                threads = [threading.Thread(target=caller, args=(calls // 8,)) for _ in range(8)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                rate = calls // 8 * 8 / (time.perf_counter() - start)
+                os.close(devnull)
+            finally:
+                server.terminate()
+                server.wait()
+        cells = "  ".join(f"{ms * 1000:>{w}.1f}" for ms, w in zip(per_call, (8, 12, 10)))
+        print(f"{calls:>7}  {cells}  {rate:>12.0f}")
+
+
+DEFAULT_SIZES = {
+    "completion": [100, 1000, 10000, 50000],
+    "script": [100000],
+    "spawn": [1000, 5000],
+    "history": [50],
+    "startup": [20],
+    "coreutils": [2000, 20000],
+    "loops": [100, 1000],
+    "pipeline": [16, 1024, 4096],
+    "warmup": [2000, 20000],
+    "paths": [1000, 100000],
+    "server": [200],
+}
+
+BENCHMARKS = {
+    "completion": bench_completion,
+    "script": bench_script,
+    "spawn": bench_spawn,
+    "history": bench_history,
+    "startup": bench_startup,
+    "coreutils": bench_coreutils,
+    "loops": bench_loops,
+    "pipeline": bench_pipeline,
+    "warmup": bench_warmup,
+    "paths": bench_paths,
+    "server": bench_server,
+}
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=None,
+        help="comma separated problem sizes",
+    )
+    args = parser.parse_args()
+    if args.sizes is None:
+        args.sizes = DEFAULT_SIZES[args.benchmark]
+    # Benchmarks that double as checks return a failure status
+    return BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
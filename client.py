@@ -0,0 +1,145 @@
+"""Thin client for the shell's server mode (`main.py --server PATH`).
+
+`client.py -c 'cmd' [name [args...]]` is a drop-in for `main.py -c`: it has
+the server listening on $SHELL_SOCKET run the command with this process's
+working directory and environment, relays stdin, stdout and stderr, and
+exits with the command's status. When no server is reachable it runs
+main.py itself.
+
+Both directions use frames of a 1-byte kind, a 4-byte big-endian payload
+length and the payload. A request is sent as
+
+    C  working directory
+    E  one environment entry, NAME=value (repeated)
+    A  one argument: the command, then $0 and the positional parameters
+    R  end of the request (empty)
+
+followed by stdin as `0` frames, an empty one for end of file. The server
+answers with `1` (stdout) and `2` (stderr) frames and ends with an `X`
+frame holding the exit status in decimal.
+"""
+
+import os, sys, select
+
+# The socket module's import costs about as much as running a command in a
+# warm server, the C module underneath is enough here
+import _socket
+
+CHUNK_SIZE = 1 << 16
+
+
+def frame(kind, payload=b""):
+    return kind + len(payload).to_bytes(4, "big") + payload
+
+
+class FrameReader:
+    """Split a byte stream into (kind, payload) frames"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes, return the frames completed by them"""
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= 5:
+            size = int.from_bytes(self.buffer[1:5], "big")
+            if len(self.buffer) < 5 + size:
+                break
+            frames.append((bytes(self.buffer[:1]), bytes(self.buffer[5 : 5 + size])))
+            del self.buffer[: 5 + size]
+        return frames
+
+
+def request_frames(argv, cwd, environ):
+    """Encode a request to run argv (`-c` arguments) in cwd with environ"""
+    parts = [frame(b"C", os.fsencode(cwd))]
+    for name, value in environ.items():
+        parts.append(frame(b"E", os.fsencode(name) + b"=" + os.fsencode(value)))
+    parts.extend(frame(b"A", os.fsencode(arg)) for arg in argv)
+    parts.append(frame(b"R"))
+    return b"".join(parts)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def connect(path):
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def run(sock, argv, fds=(0, 1, 2)):
+    """Run a command on a connected server, relaying the fds given for
+    stdin, stdout and stderr (stdin None for none); return its status.
+
+    Nothing here blocks on the socket: stdin is only read while the
+    server keeps up with it, and output is always read meanwhile, so
+    neither side can fill the socket buffer while the other waits.
+    """
+    stdin, stdout, stderr = fds
+    outgoing = bytearray(request_frames(argv, os.getcwd(), os.environ))
+    if stdin is None:
+        outgoing += frame(b"0")
+    reader = FrameReader()
+    sock.setblocking(False)
+    try:
+        while True:
+            wanted = [sock]
+            if stdin is not None and len(outgoing) < CHUNK_SIZE:
+                wanted.append(stdin)
+            readable, writable, _ = select.select(wanted, [sock] if outgoing else [], [])
+            if writable:
+                try:
+                    del outgoing[: sock.send(outgoing)]
+                except BlockingIOError:
+                    pass
+            if stdin in readable:
+                try:
+                    data = os.read(stdin, CHUNK_SIZE)
+                except OSError:
+                    data = b""
+                outgoing += frame(b"0", data)
+                if not data:
+                    stdin = None
+            if sock in readable:
+                try:
+                    data = sock.recv(CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    os.write(stderr, b"shell: lost connection to the server\n")
+                    return 1
+                for kind, payload in reader.feed(data):
+                    if kind == b"X":
+                        return int(payload)
+                    write_all(stdout if kind == b"1" else stderr, payload)
+    except BrokenPipeError:
+        return 128 + 13  # Our stdout was closed, like SIGPIPE
+    finally:
+        sock.close()
+
+
+def main(argv):
+    path = os.environ.get("SHELL_SOCKET")
+    if argv[:1] == ["-c"] and len(argv) > 1 and path:
+        try:
+            sock = connect(path)
+        except OSError:
+            pass  # No server: run the shell below
+        else:
+            return run(sock, argv[1:])
+    shell = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    os.execv(sys.executable, [sys.executable, shell, *argv])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,518 +1,5820 @@
-import sys, os, subprocess, readline, shlex
-
-BUILTINS = {
-    "exit",
-    "echo",
-    "type",
-    "pwd",
-    "cd",
-    "history",
-}
+import time
+
+STARTUP_START = time.perf_counter()  # Start of the startup profile
+
+import sys, os, io, stat, bisect, fcntl, signal, mmap, array, heapq, itertools
+
+# Modules that only some modes need (readline, subprocess, threading, re,
+# tempfile, concurrent.futures, termios...) are imported where they are used:
+# most runs are a short `-c` or script, where startup time dominates.
+
+BUILTINS = {}  # name -> handler(args, streams), filled in by @builtin below
+BUILTIN_HANDLERS = {}  # Every builtin, including those not enabled (see enable)
+
+
+# Command hash table (like bash's `hash`): command name -> absolute path.
+# Each PATH directory is listed once and cached together with its mtime, so
+# a directory is only rescanned after something was added to or removed from it.
+path_dir_cache = {}  # dir -> (mtime_ns, {name: full_path})
+command_table = {}  # name -> full path of the first match on PATH
+command_hits = {}  # full path -> number of times it was executed via the table
+indexed_path = None  # PATH value the table was built for
+last_index_check = 0.0
+INDEX_CHECK_INTERVAL = 1.0  # Seconds between mtime revalidations of PATH dirs
+index_generation = 0  # Bumped every time the command table is rebuilt
+
+# Until something needs the whole table (completion), commands are looked up
+# one by one: checking a few directories is much cheaper than listing all of
+# PATH for a `-c` or script that runs a handful of commands.
+probed_commands = {}  # name -> full path found by probe_path
+probed_path = None  # PATH value probed_commands is valid for
+# Lookups answered from the table / probe cache, and those that had to go to
+# the file system (reported by tracing)
+path_lookups = {"hits": 0, "misses": 0}
 
-command_history = []
-last_written_index = 0  # Track how many commands have been written to file
+# Sorted, deduplicated completion candidates (builtins + command table).
+# Prefix matches are a contiguous slice found with bisect.
+command_names = []
+command_names_key = None  # (index_generation, builtins) the list was built for
+
+COMPLETION_PAGE_SIZE = 100  # Matches shown per Tab press for huge match sets
+COMPLETION_RETURN_LIMIT = 200  # Max matches handed back to readline
+
+# The interactive shell builds the table on a background thread while the
+# first prompt is already up. A Tab press before it is done waits a moment,
+# then completes from the directories listed so far.
+warmup = None  # Thread building the command table, until it is done
+COMPLETION_WARMUP_WAIT = 0.05  # Seconds a Tab press waits for the warmup
+PATH_SCAN_WORKERS = 8  # PATH directories listed at once when (re)building
 
 
 def display_matches_hook(substitution, matches, longest_match_length):
-    """Custom display for showing completion matches without trailing spaces"""
+    """Custom display for showing completion matches without trailing spaces.
+
+    Matches are read from the prefix range recorded by complete(), one page
+    per Tab press, so huge match sets are never printed in one go.
+    """
+    names, lo, hi = complete.range
+    start = lo + complete.page * COMPLETION_PAGE_SIZE
+    if start >= hi:
+        # Wrapped past the last page - start over
+        complete.page = 0
+        start = lo
+    end = min(start + COMPLETION_PAGE_SIZE, hi)
+
     print()
-    for match in matches:
-        print(match.rstrip(), end="  ")  # Remove space for display
+    for match in names[start:end]:
+        print(match, end="  ")
     print()
+    if end < hi or start > lo:
+        print(
+            f"[{start - lo + 1}-{end - lo} of {hi - lo}, press Tab for more]"
+        )
+    complete.page += 1
+    import readline
+
     print("$ " + readline.get_line_buffer(), end="", flush=True)
 
 
+def sorted_command_names():
+    """Return the sorted completion candidates, rebuilding them if stale"""
+    global command_names, command_names_key
+    if not finish_warmup(COMPLETION_WARMUP_WAIT):
+        # Partial results, not cached: a later Tab sees more directories
+        names = set(BUILTINS)
+        for _, entries in list(path_dir_cache.values()):
+            names.update(entries)
+        return sorted(names)
+    refresh_command_index()
+    key = (index_generation, tuple(BUILTINS))
+    if key != command_names_key:
+        command_names = sorted(set(BUILTINS).union(command_table))
+        command_names_key = key
+    return command_names
+
+
+def prefix_range(names, prefix):
+    """Return (lo, hi) so that names[lo:hi] are exactly the prefix matches"""
+    lo = bisect.bisect_left(names, prefix)
+    hi = bisect.bisect_left(names, prefix + "\U0010ffff", lo)
+    return lo, hi
+
+
 def complete(text, state):
     if state == 0:
-        commands = list(BUILTINS)
+        import readline
 
-        path = os.environ.get("PATH", "")
-        for dir in path.split(":"):
-            try:
-                for item in os.listdir(dir):
-                    full_path = os.path.join(dir, item)
-                    if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
-                        commands.append(item)
-            except:
-                pass
+        before = readline.get_line_buffer()[: readline.get_begidx()]
+        context = completion_context(before)
+        if context == "command" and "/" not in text:
+            names = sorted_command_names()
+            lo, hi = prefix_range(names, text)
+        else:
+            names = path_completions(text, dirs_only=context == "cd")
+            lo, hi = 0, len(names)
+        if complete.range != (names, lo, hi):
+            complete.page = 0
+        complete.range = (names, lo, hi)
 
-        # Generate list of matches
-        complete.matches = [c for c in commands if c.startswith(text)]
+        # Hand readline a bounded list. In a sorted slice the common prefix of
+        # all matches is the common prefix of its two ends, so keeping the last
+        # match means readline still inserts the full LCP.
+        if hi - lo > COMPLETION_RETURN_LIMIT:
+            complete.matches = names[lo : lo + COMPLETION_RETURN_LIMIT - 1]
+            complete.matches.append(names[hi - 1])
+        else:
+            complete.matches = names[lo:hi]
 
     if state < len(complete.matches):
-        # Always add space - display hook handles showing without space
-        return complete.matches[state] + " "
+        # Add a space (the display hook shows matches without it), except
+        # after a directory, whose entries come next
+        match = complete.matches[state]
+        return match if match.endswith("/") else match + " "
     return None
 
 
 complete.matches = []
+complete.range = ([], 0, 0)
+complete.page = 0
+
+
+def scan_path_dir(dir):
+    """List the executables in one PATH directory as {name: full_path}"""
+    entries = {}
+    try:
+        with os.scandir(dir) as it:
+            for entry in it:
+                try:
+                    # DirEntry caches the file type, so only X_OK costs a syscall
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        entries[entry.name] = entry.path
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return entries
+
+
+def update_path_dir(dir):
+    """Rescan a PATH directory if its mtime changed, return True if it did"""
+    try:
+        mtime = os.stat(dir).st_mtime_ns
+    except OSError:
+        mtime = None
+    cached = path_dir_cache.get(dir)
+    if cached is not None and cached[0] == mtime:
+        return False
+    path_dir_cache[dir] = (mtime, scan_path_dir(dir) if mtime else {})
+    return True
+
+
+def update_path_dirs(dirs):
+    """update_path_dir() for many directories, PATH_SCAN_WORKERS at a time,
+    so one slow (e.g. network) directory doesn't hold up the others.
+    Return True if any of them changed."""
+    import collections, threading
+
+    queue = collections.deque(dirs)
+    updated = []
+
+    def worker():
+        while True:
+            try:
+                dir = queue.popleft()
+            except IndexError:
+                return
+            if update_path_dir(dir):
+                updated.append(dir)
+
+    # Daemon threads, so a hung mount can't keep the shell from exiting
+    workers = [
+        threading.Thread(target=worker, daemon=True)
+        for _ in range(min(len(dirs), PATH_SCAN_WORKERS))
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return bool(updated)
 
 
-def find_in_path(command):
-    # Simulate searching for a command in the system PATH
-    # in a real shell, this would check the filesystem
+def refresh_command_index(force=False):
+    """Bring the command table up to date with PATH and return it.
 
+    Directories are only rescanned when their mtime changed; the whole table
+    is rebuilt when PATH itself changed, listing the directories in
+    parallel. Revalidation is throttled to once per INDEX_CHECK_INTERVAL
+    unless force is set.
+    """
+    global indexed_path, last_index_check, index_generation
+
+    path = os.environ.get("PATH", "")
+    now = time.monotonic()
+    if (
+        not force
+        and path == indexed_path
+        and now - last_index_check < INDEX_CHECK_INTERVAL
+    ):
+        return command_table
+    last_index_check = now
+
+    # Keep first occurrence of each directory, PATH order decides precedence
+    dirs = list(dict.fromkeys(d for d in path.split(":") if d))
+    changed = path != indexed_path
+    if changed and len(dirs) > 1:
+        update_path_dirs(dirs)
+    else:
+        for dir in dirs:
+            if update_path_dir(dir):
+                changed = True
+
+    if changed:
+        command_table.clear()
+        for dir in reversed(dirs):
+            command_table.update(path_dir_cache[dir][1])
+        indexed_path = path
+        index_generation += 1
+    return command_table
+
+
+def probe_path(command):
+    """Find a command by checking each PATH directory in turn, like execvp"""
+    global probed_path
     path = os.environ.get("PATH", "")
-    for dir in path.split(":"):
+    if path != probed_path:
+        probed_commands.clear()
+        probed_path = path
+    full_path = probed_commands.get(command)
+    if full_path is not None and os.access(full_path, os.X_OK):
+        path_lookups["hits"] += 1
+        return full_path
+    path_lookups["misses"] += 1
+    for dir in dict.fromkeys(d for d in path.split(":") if d):
         full_path = os.path.join(dir, command)
         if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
+            probed_commands[command] = full_path
             return full_path
+    probed_commands.pop(command, None)
     return None
 
 
-def main():
-    # TODO: Uncomment the code below to pass the first stage
-    global last_written_index
+def start_warmup():
+    """Build the command table on a background thread and return it"""
+    global warmup
+    import threading
 
-    # Read history from HISTFILE on startup if it exists
-    histfile = os.environ.get("HISTFILE")
-    if histfile:
-        histfile = os.path.expanduser(histfile)
+    warmup = threading.Thread(target=refresh_command_index, args=(True,), daemon=True)
+    warmup.start()
+    return warmup
+
+
+def finish_warmup(timeout=None):
+    """Wait for the warmup thread; return False if it's still running"""
+    global warmup
+    if warmup is not None:
+        warmup.join(timeout)
+        if warmup.is_alive():
+            return False
+        warmup = None
+    return True
+
+
+def clear_command_index():
+    """Forget everything that was hashed (hash -r)"""
+    global indexed_path, index_generation
+    finish_warmup()
+    path_dir_cache.clear()
+    command_table.clear()
+    command_hits.clear()
+    probed_commands.clear()
+    indexed_path = None
+    index_generation += 1
+
+
+def find_in_path(command, remember=False):
+    """Resolve a command name to an executable path using the command table
+    (or by probing PATH while the table hasn't been built).
+
+    A name the rescanned table still lacks is probed for in PATH as well,
+    like bash does: `chmod +x` doesn't change a directory's mtime and NFS
+    mtimes can be too coarse to notice a new file. What that finds is added
+    to the table.
+
+    With remember set the lookup counts as a hit for the `hash` builtin.
+    """
+    global index_generation
+    if "/" in command:
+        if os.path.isfile(command) and os.access(command, os.X_OK):
+            return command
+        return None
+
+    if indexed_path is None:
+        full_path = probe_path(command)
+    else:
+        full_path = refresh_command_index().get(command)
+        if full_path is None:
+            # Something may have been installed since the last check
+            path_lookups["misses"] += 1
+            full_path = refresh_command_index(force=True).get(command)
+        elif not os.access(full_path, os.X_OK):
+            # Stale entry (file removed or chmod'ed) - rescan and retry once
+            path_lookups["misses"] += 1
+            full_path = refresh_command_index(force=True).get(command)
+        else:
+            path_lookups["hits"] += 1
+        if full_path is None:
+            full_path = probe_path(command)
+            if full_path is not None:
+                command_table[command] = full_path
+                index_generation += 1  # For the completion list
+    if full_path and remember:
+        command_hits[full_path] = command_hits.get(full_path, 0) + 1
+    return full_path
+
+
+# --- Path completion ---------------------------------------------------------
+#
+# Arguments, redirection targets and `cd` complete file names. Listings come
+# from an LRU cache of os.scandir() results that is checked against the
+# directory's mtime, so repeated Tab presses in one directory list it once;
+# DirEntry's file type spares a stat per entry. At most DIR_ENTRY_CAP entries
+# are kept per listing: in a huge directory a prefix is matched by a scan
+# that keeps only the matching entries, cached under that prefix, which also
+# serves longer prefixes typed next.
+
+# (dir, prefix) -> (mtime_ns, sorted names, set of subdirs, truncated)
+dir_listings = {}
+DIR_CACHE_SIZE = 64  # Directory listings kept, least recently used dropped
+DIR_ENTRY_CAP = 20000  # Entries of one directory cached for completion
+# Words after which a command name comes, not an argument
+COMMAND_PREFIXES = frozenset(
+    ("if", "then", "else", "elif", "do", "while", "until", "!", "time", "{")
+)
+ESCAPED_CHARS = frozenset(" \t\n\\'\"`$&|;<>()*?[]#~!{}")
+
+
+def completion_context(before):
+    """What the word after `before` is: "command", "cd" (a directory) or
+    "path" (any file)"""
+    # Only the current command counts: after the last |, ;, &, ( or `
+    cut = max(before.rfind(c) for c in "|;&(`")
+    words = before[cut + 1 :].split()
+    while words and (
+        words[0] in COMMAND_PREFIXES or is_name(words[0].partition("=")[0]) and "=" in words[0]
+    ):
+        words.pop(0)
+    if not words:
+        return "command"
+    if words[-1][-1] in "<>":
+        return "path"  # Redirection target
+    return "cd" if words[0] == "cd" else "path"
+
+
+def read_dir(dir, prefix=""):
+    """(names, subdirs, truncated) for the entries of dir starting with
+    prefix, keeping at most DIR_ENTRY_CAP of them"""
+    names = []
+    subdirs = set()
+    truncated = False
+    try:
+        with os.scandir(dir) as it:
+            for entry in it:
+                name = entry.name
+                if not name.startswith(prefix):
+                    continue
+                if len(names) == DIR_ENTRY_CAP:
+                    truncated = True
+                    break
+                names.append(name)
+                try:
+                    if entry.is_dir():  # Uses d_type, stats only symlinks
+                        subdirs.add(name)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    names.sort()
+    return names, subdirs, truncated
+
+
+def cached_listing(key, mtime):
+    # Look up a listing still valid for mtime, making it the most recent
+    cached = dir_listings.pop(key, None)
+    if cached is not None and cached[0] == mtime:
+        dir_listings[key] = cached
+        return cached
+    return None
+
+
+def list_dir(dir, prefix):
+    """(names, subdirs) of dir, sorted, including every entry starting with
+    prefix, from the listing cache while the directory's mtime is
+    unchanged"""
+    try:
+        mtime = os.stat(dir).st_mtime_ns
+    except OSError:
+        return [], set()
+    cached = cached_listing((dir, ""), mtime)
+    if cached is None:
+        cached = (mtime, *read_dir(dir))
+        dir_listings[(dir, "")] = cached
+    if cached[3] and prefix:
+        # Not every entry is in there: find the longest cached prefix of
+        # this one whose listing is complete, else scan for this prefix
+        for end in range(len(prefix), 0, -1):
+            cached = cached_listing((dir, prefix[:end]), mtime)
+            if cached is not None and not cached[3]:
+                break
+        else:
+            cached = (mtime, *read_dir(dir, prefix))
+            dir_listings[(dir, prefix)] = cached
+    while len(dir_listings) > DIR_CACHE_SIZE:
+        del dir_listings[next(iter(dir_listings))]
+    return cached[1], cached[2]
+
+
+def escape_path(name):
+    if ESCAPED_CHARS.isdisjoint(name):
+        return name
+    return "".join("\\" + c if c in ESCAPED_CHARS else c for c in name)
+
+
+def path_completions(text, dirs_only=False):
+    """Sorted completions of a (partial) path, directories ending in /"""
+    word = text.replace("\\", "")  # Typed escapes
+    head, slash, prefix = word.rpartition("/")
+    dir = os.path.expanduser(head + slash) if slash else "."
+    names, subdirs = list_dir(dir, prefix)
+    lo, hi = prefix_range(names, prefix)
+    hidden = prefix.startswith(".")
+    base = text[: text.rfind("/") + 1]  # As typed, e.g. keeping a ~
+    matches = []
+    for name in names[lo:hi]:
+        if name[0] == "." and not hidden:
+            continue
+        if name in subdirs:
+            matches.append(f"{base}{escape_path(name)}/")
+        elif not dirs_only:
+            matches.append(base + escape_path(name))
+    return matches
+
+
+# --- History -----------------------------------------------------------------
+#
+# History files are plain append-only logs, one command per line, so they stay
+# compatible with other shells. A file loaded at startup is only mmap'ed; it
+# is split into entries the first time they are needed. The dedup set and the
+# search index are also built on first use and then kept up to date.
+#
+# Several sessions can share one file. Every access takes an flock on it;
+# appends are single O_APPEND writes, and rewrites (history -w, compaction)
+# go to a temporary file that is renamed over the original. The shell that
+# loaded the file remembers how far it has read, so the lines other sessions
+# append are merged by reading only the new tail.
+
+HISTORY_WARMUP_DELAY = 1.0  # Max seconds the history warmup lets PATH go first
+HISTORY_TRIM_SLACK = 1.5  # Trim in-memory history once it exceeds cap * slack
+
+
+def history_limit(name):
+    """Read a size cap like HISTSIZE from the environment (None = unlimited)"""
+    try:
+        value = int(get_var(name) or "")
+    except ValueError:
+        return None
+    return max(value, 0)
+
+
+def lock_history_file(path, flags, operation):
+    """Open a history file and flock it, retrying when another session
+    renamed a new file into place while we were waiting for the lock"""
+    while True:
+        fd = os.open(path, flags | os.O_CLOEXEC, 0o600)
         try:
-            with open(histfile, "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        command_history.append(line)
-            last_written_index = len(command_history)
+            fcntl.flock(fd, operation)
+            st, current = os.fstat(fd), os.stat(path)
+            if (st.st_dev, st.st_ino) == (current.st_dev, current.st_ino):
+                return fd
         except FileNotFoundError:
-            pass  # File doesn't exist yet, that's ok
-        except Exception:
-            pass  # Ignore other errors silently
+            pass  # Replaced and removed again, try the new file
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
 
-    readline.set_completer(complete)
-    readline.parse_and_bind("tab: complete")
-    readline.set_completer_delims(" \t\n;")
-    readline.set_completion_display_matches_hook(display_matches_hook)
 
-    while True:
-        # Read - get user input
+def replace_history_file(path, data):
+    """Atomically replace a history file's contents; returns the new stat.
+    The caller holds the lock on the file being replaced."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
         try:
-            command = input("$ ")
-        except EOFError:
-            # Append history on exit (Ctrl+D)
-            histfile = os.environ.get("HISTFILE")
-            if histfile:
-                histfile = os.path.expanduser(histfile)
-                try:
-                    with open(histfile, "a") as f:
-                        # Only append commands added during this session
-                        for hist_cmd in command_history[last_written_index:]:
-                            f.write(hist_cmd + "\n")
-                except Exception:
-                    pass  # Ignore errors silently
-            break  # Handle Ctrl+D to exit
-
-        # Check for output redirection FIRST
-        output_file = None
-        redirect_type = "stdout"  # Default redirect type
-        append_mode = False  # Default to overwrite mode
-
-        if command.strip():
-            command_history.append(command)
-
-        if ">" in command:
-            if "2>>" in command:
-                cmd_part, file_part = command.split("2>>", 1)
-                redirect_type = "stderr"  # Redirect/Append standard error
-                append_mode = True
-            elif "1>>" in command:
-                cmd_part, file_part = command.split("1>>", 1)
-                redirect_type = "stdout"  # Append/Redirect standard ouput
-                append_mode = True
-            elif ">>" in command:
-                cmd_part, file_part = command.split(">>", 1)
-                redirect_type = "stdout"
-                append_mode = True
-            elif "2>" in command:
-                cmd_part, file_part = command.split("2>", 1)
-                redirect_type = "stderr"
-                append_mode = False
-            elif "1>" in command:
-                cmd_part, file_part = command.split("1>", 1)
-                redirect_type = "stdout"
-                append_mode = False
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return st
+
+
+def encode_history(entries):
+    return "".join(entry + "\n" for entry in entries).encode(errors="surrogateescape")
+
+
+def split_history(data):
+    """Split raw log contents into entries, skipping blank lines"""
+    entries = []
+    for line in data.split(b"\n"):
+        line = line.strip()
+        if line:
+            entries.append(line.decode(errors="surrogateescape"))
+    return entries
+
+
+class HistoryIndex:
+    """Search structures over the distinct history entries.
+
+    Each distinct entry gets an id. Prefix lookups bisect a sorted list of the
+    entries; substring lookups intersect trigram posting lists (ids are handed
+    out in increasing order, so every posting list is an already sorted
+    array). Entries are padded so that short entries and queries have
+    trigrams too.
+    """
+
+    def __init__(self):
+        self.ids = {}  # entry -> id
+        self.entries = []  # id -> entry
+        self.last = []  # id -> position of the most recent use
+        self.count = []  # id -> number of uses
+        self.max_count = 0
+        self.sorted = []  # Distinct entries in sorted order
+        self.grams = {}  # trigram -> array of ids
+
+    def build(self, entries):
+        """Index a batch of entries, sorting the prefix list only once"""
+        for position, entry in enumerate(entries):
+            self.add(entry, position, keep_sorted=False)
+        self.sorted.sort()
+
+    def add(self, entry, position, keep_sorted=True):
+        entry_id = self.ids.get(entry)
+        if entry_id is not None:
+            self.last[entry_id] = position
+            self.count[entry_id] += 1
+            self.max_count = max(self.max_count, self.count[entry_id])
+            return
+        entry_id = len(self.entries)
+        self.ids[entry] = entry_id
+        self.entries.append(entry)
+        self.last.append(position)
+        self.count.append(1)
+        self.max_count = max(self.max_count, 1)
+        if keep_sorted:
+            bisect.insort(self.sorted, entry)
+        else:
+            self.sorted.append(entry)
+        padded = f"\0{entry}\0"
+        grams = self.grams
+        for gram in {padded[i : i + 3] for i in range(len(padded) - 2)}:
+            postings = grams.get(gram)
+            if postings is None:
+                postings = grams[gram] = array.array("I")
+            postings.append(entry_id)
+
+    def prefix_ids(self, text):
+        lo, hi = prefix_range(self.sorted, text)
+        ids = self.ids
+        return [ids[entry] for entry in self.sorted[lo:hi]]
+
+    def substring_ids(self, text):
+        if len(text) < 3:
+            # Shorter than a trigram: every entry containing it has a padded
+            # trigram containing it, so union those posting lists
+            found = set()
+            for gram, postings in self.grams.items():
+                if text in gram:
+                    found.update(postings)
+            candidates = found
+        else:
+            # Entries holding the query hold its rarest trigram; checking
+            # those directly is cheaper than intersecting posting lists
+            candidates = None
+            for i in range(len(text) - 2):
+                postings = self.grams.get(text[i : i + 3])
+                if postings is None:
+                    return []
+                if candidates is None or len(postings) < len(candidates):
+                    candidates = postings
+        entries = self.entries
+        return [i for i in candidates if text in entries[i]]
+
+
+class History:
+    """The session's command history.
+
+    Behaves like a list of entries (len, iteration, indexing, slicing,
+    append) with file load/save on top. `unsaved` counts the entries at the
+    end that have not been written to the followed file (HISTFILE) yet;
+    what other files got is tracked per file, so the automatic HISTFILE
+    writes don't hide entries from `history -a FILE`.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._pending = None  # mmap of a loaded file not yet split
+        self.unsaved = 0
+        self._added = []  # Entries added this session, for other files
+        self._written = {}  # Other file -> len(self._added) when last written
+        self._seen = None  # Set of all entries, for `history -r` dedup
+        self._index = None  # HistoryIndex, built on the first search
+        self._position = 0  # Positions handed to the index so far
+        self._tail_path = None  # The file whose new lines get merged in
+        self._tail_id = None  # (st_dev, st_ino) of that file when last read
+        self._tail_offset = 0  # Bytes of it read so far
+        self._tail_lines = None  # Lines in those bytes, None until counted
+        self._warmup = None  # Thread splitting and indexing the loaded file
+        self._warmed = None  # (entries, index) it made of the loaded file
+
+    def load(self, path):
+        """Load a history file without reading it yet, and follow it"""
+        self._tail_path = path
+        fd = lock_history_file(path, os.O_RDONLY, fcntl.LOCK_SH)
+        try:
+            st = os.fstat(fd)
+            # A line still being written by a crashed session is left out
+            size = self._tail_offset = last_line_end(fd, st.st_size)
+            self._tail_id = (st.st_dev, st.st_ino)
+            if size:
+                self._pending = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            # The mmap holds a dup of fd, which would keep the lock too
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def warm_up(self, after=None):
+        """Split and index the loaded file on a background thread.
+
+        The thread only reads the mmap and builds new objects; they are put
+        in place by the first _materialize(), which waits for the thread.
+        It first gives the thread `after` up to HISTORY_WARMUP_DELAY seconds
+        to finish: indexing holds the GIL, which would slow down I/O bound
+        work like listing PATH a lot.
+        """
+        if self._pending is None:
+            return
+        import threading
+
+        def run():
+            if after is not None:
+                after.join(HISTORY_WARMUP_DELAY)
+            loaded = split_history(self._pending[:])
+            index = HistoryIndex()
+            index.build(loaded)
+            self._warmed = (loaded, index)
+
+        self._warmup = threading.Thread(target=run, daemon=True)
+        self._warmup.start()
+
+    def _materialize(self):
+        # Split the loaded file in front of the entries added since
+        if self._warmup is not None:
+            self._warmup.join()
+            self._warmup = None
+        if self._pending is None:
+            return
+        pending, self._pending = self._pending, None
+        if self._warmed is None:
+            loaded, index = split_history(pending[:]), None
+        else:
+            (loaded, index), self._warmed = self._warmed, None
+        pending.close()
+        self._entries[:0] = loaded
+        self._index = None
+        self._seen = None
+        if index is not None:
+            # Index the entries added while the thread was running too
+            for position in range(len(loaded), len(self._entries)):
+                index.add(self._entries[position], position)
+            self._index = index
+            self._position = len(self._entries)
+        self._trim()
+
+    def _trim(self):
+        cap = history_limit("HISTSIZE")
+        if cap is not None and len(self._entries) > cap * HISTORY_TRIM_SLACK:
+            del self._entries[: len(self._entries) - cap]
+            self.unsaved = min(self.unsaved, cap)
+            self._index = None
+            self._seen = None
+
+    def _offset(self):
+        # Entries kept beyond HISTSIZE (see _trim) are hidden, not yet deleted
+        self._materialize()
+        cap = history_limit("HISTSIZE")
+        if cap is not None and len(self._entries) > cap:
+            return len(self._entries) - cap
+        return 0
+
+    def __len__(self):
+        return len(self._entries) - self._offset()
+
+    def __iter__(self):
+        return itertools.islice(self._entries, self._offset(), None)
+
+    def __getitem__(self, key):
+        offset = self._offset()
+        if offset:
+            return self._entries[offset:][key]
+        return self._entries[key]
+
+    def append(self, entry):
+        self._entries.append(entry)
+        self._added.append(entry)
+        self.unsaved += 1
+        if self._seen is not None:
+            self._seen.add(entry)
+        if self._index is not None:
+            self._index.add(entry, self._position)
+            self._position += 1
+        if self._pending is None:
+            self._trim()
+
+    def read_file(self, path):
+        """Append the entries of a file that aren't in the history yet"""
+        fd = lock_history_file(path, os.O_RDONLY, fcntl.LOCK_SH)
+        try:
+            with open(fd, "rb", closefd=False) as f:
+                loaded = split_history(f.read())
+        finally:
+            os.close(fd)
+        for entry in self._unseen(loaded):
+            self.append(entry)
+
+    def _unseen(self, entries):
+        # The distinct entries that aren't in the history yet
+        self._materialize()
+        if self._seen is None:
+            self._seen = set(self._entries)
+        return [entry for entry in dict.fromkeys(entries) if entry not in self._seen]
+
+    def write_file(self, path):
+        """Replace a file with the whole history"""
+        fd = lock_history_file(path, os.O_RDONLY | os.O_CREAT, fcntl.LOCK_EX)
+        try:
+            # Lines other sessions appended since the last merge are kept
+            self._merge_tail(path, fd)
+            st = replace_history_file(path, encode_history(self))
+            self._followed(path, st, len(self))
+        finally:
+            os.close(fd)
+        self._saved(path)
+
+    def _unsaved(self, path):
+        # The entries a file hasn't been given yet
+        if path == self._tail_path:
+            return self._entries[len(self._entries) - self.unsaved :]
+        return self._added[self._written.get(path, 0) :]
+
+    def _saved(self, path):
+        if path == self._tail_path:
+            self.unsaved = 0
+        else:
+            self._written[path] = len(self._added)
+
+    def append_file(self, path):
+        """Append the entries not written yet to a file, after merging the
+        lines other sessions appended to it"""
+        fd = lock_history_file(
+            path, os.O_RDWR | os.O_CREAT | os.O_APPEND, fcntl.LOCK_EX
+        )
+        try:
+            self._merge_tail(path, fd)
+            size = os.fstat(fd).st_size
+            # A torn last line has no newline, so this counts the whole file
+            lines = self._tail_lines if path == self._tail_path else None
+            new = self._unsaved(path)
+            if new:
+                data = encode_history(new)
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    data = b"\n" + data  # Don't glue onto a torn line
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view) :]
+                size += len(data)
+                if lines is not None:
+                    lines += data.count(b"\n")
+                self._saved(path)
+            st, lines = compact_history_file(path, fd, size, lines)
+            self._followed(path, st or os.fstat(fd), lines)
+        finally:
+            os.close(fd)
+
+    def merge_file(self, path):
+        """Merge the lines other sessions appended to the followed file"""
+        if path != self._tail_path:
+            return
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        if (st.st_dev, st.st_ino) == self._tail_id and st.st_size == self._tail_offset:
+            return  # Nothing new, skip the locking
+        fd = lock_history_file(path, os.O_RDONLY, fcntl.LOCK_SH)
+        try:
+            self._merge_tail(path, fd)
+        finally:
+            os.close(fd)
+
+    def _merge_tail(self, path, fd):
+        # Read the complete lines past the offset of the followed file
+        if path != self._tail_path:
+            return
+        st = os.fstat(fd)
+        end = last_line_end(fd, st.st_size)
+        replaced = self._tail_id is not None and (
+            (st.st_dev, st.st_ino) != self._tail_id or end < self._tail_offset
+        )
+        self._tail_id = (st.st_dev, st.st_ino)
+        if replaced:
+            # Rewritten by another session's history -w or compaction; there
+            # is no offset to resume from, so take what we don't have yet
+            self._tail_offset = end
+            data = os.pread(fd, end, 0)
+            self._tail_lines = data.count(b"\n")
+            self._insert_merged(self._unseen(split_history(data)))
+            return
+        if end <= self._tail_offset:
+            return
+        data = os.pread(fd, end - self._tail_offset, self._tail_offset)
+        self._tail_offset = end
+        if self._tail_lines is not None:
+            self._tail_lines += data.count(b"\n")
+        self._insert_merged(split_history(data))
+
+    def _insert_merged(self, entries):
+        # Merged lines go before our unsaved entries, matching the file order
+        if not entries:
+            return
+        at = len(self._entries) - self.unsaved
+        self._entries[at:at] = entries
+        if self._seen is not None:
+            self._seen.update(entries)
+        if self._index is not None:
+            for entry in entries:
+                self._index.add(entry, self._position)
+                self._position += 1
+        if self._pending is None:
+            self._trim()
+
+    def _followed(self, path, st, lines):
+        # Our own write ends the followed file, nothing in it is unread
+        if path == self._tail_path:
+            self._tail_id = (st.st_dev, st.st_ino)
+            self._tail_offset = st.st_size
+            self._tail_lines = lines
+
+    def index(self):
+        self._materialize()  # May put the warmup's index in place
+        if self._index is None:
+            self._index = HistoryIndex()
+            self._index.build(self._entries)
+            self._position = len(self._entries)
+        return self._index
+
+    def recent(self):
+        """Iterate over the visible entries, newest first"""
+        offset = self._offset()
+        return (self._entries[i] for i in range(len(self._entries) - 1, offset - 1, -1))
+
+    def search(self, text, prefix=False, limit=None):
+        """Distinct entries containing (or starting with) text, most recently
+        used first"""
+        index = self.index()
+        ids = index.prefix_ids(text) if prefix else index.substring_ids(text)
+        last = index.last
+        if limit is None:
+            ids = sorted(ids, key=last.__getitem__, reverse=True)
+        else:
+            ids = heapq.nlargest(limit, ids, key=last.__getitem__)
+        return [index.entries[i] for i in ids]
+
+
+SEARCH_CANDIDATE_LIMIT = 5000  # Larger posting lists are searched by recency
+SEARCH_WALK_LIMIT = 50000  # Entries walked newest-first before using the index
+FREQUENCY_WEIGHT = 64  # How many positions of recency a doubling of uses is worth
+
+
+class HistorySearch:
+    """Incremental, ranked substring search for one Ctrl-R session.
+
+    Matches are ranked by recency plus a bonus for frequently used entries.
+    A query whose rarest trigram is rare is answered from the trigram index,
+    and extending it only re-checks the previous candidates. A query made of
+    common text (including 1-2 characters) matches so much that the best
+    matches are found faster by walking the history newest-first until no
+    older entry can outrank them. When nothing contains the query, entries
+    containing its characters in order are offered instead (fuzzy).
+    """
+
+    def __init__(self, history, limit=100):
+        self.history = history
+        self.index = history.index()
+        self.limit = limit
+        self.query = None
+        self.candidates = None  # Every id containing self.query, if known
+        self.fuzzy = False
+
+    def rarest_postings(self, query):
+        # Smallest posting list among the query's trigrams ([] if one is absent)
+        smallest = None
+        for i in range(len(query) - 2):
+            postings = self.index.grams.get(query[i : i + 3], ())
+            if smallest is None or len(postings) < len(smallest):
+                smallest = postings
+        return smallest
+
+    def walk_recent(self, matches):
+        """Best entries for which matches(entry) is true, found by walking
+        newest-first, or None if the walk limit was hit before the ranking
+        was settled"""
+        # No entry can gain more than this from its use count
+        max_bonus = FREQUENCY_WEIGHT * self.index.max_count.bit_length()
+        found = {}
+        settled_at = None
+        for steps, entry in enumerate(self.history.recent()):
+            if settled_at is not None and steps > settled_at + max_bonus:
+                return list(found)
+            if steps >= SEARCH_WALK_LIMIT:
+                return None
+            if entry not in found and matches(entry):
+                found[entry] = None
+                if len(found) == self.limit:
+                    settled_at = steps
+        return list(found)
+
+    def update(self, query):
+        """Return the ranked matches for a new query"""
+        index = self.index
+        entries = index.entries
+        recent = None
+        if (
+            self.candidates is not None
+            and self.query is not None
+            and query.startswith(self.query)
+        ):
+            candidates = [i for i in self.candidates if query in entries[i]]
+        else:
+            postings = self.rarest_postings(query) if len(query) >= 3 else None
+            if postings is None or len(postings) > SEARCH_CANDIDATE_LIMIT:
+                recent = self.walk_recent(lambda entry: query in entry)
+            if recent is not None:
+                candidates = [index.ids[entry] for entry in recent]
+            else:
+                if postings is None or len(postings) > SEARCH_CANDIDATE_LIMIT:
+                    postings = index.substring_ids(query)
+                candidates = [i for i in postings if query in entries[i]]
+        self.query = query
+        # A walk only finds the best matches, it can't be narrowed later
+        self.candidates = None if recent is not None else candidates
+
+        self.fuzzy = not candidates and len(query) >= 2
+        if self.fuzzy:
+            # Characters in order with anything in between, e.g. "gco" -> "git co"
+            import re
+
+            pattern = re.compile(".*?".join(map(re.escape, query)))
+            recent = self.walk_recent(pattern.search) or []
+            return self.rank([index.ids[entry] for entry in recent])
+        return self.rank(candidates)
+
+    def rank(self, candidates):
+        last = self.index.last
+        count = self.index.count
+        # Newer ids first, so the heap rarely has to replace its minimum
+        scored = [
+            (last[i] + FREQUENCY_WEIGHT * count[i].bit_length(), i)
+            for i in reversed(candidates)
+        ]
+        return [self.index.entries[i] for _, i in heapq.nlargest(self.limit, scored)]
+
+
+def last_line_end(fd, size):
+    """Offset just past the last newline in the first `size` bytes of fd"""
+    end = size
+    while end > 0:
+        start = max(0, end - 4096)
+        i = os.pread(fd, end - start, start).rfind(b"\n")
+        if i >= 0:
+            return start + i + 1
+        end = start
+    return 0
+
+
+def compact_history_file(path, fd, size, count=None):
+    """Cut a locked history file down to its last HISTFILESIZE lines once it
+    grew past twice that, so the log doesn't grow without bound.
+
+    count is the file's number of lines if the caller knows it; otherwise
+    the file is read to count them. Returns (stat of the new file or None
+    if nothing was done, number of lines now or None if not counted).
+    """
+    cap = history_limit("HISTFILESIZE")
+    if cap is None or count is not None and count <= cap * 2:
+        return None, count
+    if size <= cap * 2:
+        return None, count  # Each line takes a byte at least
+    lines = os.pread(fd, size, 0).splitlines(keepends=True)
+    if len(lines) <= cap * 2:
+        return None, len(lines)
+    return replace_history_file(path, b"".join(lines[len(lines) - cap :])), cap
+
+
+command_history = History()
+
+
+class ShellSyntaxError(Exception):
+    pass
+
+
+class IncompleteInput(ShellSyntaxError):
+    """The input ended inside a quote or compound command and continues on
+    the next line. closers lists strings one of which a later line must
+    contain to complete it (None when any line might)."""
+
+    def __init__(self, closers=None):
+        super().__init__("syntax error: unexpected end of file")
+        self.closers = closers
+
+
+class ExitShell(Exception):
+    """Raised by the exit builtin to unwind back to the main loop"""
+
+    def __init__(self, status=0):
+        super().__init__(status)
+        self.status = status
+
+
+# --- Parser ------------------------------------------------------------------
+#
+# A line is lexed once into tokens and parsed into a small AST:
+#
+#   CommandList  - and_or lists separated by ";" / "&" / newlines
+#   AndOr        - pipelines joined by "&&" / "||"
+#   Pipeline     - commands joined by "|"
+#   SimpleCommand - assignments and words plus its own redirections
+#   If, For, While, Group, Subshell, FunctionDef - compound commands, which
+#                  take the place of a SimpleCommand in a pipeline
+#
+# Words keep their quoting as a tuple of (kind, value) parts so expansion can
+# be done at execution time: "lit" is unquoted text, "sq" is literal text
+# (single quotes or backslash escapes) and "dq" is double quoted text.
+# "param", "subst" and "arith" hold a Param, a CommandSubst or an Arith for
+# $name / ${...}, $(...) / `...` and $((...)); "qparam" and "qsubst" are the
+# same inside double quotes, where the result is not split or globbed.
+# Everything is parsed once: a loop body runs from its AST every iteration.
+
+OPERATORS = ["&&", "||", ";", "&", "|", "(", ")", "\n"]
+REDIRECT_OPERATORS = ["&>>", "<<<", ">>", ">&", "<&", "&>", ">", "<"]
+# Reserved words, recognized unquoted in command position
+KEYWORDS = {
+    "!", "time", "if", "then", "elif", "else", "fi", "for", "in", "while",
+    "until", "do", "done", "{", "}", "function",
+}
+CLOSING_WORDS = {"then", "elif", "else", "fi", "do", "done", "}"}
+
+
+class Redirect:
+    def __init__(self, fd, op, target):
+        self.fd = fd  # File descriptor number being redirected
+        self.op = op  # One of REDIRECT_OPERATORS
+        self.target = target  # Word (file name, fd number or here-string)
+        static = static_words([target])
+        self.text = static[0] if static else None  # Target without expansions
+
+
+class SimpleCommand:
+    def __init__(self, words, redirects, assignments=()):
+        self.words = words
+        self.redirects = redirects
+        self.assignments = assignments  # (name, value word) pairs
+        # Words without anything to expand are resolved once, here
+        self.argv = static_words(words)
+        values = static_words([value for name, value in assignments])
+        if values is not None:
+            values = list(zip([name for name, value in assignments], values))
+        self.values = values  # (name, value) pairs when nothing needs expanding
+
+
+class If:
+    def __init__(self, clauses, else_body):
+        self.clauses = clauses  # (condition, body) CommandList pairs
+        self.else_body = else_body  # CommandList or None
+        self.redirects = []
+
+
+class For:
+    def __init__(self, name, words, body):
+        self.name = name
+        self.words = words  # None iterates over "$@"
+        self.body = body
+        self.items = static_words(words) if words is not None else None
+        self.redirects = []
+
+
+class While:
+    def __init__(self, condition, body, until=False):
+        self.condition = condition
+        self.body = body
+        self.until = until
+        self.redirects = []
+
+
+class Group:
+    def __init__(self, body):
+        self.body = body  # { body; }
+        self.redirects = []
+
+
+class Subshell:
+    def __init__(self, body):
+        self.body = body  # ( body ), run in a forked child
+        self.redirects = []
+
+
+class FunctionDef:
+    def __init__(self, name, body):
+        self.name = name
+        self.body = body  # A compound command
+        self.redirects = []
+
+
+class Param:
+    """$name or ${name[op word]}"""
+
+    def __init__(self, name, source, op=None, word=None, length=False):
+        self.name = name
+        self.source = source
+        self.op = op  # One of PARAM_OPERATORS
+        self.word = word  # Parts of the word after op
+        self.length = length  # ${#name}
+
+
+class CommandSubst:
+    def __init__(self, tree, source):
+        self.tree = tree
+        self.source = source
+
+
+class Arith:
+    def __init__(self, parts, source):
+        self.parts = parts  # Parts of the expression, expanded before evaluation
+        self.source = source
+
+
+class Pipeline:
+    def __init__(self, commands, negated=False, text="", timed=None):
+        self.commands = commands
+        self.negated = negated
+        self.text = text  # Source text, used to describe jobs
+        self.timed = timed  # "time" or "time -p" when run under the keyword
+
+
+class AndOr:
+    def __init__(self, pipelines, ops, text=""):
+        self.pipelines = pipelines
+        self.ops = ops  # ops[i] joins pipelines[i] and pipelines[i + 1]
+        self.text = text
+
+
+class CommandList:
+    def __init__(self, items):
+        self.items = items  # List of (AndOr, background) pairs
+
+
+PARAM_OPERATORS = [
+    ":-", ":=", ":+", ":?", "-", "=", "+", "?", "##", "#", "%%", "%", "//", "/",
+]
+SPECIAL_PARAMS = "?$#@*!0123456789"
+
+
+def is_name(text):
+    """Whether text is a valid variable or function name"""
+    return (
+        text.isascii()
+        and (text[:1].isalpha() or text[:1] == "_")
+        and text.replace("_", "a").isalnum()
+    )
+
+
+def static_words(words):
+    """The words' text if none of them needs expanding, else None"""
+    argv = []
+    for word in words:
+        for index, (kind, text) in enumerate(word):
+            if kind == "lit":
+                if has_glob(text) or index == 0 and text.startswith("~"):
+                    return None
+            elif kind not in ("sq", "dq"):
+                return None
+        argv.append("".join(text for kind, text in word))
+    return argv
+
+
+def default_fd(op):
+    # Which fd a redirection applies to when no number precedes it
+    return 0 if op in ("<", "<&", "<<<") else 1
+
+
+def tokenize(line, spans=None):
+    """Split a line into ("word", parts), ("op", text) and
+    ("redirect", op, fd) tokens in a single pass.
+
+    If a spans list is given, the (start, end) offset of each token in the
+    line is appended to it.
+    """
+    tokens = []
+    if spans is None:
+        spans = []
+    word_start = 0
+    parts = []  # Parts of the word being built
+    lit = []  # Unquoted characters not yet flushed into parts
+    in_word = False
+    i = 0
+    n = len(line)
+
+    def flush_lit():
+        if lit:
+            parts.append(("lit", "".join(lit)))
+            lit.clear()
+
+    def end_word():
+        nonlocal parts, in_word
+        flush_lit()
+        if in_word:
+            tokens.append(("word", tuple(parts)))
+            spans.append((word_start, i))
+        parts = []
+        in_word = False
+
+    while i < n:
+        c = line[i]
+        if not in_word:
+            word_start = i
+        if c in " \t":
+            end_word()
+            i += 1
+        elif c == "#" and not in_word:
+            # Comment runs to the end of the line
+            while i < n and line[i] != "\n":
+                i += 1
+        elif c == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                raise IncompleteInput(("'",))
+            flush_lit()
+            parts.append(("sq", line[i + 1 : end]))
+            in_word = True
+            i = end + 1
+        elif c == '"':
+            flush_lit()
+            in_word = True
+            i = lex_double_quoted(line, i + 1, parts)
+        elif c == "\\":
+            if i + 1 == n:
+                raise IncompleteInput()  # Continued on the next line
+            if line[i + 1] == "\n":
+                i += 2  # Line continuation
+                continue
+            flush_lit()
+            parts.append(("sq", line[i + 1]))
+            in_word = True
+            i += 2
+        elif c in "$`":
+            part, end = lex_expansion(line, i, False)
+            if part is None:
+                lit.append(c)
             else:
-                cmd_part, file_part = command.split(">", 1)
-                redirect_type = "stdout"
-                append_mode = False
-
-            # Parse the file part to get just the filename (handles quotes)
-            file_parts = shlex.split(file_part.strip())
-            output_file = file_parts[0] if file_parts else None
-            command = cmd_part.strip()  # Update command to be just before redirect
-
-        # Check for pipeline (pipe character)
-        if "|" in command:
-            # Split command string on pipe character
-            pipeline_commands = command.split("|")
-
-            # Validate pipeline has at least 2 commands
-            if len(pipeline_commands) < 2:
-                print("Error: pipeline needs at least 2 commands")
+                flush_lit()
+                parts.append(part)
+            in_word = True
+            i = end
+        elif c in "|&;<>()\n":
+            # A word made only of digits right before < or > is the fd number
+            fd = None
+            start = i
+            if c in "<>" and in_word and not parts and "".join(lit).isdigit():
+                fd = int("".join(lit))
+                lit.clear()
+                in_word = False
+                start = word_start
+            end_word()
+            for op in REDIRECT_OPERATORS:
+                if line.startswith(op, i):
+                    tokens.append(("redirect", op, fd if fd is not None else default_fd(op)))
+                    break
+            else:
+                for op in OPERATORS:
+                    if line.startswith(op, i):
+                        tokens.append(("op", op))
+                        break
+            i += len(op)
+            spans.append((start, i))
+        else:
+            lit.append(c)
+            in_word = True
+            i += 1
+
+    end_word()
+    return tokens
+
+
+def lex_double_quoted(line, i, parts):
+    """Lex the inside of a double quoted string starting at i, append its
+    parts and return the index just past the closing quote."""
+    text = []
+    n = len(line)
+    first = len(parts)
+
+    def flush():
+        # Empty text is left out, so that "$@" can expand to no word at all
+        if text:
+            parts.append(("dq", "".join(text)))
+            text.clear()
+
+    while i < n:
+        c = line[i]
+        if c == '"':
+            flush()
+            if len(parts) == first:
+                parts.append(("dq", ""))  # "" is still an (empty) word
+            return i + 1
+        if c == "\\" and i + 1 < n and line[i + 1] in '\\"$`\n':
+            # Only these characters can be escaped inside double quotes
+            flush()
+            if line[i + 1] != "\n":
+                parts.append(("sq", line[i + 1]))
+            i += 2
+            continue
+        if c in "$`":
+            part, end = lex_expansion(line, i, True)
+            if part is not None:
+                flush()
+                parts.append(part)
+                i = end
                 continue
+        text.append(c)
+        i += 1
+    raise IncompleteInput(('"',))
 
-            # Parse all commands in the pipeline
-            parsed_cmds = []
-            for cmd_str in pipeline_commands:
-                parts = shlex.split(cmd_str.strip())
-                if parts:
-                    parsed_cmds.append(parts)
 
-            try:
-                # Build pipeline with support for builtins at any position
-                processes = []  # List of subprocess.Popen objects
-                prev_stdout = None  # Output from previous command
-
-                for i, cmd_parts in enumerate(parsed_cmds):
-                    cmd = cmd_parts[0]
-                    is_first = i == 0
-                    is_last = i == len(parsed_cmds) - 1
-
-                    # Handle builtin commands
-                    if cmd in BUILTINS:
-                        # Execute builtin and capture output
-                        if cmd == "echo":
-                            builtin_output = " ".join(cmd_parts[1:])
-                        elif cmd == "pwd":
-                            builtin_output = os.getcwd()
-                        elif cmd == "type":
-                            if len(cmd_parts) > 1:
-                                cmd_to_check = cmd_parts[1]
-                                if cmd_to_check in BUILTINS:
-                                    builtin_output = (
-                                        f"{cmd_to_check} is a shell builtin"
-                                    )
-                                else:
-                                    path = find_in_path(cmd_to_check)
-                                    if path:
-                                        builtin_output = f"{cmd_to_check} is {path}"
-                                    else:
-                                        builtin_output = f"{cmd_to_check}: not found"
-                            else:
-                                builtin_output = ""
-                        elif cmd == "cd":
-                            if len(cmd_parts) > 1:
-                                path = cmd_parts[1]
-                                if path == "~":
-                                    path = os.path.expanduser("~")
-                                try:
-                                    os.chdir(path)
-                                    builtin_output = ""
-                                except FileNotFoundError:
-                                    builtin_output = (
-                                        f"cd: {path}: No such file or directory"
-                                    )
-                                except Exception as e:
-                                    builtin_output = f"cd: {e}"
-                            else:
-                                builtin_output = ""
-                        elif cmd == "history":
-                            # Check for -w flag (write to file)
-                            if len(cmd_parts) > 1 and cmd_parts[1] == "-w":
-                                history_file = os.path.expanduser(
-                                    cmd_parts[2]
-                                    if len(cmd_parts) > 2
-                                    else "~/.shell_history"
-                                )
-                                try:
-                                    with open(history_file, "w") as f:
-                                        for hist_cmd in command_history:
-                                            f.write(hist_cmd + "\n")
-                                    last_written_index = len(command_history)
-                                    builtin_output = ""  # Silent success
-                                except Exception as e:
-                                    builtin_output = f"history: {e}"
-                            # Check for -a flag (append to file)
-                            elif len(cmd_parts) > 1 and cmd_parts[1] == "-a":
-                                history_file = os.path.expanduser(
-                                    cmd_parts[2]
-                                    if len(cmd_parts) > 2
-                                    else "~/.shell_history"
-                                )
-                                try:
-                                    with open(history_file, "a") as f:
-                                        # Only append commands added since last write
-                                        for hist_cmd in command_history[
-                                            last_written_index:
-                                        ]:
-                                            f.write(hist_cmd + "\n")
-                                    last_written_index = len(command_history)
-                                    builtin_output = ""  # Silent success
-                                except Exception as e:
-                                    builtin_output = f"history: {e}"
-                            # Check for -r flag (read from file)
-                            elif len(cmd_parts) > 1 and cmd_parts[1] == "-r":
-                                history_file = os.path.expanduser(
-                                    cmd_parts[2]
-                                    if len(cmd_parts) > 2
-                                    else "~/.shell_history"
-                                )
-                                try:
-                                    with open(history_file, "r") as f:
-                                        for line in f:
-                                            line = line.strip()
-                                            if line and line not in command_history:
-                                                command_history.append(line)
-                                    builtin_output = ""  # No output for -r
-                                except FileNotFoundError:
-                                    builtin_output = f"history: {history_file}: No such file or directory"
-                                except Exception as e:
-                                    builtin_output = f"history: {e}"
-                            # Check if theres a limit argument
-                            elif len(cmd_parts) > 1:
-                                try:
-                                    limit = int(cmd_parts[1])
-                                    history_to_show = command_history[-limit:]
-                                    start_index = (
-                                        len(command_history) - len(history_to_show) + 1
-                                    )
-                                except ValueError:
-                                    history_to_show = command_history
-                                    start_index = 1
-
-                                history_output = []
-                                for i, hist_cmd in enumerate(
-                                    history_to_show, start=start_index
-                                ):
-                                    history_output.append(f"{i:>4}  {hist_cmd}")
-                                builtin_output = "\n".join(history_output)
-                            else:
-                                history_to_show = command_history
-                                start_index = 1
-
-                                history_output = []
-                                for i, hist_cmd in enumerate(
-                                    history_to_show, start=start_index
-                                ):
-                                    history_output.append(f"{i:>4}  {hist_cmd}")
-                                builtin_output = "\n".join(history_output)
-                        else:
-                            builtin_output = ""
-
-                        # If this is the last command, output directly
-                        if is_last:
-                            if output_file:
-                                file_mode = "a" if append_mode else "w"
-                                with open(output_file, file_mode) as f:
-                                    f.write(builtin_output + "\n")
-                            else:
-                                print(builtin_output)
-                            prev_stdout = None
-                        else:
-                            # Not last - need to pipe to next command
-                            # Store output as bytes to pass to next command
-                            prev_stdout = builtin_output.encode()
-
-                    # Handle external commands
-                    else:
-                        # Determine stdin source
-                        if is_first:
-                            stdin_source = None  # Read from terminal
-                        elif isinstance(prev_stdout, bytes):
-                            # Previous was a builtin - create stdin from its output
-                            stdin_source = subprocess.PIPE
-                        else:
-                            # Previous was external - use its stdout
-                            stdin_source = prev_stdout
-
-                        # Determine stdout destination
-                        if is_last and output_file:
-                            # Last command with redirect
-                            file_mode = "a" if append_mode else "w"
-                            f = open(output_file, file_mode)
-                            stdout_dest = f
-                        elif is_last:
-                            # Last command to terminal
-                            stdout_dest = None
-                        else:
-                            # Not last - pipe to next command
-                            stdout_dest = subprocess.PIPE
-
-                        # Create process
-                        proc = subprocess.Popen(
-                            cmd_parts, stdin=stdin_source, stdout=stdout_dest
-                        )
-                        processes.append(proc)
-
-                        # If previous was builtin, write its output to this process
-                        if isinstance(prev_stdout, bytes):
-                            proc.stdin.write(prev_stdout + b"\n")
-                            proc.stdin.close()
-                        # If previous was external, close its stdout in parent
-                        elif prev_stdout is not None:
-                            prev_stdout.close()
-
-                        # If not last, save stdout for next command
-                        if not is_last:
-                            prev_stdout = proc.stdout
-                        else:
-                            prev_stdout = None
-
-                # Wait for all processes to complete
-                for proc in processes:
-                    proc.wait()
-
-                # Close output file if opened
-                if output_file and "f" in locals():
-                    f.close()
-
-            except Exception as e:
-                print(f"Error in pipeline: {e}")
-
-            continue  # Skip normal command execution - go to next prompt
-
-        # Parse command into parts, handling quotes
-        parts = shlex.split(command) if command.strip() else []
-        if not parts:
+def find_closing(line, i, closer):
+    """Return the index of the ")" or "}" closing an expansion whose body
+    starts at i, skipping quoted text and nested brackets."""
+    opener = "(" if closer == ")" else "{"
+    depth = 0
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if c == "\\":
+            i += 2
             continue
+        if c == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                raise IncompleteInput(("'",))
+            i = end
+        elif c == '"':
+            i += 1
+            while i < n and line[i] != '"':
+                i += 2 if line[i] == "\\" else 1
+            if i >= n:
+                raise IncompleteInput(('"',))
+        elif c == opener:
+            depth += 1
+        elif c == closer:
+            if not depth:
+                return i
+            depth -= 1
+        i += 1
+    raise IncompleteInput((closer,))
 
-        cmd = parts[0]
-        args = parts[1:]
 
-        # Evaluate - process the command
-        if cmd == "exit":
-            # Append history on exit
-            histfile = os.environ.get("HISTFILE")
-            if histfile:
-                histfile = os.path.expanduser(histfile)
-                try:
-                    with open(histfile, "a") as f:
-                        # Only append commands added during this session
-                        for hist_cmd in command_history[last_written_index:]:
-                            f.write(hist_cmd + "\n")
-                except Exception:
-                    pass  # Ignore errors silently
-            break
-        elif cmd == "echo":
-            result = " ".join(args)
-            if output_file:
-                file_mode = "a" if append_mode else "w"
-                # Create the file for redirect
-                try:
-                    with open(output_file, file_mode) as f:
-                        if redirect_type == "stdout":
-                            # Redirect stdout to file
-                            f.write(result + "\n")
-                        else:
-                            # Redirecting stderr (2>) but echo produces stdout
-                            # File gets created empty, output goes to terminal
-                            print(result)
-                except Exception as e:
-                    print(f"Error writing to file: {e}")
-            else:
-                print(result)
-        elif cmd == "type":
-            if args:
-                cmd_to_check = args[0]
-                if cmd_to_check in BUILTINS:
-                    print(f"{cmd_to_check} is a shell builtin")
-                else:
-                    path = find_in_path(cmd_to_check)
-                    if path:
-                        print(f"{cmd_to_check} is {path}")
-                    else:
-                        print(f"{cmd_to_check}: not found")
-        elif cmd == "pwd":
-            print(os.getcwd())
-        elif cmd == "cd":
-            if args:
-                path = args[0]
+def parse_nested(text):
+    # The body of $(...) or `...` must be complete on its own
+    try:
+        return parse(text)
+    except IncompleteInput as e:
+        raise ShellSyntaxError(str(e))
 
-                # Expand ~ to home directory
-                if path == "~":
-                    path = os.path.expanduser("~")
 
-                try:
-                    os.chdir(path)
-                except FileNotFoundError:
-                    print(f"cd: {path}: No such file or directory")
-                except Exception as e:
-                    print(f"cd: {e}")
-
-        elif cmd == "history":
-            if args and args[0] == "-w":
-                # Write history to file
-                history_file = os.path.expanduser(
-                    args[1] if len(args) > 1 else "~/.shell_history"
-                )
-                try:
-                    with open(history_file, "w") as f:
-                        for hist_cmd in command_history:
-                            f.write(hist_cmd + "\n")
-                    last_written_index = len(command_history)
-                    pass  # Silent success
-                except Exception as e:
-                    print(f"history: {e}")
-            elif args and args[0] == "-a":
-                # Append history to file
-                history_file = os.path.expanduser(
-                    args[1] if len(args) > 1 else "~/.shell_history"
+def lex_expansion(line, i, quoted):
+    """Lex the expansion starting with the $ or ` at line[i].
+
+    Returns (part, end) with end just past it, or (None, i + 1) when the $
+    doesn't start an expansion and is literal text.
+    """
+    n = len(line)
+    q = "q" if quoted else ""
+    if line[i] == "`":
+        # Inside backquotes a backslash only escapes $, ` and itself
+        j = i + 1
+        body = []
+        while j < n and line[j] != "`":
+            if line[j] == "\\" and j + 1 < n and line[j + 1] in "$`\\":
+                j += 1
+            body.append(line[j])
+            j += 1
+        if j >= n:
+            raise IncompleteInput(("`",))
+        return (q + "subst", CommandSubst(parse_nested("".join(body)), line[i : j + 1])), j + 1
+    c = line[i + 1] if i + 1 < n else ""
+    if c == "(":
+        if line.startswith("((", i + 1):
+            end = find_closing(line, i + 3, ")")
+            if line.startswith(")", end + 1):
+                arith = Arith(lex_parts(line[i + 3 : end]), line[i : end + 2])
+                return ("arith", arith), end + 2
+            # $( (...) ... ) is a command substitution starting with a subshell
+        end = find_closing(line, i + 2, ")")
+        tree = parse_nested(line[i + 2 : end])
+        return (q + "subst", CommandSubst(tree, line[i : end + 1])), end + 1
+    if c == "{":
+        end = find_closing(line, i + 2, "}")
+        return (q + "param", lex_braced_param(line[i + 2 : end], line[i : end + 1])), end + 1
+    if c and c in SPECIAL_PARAMS:
+        return (q + "param", Param(c, line[i : i + 2])), i + 2
+    j = i + 1
+    while j < n and (line[j].isalnum() or line[j] == "_") and line[j].isascii():
+        j += 1
+    if j == i + 1:
+        return None, i + 1
+    return (q + "param", Param(line[i + 1 : j], line[i:j])), j
+
+
+def lex_braced_param(body, source):
+    """Parse the inside of ${...}"""
+    length = body.startswith("#") and len(body) > 1
+    if length:
+        body = body[1:]
+    if body[:1] and body[0] in SPECIAL_PARAMS and not body[:1].isdigit():
+        name = body[0]
+    else:
+        j = 0
+        while j < len(body) and (body[j].isalnum() or body[j] == "_"):
+            j += 1
+        name = body[:j]
+    rest = body[len(name) :]
+    if not name or (not is_name(name) and not name.isdigit() and len(name) > 1):
+        raise ShellSyntaxError(f"{source}: bad substitution")
+    if not rest:
+        return Param(name, source, length=length)
+    if length:
+        raise ShellSyntaxError(f"{source}: bad substitution")
+    for op in PARAM_OPERATORS:
+        if rest.startswith(op):
+            word = rest[len(op) :]
+            if op[0] == "/":
+                # ${name/pattern/replacement}: the word is a (pattern, replacement) pair
+                end = find_closing(word + "}", 0, "}")
+                slash = next(
+                    (k for k in range(end) if word[k] == "/" and word[k - 1 : k] != "\\"),
+                    len(word),
                 )
-                try:
-                    with open(history_file, "a") as f:
-                        # Only append commands added since last write
-                        for hist_cmd in command_history[last_written_index:]:
-                            f.write(hist_cmd + "\n")
-                    last_written_index = len(command_history)
-                    pass  # Silent success
-                except Exception as e:
-                    print(f"history: {e}")
-            elif args and args[0] == "-r":
-                # Read history from file
-                history_file = os.path.expanduser(
-                    args[1] if len(args) > 1 else "~/.shell_history"
+                return Param(
+                    name, source, op, (lex_parts(word[:slash]), lex_parts(word[slash + 1 :]))
                 )
-                try:
-                    with open(history_file, "r") as f:
-                        for line in f:
-                            line = line.strip()
-                            if line and line not in command_history:  # Avoid duplicates
-                                command_history.append(line)
-                except FileNotFoundError:
-                    print(f"history: {history_file}: No such file or directory")
-                except Exception as e:
-                    print(f"history: {e}")
-            elif args:
-                # Check if argument is a number (limit)
-                try:
-                    limit = int(args[0])
-                    history_to_show = command_history[-limit:]
-                    start_index = len(command_history) - len(history_to_show) + 1
-                except ValueError:
-                    # Not a number - show all history
-                    history_to_show = command_history
-                    start_index = 1
+            return Param(name, source, op, lex_parts(word))
+    raise ShellSyntaxError(f"{source}: bad substitution")
+
+
+def lex_parts(text):
+    """Lex text that is a single word even with blanks in it (the word in
+    ${name:-word}, an arithmetic expression) into parts"""
+    parts = []
+    lit = []
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c in "'\"\\$`":
+            if lit:
+                parts.append(("lit", "".join(lit)))
+                lit = []
+            if c == "'":
+                end = text.find("'", i + 1)
+                if end == -1:
+                    raise ShellSyntaxError("unexpected EOF while looking for matching `''")
+                parts.append(("sq", text[i + 1 : end]))
+                i = end + 1
+            elif c == '"':
+                i = lex_double_quoted(text, i + 1, parts)
+            elif c == "\\":
+                parts.append(("sq", text[i + 1 : i + 2]))
+                i += 2
             else:
-                history_to_show = command_history
-                start_index = 1
+                part, i = lex_expansion(text, i, False)
+                parts.append(part or ("lit", c))
+            continue
+        lit.append(c)
+        i += 1
+    if lit:
+        parts.append(("lit", "".join(lit)))
+    return tuple(parts)
+
 
-            # Only display if not -r, -w, or -a flag
-            if not (args and (args[0] == "-r" or args[0] == "-w" or args[0] == "-a")):
-                for i, hist_cmd in enumerate(history_to_show, start=start_index):
-                    print(f"{i:>4}  {hist_cmd}")
+class Parser:
+    def __init__(self, line):
+        self.line = line
+        self.spans = []
+        self.tokens = tokenize(line, self.spans)
+        self.pos = 0
 
+    def text_from(self, start):
+        # Source text of the tokens from index start up to the current one
+        return self.line[self.spans[start][0] : self.spans[self.pos - 1][1]]
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def peek_op(self):
+        token = self.peek()
+        if token and token[0] == "op":
+            return token[1]
+        return None
+
+    def error(self):
+        token = self.peek()
+        if token is None:
+            return IncompleteInput()
+        elif token[0] == "redirect":
+            text = token[1]
+        elif token[0] == "op":
+            text = "newline" if token[1] == "\n" else token[1]
         else:
-            # Execute - run external commands
-            if find_in_path(cmd):
-                try:
-                    if output_file:
-                        file_mode = "a" if append_mode else "w"
-                        # Open file to ensure it's created even if no output
-                        with open(output_file, file_mode) as f:
-                            if redirect_type == "stderr":
-                                subprocess.run(parts, stderr=f)
-                            else:
-                                subprocess.run(parts, stdout=f)
-                    else:
-                        subprocess.run(parts)
-                except Exception as e:
-                    print(f"Error: {e}")
-            else:
-                print(f"{cmd}: command not found")
+            text = word_text(token[1])
+        return ShellSyntaxError(f"syntax error near unexpected token `{text}'")
 
-    # Continue looping back to "Read"
+    def skip_newlines(self):
+        while self.peek_op() == "\n":
+            self.pos += 1
+
+    def at_word(self, words):
+        # Whether the next token is one of these unquoted words
+        token = self.peek()
+        return (
+            token is not None
+            and token[0] == "word"
+            and len(token[1]) == 1
+            and token[1][0][0] == "lit"
+            and token[1][0][1] in words
+        )
+
+    def expect(self, word):
+        if self.peek() is None:
+            raise IncompleteInput((word,))
+        if not self.accept_word(word):
+            raise self.error()
+
+    def parse_list(self, terminators=()):
+        """Parse and_or lists up to the end of the input or, inside a
+        compound command, up to one of the terminators (not consumed)."""
+        items = []
+        self.skip_newlines()
+        while self.peek() is not None:
+            if self.at_word(terminators) or ")" in terminators and self.peek_op() == ")":
+                break
+            and_or = self.parse_and_or()
+            background = False
+            op = self.peek_op()
+            if op in (";", "&", "\n"):
+                background = op == "&"
+                self.pos += 1
+            elif self.peek() is not None and not (op == ")" and ")" in terminators):
+                raise self.error()
+            items.append((and_or, background))
+            self.skip_newlines()
+        if terminators and self.peek() is None:
+            raise IncompleteInput(tuple(terminators))
+        return CommandList(items)
+
+    def parse_body(self, terminators):
+        # The list inside a compound command may not be empty
+        body = self.parse_list(terminators)
+        if not body.items:
+            raise self.error()
+        return body
+
+    def parse_and_or(self):
+        start = self.pos
+        pipelines = [self.parse_pipeline()]
+        ops = []
+        while self.peek_op() in ("&&", "||"):
+            ops.append(self.peek_op())
+            self.pos += 1
+            self.skip_newlines()
+            pipelines.append(self.parse_pipeline())
+        return AndOr(pipelines, ops, self.text_from(start))
+
+    def accept_word(self, text):
+        # Consume the next token if it is exactly the unquoted word text
+        token = self.peek()
+        if token and token[0] == "word" and token[1] == (("lit", text),):
+            self.pos += 1
+            return True
+        return False
+
+    def parse_pipeline(self):
+        start = self.pos
+        timed = None
+        if self.accept_word("time"):
+            timed = "time -p" if self.accept_word("-p") else "time"
+        negated = self.accept_word("!")
+        if timed and not negated and (self.peek() is None or self.peek_op() not in (None, "|", "(")):
+            # A bare `time` times nothing, like in bash
+            return Pipeline([], False, self.text_from(start), timed)
+        commands = [self.parse_command()]
+        while self.peek_op() == "|":
+            self.pos += 1
+            self.skip_newlines()
+            commands.append(self.parse_command())
+        return Pipeline(commands, negated, self.text_from(start), timed)
+
+    def parse_command(self):
+        token = self.peek()
+        if self.peek_op() == "(":
+            self.pos += 1
+            command = Subshell(self.parse_body((")",)))
+            if self.peek_op() != ")":
+                raise self.error()
+            self.pos += 1
+        elif self.at_word(("if", "for", "while", "until", "{", "function")):
+            keyword = token[1][0][1]
+            self.pos += 1
+            if keyword == "if":
+                command = self.parse_if()
+            elif keyword == "for":
+                command = self.parse_for()
+            elif keyword == "{":
+                command = Group(self.parse_body(("}",)))
+                self.expect("}")
+            elif keyword == "function":
+                return self.parse_function(self.peek(), parens=False)
+            else:
+                condition = self.parse_body(("do",))
+                command = While(condition, self.parse_do(), until=keyword == "until")
+        elif self.at_word(CLOSING_WORDS):
+            raise self.error()
+        elif (
+            token is not None
+            and token[0] == "word"
+            and self.tokens[self.pos + 1 : self.pos + 2] == [("op", "(")]
+        ):
+            return self.parse_function(token, parens=True)
+        else:
+            return self.parse_simple_command()
+        command.redirects = self.parse_redirects()
+        return command
+
+    def parse_redirects(self):
+        redirects = []
+        while self.peek() is not None and self.peek()[0] == "redirect":
+            redirects.append(self.parse_redirect())
+        return redirects
+
+    def parse_redirect(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        target = self.peek()
+        if target is None or target[0] != "word":
+            raise self.error()
+        self.pos += 1
+        return Redirect(token[2], token[1], target[1])
+
+    def parse_simple_command(self):
+        words = []
+        redirects = []
+        assignments = []
+        while True:
+            token = self.peek()
+            if token is None or token[0] == "op":
+                break
+            if token[0] == "redirect":
+                redirects.append(self.parse_redirect())
+                continue
+            self.pos += 1
+            word = token[1]
+            if not words and word[0][0] == "lit" and "=" in word[0][1]:
+                # NAME=value words before the command name are assignments
+                name, value = word[0][1].split("=", 1)
+                if is_name(name):
+                    value = ((("lit", value),) if value else ()) + word[1:]
+                    assignments.append((name, value))
+                    continue
+            words.append(word)
+        if not words and not redirects and not assignments:
+            raise self.error()
+        return SimpleCommand(words, redirects, assignments)
+
+    def parse_if(self):
+        clauses = []
+        while True:
+            condition = self.parse_body(("then",))
+            self.expect("then")
+            clauses.append((condition, self.parse_body(("elif", "else", "fi"))))
+            if not self.accept_word("elif"):
+                break
+        else_body = None
+        if self.accept_word("else"):
+            else_body = self.parse_body(("fi",))
+        self.expect("fi")
+        return If(clauses, else_body)
+
+    def parse_for(self):
+        token = self.peek()
+        if token is None:
+            raise self.error()
+        name = word_text(token[1]) if token[0] == "word" else ""
+        if not is_name(name):
+            raise self.error()
+        self.pos += 1
+        self.skip_newlines()
+        words = None
+        if self.accept_word("in"):
+            words = []
+            while self.peek() is not None and self.peek()[0] == "word":
+                words.append(self.peek()[1])
+                self.pos += 1
+            if self.peek_op() not in (";", "\n"):
+                raise self.error()
+            self.pos += 1
+        elif self.peek_op() == ";":
+            self.pos += 1
+        self.skip_newlines()
+        return For(name, words, self.parse_do())
+
+    def parse_do(self):
+        # do list done
+        self.expect("do")
+        body = self.parse_body(("done",))
+        self.expect("done")
+        return body
+
+    def parse_function(self, token, parens):
+        # name() compound-command, or: function name [()] compound-command
+        if token is None:
+            raise self.error()
+        name = word_text(token[1]) if token[0] == "word" else ""
+        if not is_name(name) or name in KEYWORDS:
+            raise self.error()
+        self.pos += 1
+        if parens or self.peek_op() == "(":
+            self.pos += 1
+            if self.peek_op() != ")":
+                raise self.error()
+            self.pos += 1
+        self.skip_newlines()
+        if self.peek_op() != "(" and not self.at_word(("if", "for", "while", "until", "{")):
+            raise self.error()  # The body must be a compound command
+        return FunctionDef(name, self.parse_command())
+
+
+# Parsed lines, most recently used last. Scripts and loops that repeat the
+# same line skip lexing and parsing entirely.
+parse_cache = {}
+PARSE_CACHE_SIZE = 1024
+last_parse_time = 0.0  # Seconds the last parse() took, for tracing
+
+
+def parse(line):
+    """Parse a line into a CommandList, reusing cached ASTs"""
+    global last_parse_time
+    tree = parse_cache.pop(line, None)
+    if tree is None:
+        start = time.perf_counter()
+        try:
+            tree = Parser(line).parse_list()
+        except RecursionError:
+            raise ShellSyntaxError("syntax error: commands nested too deeply")
+        if len(parse_cache) >= PARSE_CACHE_SIZE:
+            del parse_cache[next(iter(parse_cache))]
+        last_parse_time = time.perf_counter() - start
+    else:
+        last_parse_time = 0.0  # A cache hit costs next to nothing
+    parse_cache[line] = tree
+    return tree
+
+
+def word_text(word):
+    """Remove quoting from a word and return its text (expansions are kept
+    as they were written)"""
+    return "".join(
+        value if isinstance(value, str) else value.source for kind, value in word
+    )
+
+
+# --- Expansion ---------------------------------------------------------------
+#
+# Words are expanded when a command runs: parameters, command substitution
+# and arithmetic, then field splitting on IFS and pathname globbing, which
+# only look at unquoted text. Expansion is lazy: expand_words() yields one
+# field at a time and globs stream entries straight from os.scandir, so a
+# `for` loop over a huge directory starts right away. Glob results are
+# sorted by name like in other shells; GLOBSORT=nosort yields them in
+# directory order without holding them all (like bash's GLOBSORT).
+#
+# Unexported variables live in shell_vars and exported ones in os.environ,
+# never in both.
+
+shell_vars = {}  # name -> value of the variables that aren't exported
+functions = {}  # name -> compound command run by a function call
+positional = []  # $1, $2, ...
+script_name = "shell"  # $0
+last_status = 0  # $?
+last_background = None  # $!, pid of the last background job
+substitution_status = 0  # Status of the last command substitution
+local_frames = []  # Per running function: {name: value saved by `local`}
+SHELL_PID = os.getpid()  # $$ stays the shell's pid in forked children
+DEFAULT_IFS = " \t\n"
+ARITH_CACHE_SIZE = 1024
+GLOB_CACHE_SIZE = 1024
+
+
+class ExpansionError(Exception):
+    pass
+
+
+def get_var(name):
+    value = shell_vars.get(name)
+    if value is None:
+        value = os.environ.get(name)
+    return value
+
+
+def set_var(name, value):
+    if name in shell_vars or name not in os.environ:
+        shell_vars[name] = value
+        if name == "TRACEFILE":
+            environ_changed()  # Its cached lookup is dropped there
+    else:
+        os.environ[name] = value
+        environ_changed()
+
+
+def unset_var(name):
+    shell_vars.pop(name, None)
+    if name in os.environ:
+        del os.environ[name]
+        environ_changed()
+    elif name == "TRACEFILE":
+        environ_changed()
+
+
+def export_var(name, value=None):
+    """Move a variable to the environment (creating it if a value is given)"""
+    if value is None:
+        value = shell_vars.pop(name, None)
+        if value is None:
+            return
+    else:
+        shell_vars.pop(name, None)
+    os.environ[name] = value
+    environ_changed()
+
+
+def param_value(name):
+    """Value of a variable or special parameter, None when unset"""
+    if name[0] not in SPECIAL_PARAMS:
+        return get_var(name)
+    if name == "?":
+        return str(last_status)
+    if name == "$":
+        return str(SHELL_PID)
+    if name == "#":
+        return str(len(positional))
+    if name == "!":
+        return None if last_background is None else str(last_background)
+    if name in ("@", "*"):
+        return " ".join(positional)
+    if name == "0":
+        return script_name
+    index = int(name)
+    return positional[index - 1] if index <= len(positional) else None
+
+
+def param_expand(param, fds, quoted):
+    name = param.name
+    if param.length:
+        if name in ("@", "*"):
+            return str(len(positional))
+        return str(len(param_value(name) or ""))
+    if name == "*" and quoted and param.op is None:
+        # "$*" joins the parameters with the first character of IFS
+        ifs = get_var("IFS")
+        return (DEFAULT_IFS if ifs is None else ifs)[:1].join(positional)
+    value = param_value(name)
+    op = param.op
+    if op is None:
+        return value or ""
+    if op[-1] in "#%":
+        return remove_pattern(value or "", op, param.word, fds)
+    if op[0] == "/":
+        return replace_pattern(value or "", op == "//", *param.word, fds)
+    unset = value is None or op[0] == ":" and not value
+    if op[-1] == "-":
+        return expand_text(param.word, fds) if unset else value
+    if op[-1] == "+":
+        return "" if unset else expand_text(param.word, fds)
+    if op[-1] == "=":
+        if unset:
+            if not is_name(name):
+                raise ExpansionError(f"${name}: cannot assign in this way")
+            value = expand_text(param.word, fds)
+            set_var(name, value)
+        return value
+    if unset:  # ? and :?
+        message = expand_text(param.word, fds) or "parameter null or not set"
+        raise ExpansionError(f"{name}: {message}")
+    return value
+
+
+def remove_pattern(value, op, word, fds):
+    """${name#pattern}, ##, % and %%: strip the shortest or longest
+    matching prefix or suffix"""
+    regex, _ = glob_regex(expand_segments(word, fds))
+    ends = range(len(value) + 1)
+    if op in ("##", "%"):
+        ends = reversed(ends)
+    for end in ends:
+        if op[0] == "#":
+            if regex.fullmatch(value, 0, end):
+                return value[end:]
+        elif regex.fullmatch(value, end):
+            return value[:end]
+    return value
+
+
+def replace_pattern(value, every, pattern, replacement, fds):
+    """${name/pattern/replacement}: replace the longest match of pattern
+    (every match with //). A pattern starting with # or % must match at
+    the start or the end of the value."""
+    segments = expand_segments(pattern, fds)
+    anchor = None
+    if segments and not segments[0][1] and segments[0][0][:1] in ("#", "%"):
+        anchor = segments[0][0][0]
+        segments[0] = (segments[0][0][1:], False)
+    regex, _ = glob_regex(segments)
+    replacement = expand_text(replacement, fds)
+    n = len(value)
+
+    def longest_match(start):
+        for end in range(n, start - 1, -1):
+            if regex.fullmatch(value, start, end):
+                return end
+        return None
+
+    if anchor == "#":
+        end = longest_match(0)
+        return value if end is None else replacement + value[end:]
+    if anchor == "%":
+        start = next((i for i in range(n + 1) if regex.fullmatch(value, i)), None)
+        return value if start is None else value[:start] + replacement
+    out = []
+    i = last = 0
+    while i < n:
+        end = longest_match(i)
+        if end is None or end == i:
+            i += 1
+            continue
+        out.append(value[last:i])
+        out.append(replacement)
+        i = last = end
+        if not every:
+            break
+    out.append(value[last:])
+    return "".join(out)
+
+
+def expansion_value(kind, value, fds):
+    # The text of a param/subst/arith part
+    if kind.endswith("param"):
+        return param_expand(value, fds, kind == "qparam")
+    if kind.endswith("subst"):
+        return command_substitution(value.tree, fds)
+    return str(arith_eval(expand_text(value.parts, fds)))
+
+
+def tilde_prefix(text, segments):
+    # ~ and ~user at the start of a word; the result is never split or globbed
+    head, sep, tail = text.partition("/")
+    home = os.path.expanduser(head)
+    if home == head:
+        return text
+    segments.append((home, True))
+    return sep + tail
+
+
+def expand_segments(parts, fds):
+    """Expand parts into (text, quoted) segments without field splitting"""
+    segments = []
+    for index, (kind, value) in enumerate(parts):
+        if kind == "lit":
+            if index == 0 and value.startswith("~"):
+                value = tilde_prefix(value, segments)
+            segments.append((value, False))
+        elif kind in ("sq", "dq"):
+            segments.append((value, True))
+        else:
+            segments.append((expansion_value(kind, value, fds), kind[0] == "q"))
+    return segments
+
+
+def expand_text(parts, fds=None):
+    """Expand parts into a single string (assignments, here-strings, the
+    word in ${name:-word})"""
+    return "".join(text for text, quoted in expand_segments(parts, fds))
+
+
+def ifs_split(text):
+    """Split the result of an unquoted expansion on IFS. Returns the
+    fields and whether text started and ended with a separator."""
+    ifs = get_var("IFS")
+    if ifs is None:
+        ifs = DEFAULT_IFS
+    if not ifs:
+        return [text], False, False
+    if ifs == DEFAULT_IFS:
+        return text.split(), text[0] in ifs, text[-1] in ifs
+    white = "".join(c for c in ifs if c in DEFAULT_IFS)
+    separator = ifs_separators.get(ifs)
+    if separator is None:
+        import re
+
+        other = "".join(c for c in ifs if c not in DEFAULT_IFS)
+        ws = f"[{re.escape(white)}]*" if white else ""
+        pattern = f"{ws}[{re.escape(other)}]{ws}" if other else ""
+        if white:
+            pattern += f"|[{re.escape(white)}]+" if pattern else f"[{re.escape(white)}]+"
+        separator = ifs_separators[ifs] = re.compile(pattern)
+    stripped = text.strip(white)
+    leading = text[0] in white
+    trailing = text[-1] in ifs
+    fields = separator.split(stripped) if stripped else []
+    if fields and fields[-1] == "" and stripped[-1] not in white:
+        fields.pop()  # A trailing delimiter ends the last field, it adds none
+    return fields, leading, trailing
+
+
+ifs_separators = {}  # IFS -> compiled separator regex
+glob_cache = {}  # Pattern segments -> (regex, has wildcards)
+
+
+def word_fields(word, fds):
+    """Expand a word into fields, each a list of (text, quoted) segments"""
+    fields = []
+    current = []
+    keep = False  # Whether current is a field even if it is empty ("")
+
+    for index, (kind, value) in enumerate(word):
+        if kind == "lit":
+            if index == 0 and value.startswith("~"):
+                value = tilde_prefix(value, current)
+            if value:
+                current.append((value, False))
+        elif kind in ("sq", "dq"):
+            current.append((value, True))
+            keep = True
+        elif kind == "qparam" and value.name == "@" and value.op is None and not value.length:
+            # "$@" is one field per positional parameter
+            for n, arg in enumerate(positional):
+                if n:
+                    fields.append(current)
+                    current = []
+                current.append((arg, True))
+                keep = True
+        elif kind[0] == "q" or kind == "arith":
+            current.append((expansion_value(kind, value, fds), True))
+            keep = True
+        else:
+            text = expansion_value(kind, value, fds)
+            if not text:
+                continue
+            pieces, leading, trailing = ifs_split(text)
+            if leading and (current or keep):
+                fields.append(current)
+                current, keep = [], False
+            for n, piece in enumerate(pieces):
+                if n:
+                    fields.append(current)
+                    current, keep = [], False
+                current.append((piece, False))
+            if trailing and pieces:
+                fields.append(current)
+                current, keep = [], False
+    if current or keep:
+        fields.append(current)
+    return fields
+
+
+def expand_word(word, fds=None):
+    """Yield the fields a word expands to, globbing them lazily"""
+    for segments in word_fields(word, fds):
+        if any(not quoted and has_glob(text) for text, quoted in segments):
+            yield from glob_field(segments)
+        else:
+            yield "".join(text for text, quoted in segments)
+
+
+def expand_words(words, fds=None):
+    for word in words:
+        yield from expand_word(word, fds)
+
+
+def has_glob(text):
+    return "*" in text or "?" in text or "[" in text and "]" in text
+
+
+def glob_regex(segments):
+    """Compile a pattern given as (text, quoted) segments; returns the regex
+    and whether the pattern has any wildcard in it"""
+    key = tuple(segments)
+    compiled = glob_cache.get(key)
+    if compiled is None:
+        if len(glob_cache) >= GLOB_CACHE_SIZE:
+            glob_cache.clear()
+        compiled = glob_cache[key] = compile_glob(segments)
+    return compiled
+
+
+def compile_glob(segments):
+    import re
+
+    out = []
+    wild = False
+    for text, quoted in segments:
+        if quoted:
+            out.append(re.escape(text))
+            continue
+        i = 0
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if c == "*":
+                out.append(".*")
+                wild = True
+            elif c == "?":
+                out.append(".")
+                wild = True
+            elif c == "[":
+                j = i + 1
+                if j < n and text[j] in "!^":
+                    j += 1
+                if j < n and text[j] == "]":
+                    j += 1  # A ] right after [ is part of the set
+                j = text.find("]", j)
+                if j == -1:
+                    out.append(re.escape(c))
+                else:
+                    body = text[i + 1 : j]
+                    negate = body[:1] in ("!", "^")
+                    if negate:
+                        body = body[1:]
+                    body = body.replace("\\", "\\\\").replace("[", "\\[")
+                    if body.startswith("^"):
+                        body = "\\" + body
+                    out.append(f"[{'^' if negate else ''}{body}]")
+                    wild = True
+                    i = j
+            else:
+                out.append(re.escape(c))
+            i += 1
+    return re.compile("".join(out), re.DOTALL), wild
+
+
+def glob_field(segments):
+    """Yield the paths matching a field with unquoted wildcards, or the
+    field itself when nothing matches"""
+    components = [[]]
+    for text, quoted in segments:
+        for n, piece in enumerate(text.split("/")):
+            if n:
+                components.append([])
+            if piece:
+                components[-1].append((piece, quoted))
+    matchers = []  # (literal text, regex or None, matches dot files)
+    for component in components:
+        text = "".join(piece for piece, quoted in component)
+        regex = None
+        if any(not quoted and has_glob(piece) for piece, quoted in component):
+            regex, wild = glob_regex(component)
+            if not wild:
+                regex = None
+        matchers.append((text, regex, text.startswith(".")))
+    literal = "".join(text for text, quoted in segments)
+    if all(regex is None for _, regex, _ in matchers):
+        yield literal
+        return
+
+    matches = glob_walk("", matchers)
+    if get_var("GLOBSORT") != "nosort":
+        matches = sorted(matches)
+    found = False
+    for path in matches:
+        found = True
+        yield path
+    if not found:
+        yield literal
+
+
+def glob_walk(prefix, matchers):
+    """Yield the paths below prefix matching the remaining components"""
+    text, regex, dotted = matchers[0]
+    rest = matchers[1:]
+    if regex is None:
+        path = prefix + text
+        if rest:
+            yield from glob_walk(path + "/", rest)
+        elif os.path.lexists(path):
+            yield path
+        return
+    try:
+        entries = os.scandir(prefix or ".")
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            name = entry.name
+            if name[0] == "." and not dotted or not regex.fullmatch(name):
+                continue
+            if not rest:
+                yield prefix + name
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                yield from glob_walk(prefix + name + "/", rest)
+
+
+def command_substitution(tree, fds):
+    """Run a parsed $(...) in a forked child and return its output with
+    trailing newlines removed. The output is read in chunks as it comes."""
+    global substitution_status
+    fds = fds or {0: 0, 1: 1, 2: 2}
+    read_fd, write_fd = os.pipe()
+    child_fds = {0: fds[0], 1: write_fd, 2: fds[2]}
+    try:
+        pid = fork_child(lambda: execute(tree, child_fds), child_fds.values())
+    finally:
+        os.close(write_fd)
+    chunks = []
+    try:
+        while True:
+            chunk = os.read(read_fd, SCRIPT_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(read_fd)
+        substitution_status = wait_child(pid)
+    return b"".join(chunks).decode(errors="surrogateescape").rstrip("\n")
+
+
+# Arithmetic: $((...)) is compiled into nested closures the first time an
+# expression text is seen, so a loop counter costs a dict lookup and a few
+# calls per iteration.
+
+ARITH_BINARY = {
+    "||": 1, "&&": 2, "|": 3, "^": 4, "&": 5, "==": 6, "!=": 6,
+    "<": 7, "<=": 7, ">": 7, ">=": 7, "<<": 8, ">>": 8,
+    "+": 9, "-": 9, "*": 10, "/": 10, "%": 10, "**": 11,
+}
+ARITH_ASSIGN = ("=", "+=", "-=", "*=", "/=", "%=")
+arith_cache = {}  # Expression text -> compiled closure
+arith_token = None  # Compiled tokenizer regex
+
+
+def arith_divide(a, b):
+    # C semantics: truncate towards zero
+    if b == 0:
+        raise ExpansionError("division by 0")
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+def arith_power(a, b):
+    if b < 0:
+        raise ExpansionError("exponent less than 0")
+    return a**b
+
+
+ARITH_FUNCTIONS = {
+    "|": lambda a, b: a | b,
+    "^": lambda a, b: a ^ b,
+    "&": lambda a, b: a & b,
+    "==": lambda a, b: int(a == b),
+    "!=": lambda a, b: int(a != b),
+    "<": lambda a, b: int(a < b),
+    "<=": lambda a, b: int(a <= b),
+    ">": lambda a, b: int(a > b),
+    ">=": lambda a, b: int(a >= b),
+    "<<": lambda a, b: a << b,
+    ">>": lambda a, b: a >> b,
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": arith_divide,
+    "%": lambda a, b: a - b * arith_divide(a, b),
+    "**": arith_power,
+}
+
+
+def arith_number(text):
+    # 0x1f is hex and a leading 0 means octal, like in C
+    if text[:2] in ("0x", "0X"):
+        return int(text, 16)
+    if len(text) > 1 and text[0] == "0":
+        return int(text, 8)
+    return int(text)
+
+
+def arith_var(name):
+    value = get_var(name)
+    if not value:
+        return 0
+    try:
+        return arith_number(value.strip())
+    except ValueError:
+        return arith_eval(value)  # A variable may hold an expression
+
+
+class ArithParser:
+    """Compile an arithmetic expression into a closure returning its value"""
+
+    def __init__(self, text):
+        global arith_token
+        if arith_token is None:
+            import re
+
+            arith_token = re.compile(
+                r"\s*(?:(0[xX][0-9a-fA-F]+|\d+)|([A-Za-z_]\w*)|"
+                r"(\*\*|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%]=|[-+*/%<>=!~&|^?:(),]))"
+            )
+        self.text = text
+        self.tokens = []  # (kind, text): kind is "num", "name" or "op"
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = arith_token.match(text, pos)
+            if match is None:
+                raise self.error()
+            number, name, op = match.groups()
+            if number is not None:
+                self.tokens.append(("num", number))
+            elif name is not None:
+                self.tokens.append(("name", name))
+            else:
+                self.tokens.append(("op", op))
+            pos = match.end()
+        self.pos = 0
+
+    def error(self):
+        return ExpansionError(f"{self.text.strip()}: syntax error in expression")
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def accept(self, op):
+        if self.peek() == ("op", op):
+            self.pos += 1
+            return True
+        return False
+
+    def compile(self):
+        if not self.tokens:
+            return lambda: 0
+        node = self.assignment()
+        while self.accept(","):
+            # a, b evaluates both and yields b
+            node = (lambda a, b: lambda: (a(), b())[1])(node, self.assignment())
+        if self.pos != len(self.tokens):
+            raise self.error()
+        return node
+
+    def assignment(self):
+        kind, name = self.peek()
+        if kind == "name" and self.peek(1)[0] == "op" and self.peek(1)[1] in ARITH_ASSIGN:
+            op = self.peek(1)[1]
+            self.pos += 2
+            value = self.assignment()
+            combine = ARITH_FUNCTIONS.get(op[:-1])
+
+            def assign():
+                result = value() if combine is None else combine(arith_var(name), value())
+                set_var(name, str(result))
+                return result
+
+            return assign
+        return self.conditional()
+
+    def conditional(self):
+        condition = self.binary(1)
+        if not self.accept("?"):
+            return condition
+        if_true = self.assignment()
+        if not self.accept(":"):
+            raise self.error()
+        if_false = self.conditional()
+        return lambda: if_true() if condition() else if_false()
+
+    def binary(self, min_precedence):
+        left = self.unary()
+        while True:
+            kind, op = self.peek()
+            precedence = ARITH_BINARY.get(op) if kind == "op" else None
+            if precedence is None or precedence < min_precedence:
+                return left
+            self.pos += 1
+            # ** is right associative, everything else left associative
+            right = self.binary(precedence if op == "**" else precedence + 1)
+            if op == "&&":
+                left = (lambda a, b: lambda: int(bool(a() and b())))(left, right)
+            elif op == "||":
+                left = (lambda a, b: lambda: int(bool(a() or b())))(left, right)
+            else:
+                left = (lambda f, a, b: lambda: f(a(), b()))(ARITH_FUNCTIONS[op], left, right)
+
+    def unary(self):
+        kind, op = self.peek()
+        if kind != "op":
+            return self.primary()
+        if op in ("++", "--") and self.peek(1)[0] == "name":
+            name = self.peek(1)[1]
+            self.pos += 2
+            step = 1 if op == "++" else -1
+
+            def increment():
+                value = arith_var(name) + step
+                set_var(name, str(value))
+                return value
+
+            return increment
+        if op in ("!", "~", "-", "+"):
+            self.pos += 1
+            operand = self.unary()
+            if op == "!":
+                return lambda: int(not operand())
+            if op == "~":
+                return lambda: ~operand()
+            if op == "-":
+                return lambda: -operand()
+            return operand
+        return self.primary()
+
+    def primary(self):
+        kind, text = self.peek()
+        self.pos += 1
+        if kind == "num":
+            try:
+                value = arith_number(text)
+            except ValueError:
+                raise ExpansionError(f"{text}: value too great for base")
+            return lambda: value
+        if kind == "name":
+            if self.peek()[0] == "op" and self.peek()[1] in ("++", "--"):
+                step = 1 if self.peek()[1] == "++" else -1
+                self.pos += 1
+
+                def post_increment():
+                    value = arith_var(text)
+                    set_var(text, str(value + step))
+                    return value
+
+                return post_increment
+            return lambda: arith_var(text)
+        if (kind, text) == ("op", "("):
+            inner = self.assignment()
+            if not self.accept(")"):
+                raise self.error()
+            return inner
+        raise self.error()
+
+
+def arith_eval(text):
+    """Evaluate an (already expanded) arithmetic expression"""
+    compiled = arith_cache.get(text)
+    if compiled is None:
+        compiled = ArithParser(text).compile()
+        if len(arith_cache) >= ARITH_CACHE_SIZE:
+            arith_cache.clear()
+        arith_cache[text] = compiled
+    try:
+        return compiled()
+    except RecursionError:
+        raise ExpansionError(f"{text.strip()}: expression recursion level exceeded")
+
+
+# --- Builtins ----------------------------------------------------------------
+#
+# Every builtin is registered once in BUILTINS as handler(args, streams) and
+# writes to the file-like objects in `streams`, so the same code serves the
+# prompt, redirections and pipelines. Handlers return their exit status.
+
+
+class Streams:
+    """The stdin/stdout/stderr a builtin reads from and writes to"""
+
+    def __init__(self, stdin=None, stdout=None, stderr=None):
+        self.stdin = stdin or sys.stdin
+        self.stdout = stdout or sys.stdout
+        self.stderr = stderr or sys.stderr
+
+
+def builtin(name, enabled=True):
+    """Decorator registering a function as the handler for a builtin.
+    A builtin registered with enabled=False only runs after `enable name`."""
+
+    def register(func):
+        BUILTIN_HANDLERS[name] = func
+        if enabled:
+            BUILTINS[name] = func
+        return func
+
+    return register
+
+
+@builtin("exit")
+def builtin_exit(args, streams):
+    try:
+        raise ExitShell(int(args[0]) if args else 0)
+    except ValueError:
+        streams.stderr.write(f"exit: {args[0]}: numeric argument required\n")
+        raise ExitShell(2)
+
+
+@builtin("echo")
+def builtin_echo(args, streams):
+    streams.stdout.write(" ".join(args) + "\n")
+    return 0
+
+
+@builtin("type")
+def builtin_type(args, streams):
+    status = 0
+    for cmd_to_check in args:
+        if cmd_to_check in KEYWORDS:
+            streams.stdout.write(f"{cmd_to_check} is a shell keyword\n")
+        elif cmd_to_check in functions:
+            streams.stdout.write(f"{cmd_to_check} is a function\n")
+        elif cmd_to_check in BUILTINS:
+            streams.stdout.write(f"{cmd_to_check} is a shell builtin\n")
+        else:
+            path = find_in_path(cmd_to_check)
+            if path:
+                streams.stdout.write(f"{cmd_to_check} is {path}\n")
+            else:
+                streams.stderr.write(f"{cmd_to_check}: not found\n")
+                status = 1
+    return status
+
+
+@builtin("pwd")
+def builtin_pwd(args, streams):
+    streams.stdout.write(os.getcwd() + "\n")
+    return 0
+
+
+@builtin("cd")
+def builtin_cd(args, streams):
+    path = args[0] if args else "~"
+
+    # Expand ~ to home directory
+    if path == "~" or path.startswith("~/"):
+        path = os.path.expanduser(path)
+
+    try:
+        os.chdir(path)
+    except FileNotFoundError:
+        streams.stderr.write(f"cd: {path}: No such file or directory\n")
+        return 1
+    except Exception as e:
+        streams.stderr.write(f"cd: {e}\n")
+        return 1
+    return 0
+
+
+@builtin("hash")
+def builtin_hash(args, streams):
+    if args and args[0] == "-r":
+        clear_command_index()
+        return 0
+    if args:
+        status = 0
+        for name in args:
+            full_path = find_in_path(name)
+            if full_path:
+                command_hits.setdefault(full_path, 0)
+            else:
+                streams.stderr.write(f"hash: {name}: not found\n")
+                status = 1
+        return status
+    if not command_hits:
+        streams.stderr.write("hash: hash table empty\n")
+        return 0
+    streams.stdout.write("hits\tcommand\n")
+    for full_path, hits in command_hits.items():
+        streams.stdout.write(f"{hits:>4}\t{full_path}\n")
+    return 0
+
+
+@builtin("history")
+def builtin_history(args, streams):
+    if args and args[0] in ("-r", "-w", "-a", "-n"):
+        history_file = os.path.expanduser(
+            args[1] if len(args) > 1 else "~/.shell_history"
+        )
+        try:
+            if args[0] == "-w":
+                command_history.write_file(history_file)
+            elif args[0] == "-a":
+                # Only append commands added since last write
+                command_history.append_file(history_file)
+            elif args[0] == "-n":
+                # Only the lines appended since the file was last read
+                command_history.merge_file(history_file)
+            else:
+                # Entries already in the history are skipped
+                command_history.read_file(history_file)
+        except FileNotFoundError:
+            streams.stderr.write(f"history: {history_file}: No such file or directory\n")
+            return 1
+        except Exception as e:
+            streams.stderr.write(f"history: {e}\n")
+            return 1
+        return 0
+
+    history_to_show = command_history
+    start_index = 1
+    if args:
+        # Check if argument is a number (limit)
+        try:
+            limit = int(args[0])
+            history_to_show = command_history[-limit:] if limit > 0 else []
+            start_index = len(command_history) - len(history_to_show) + 1
+        except ValueError:
+            pass  # Not a number - show all history
+
+    # Stream entries one by one instead of building the whole listing
+    write = streams.stdout.write
+    for i, hist_cmd in enumerate(history_to_show, start=start_index):
+        write(f"{i:>4}  {hist_cmd}\n")
+    return 0
+
+
+# --- Execution ---------------------------------------------------------------
+#
+# Each pipeline stage gets an fd map {child fd: shell fd} that starts out as
+# the pipe ends (or the shell's own 0/1/2) and is then rewritten by the
+# stage's redirections. Files are opened with os.open() and the raw fds are
+# handed to children, so redirected output never passes through the shell.
+
+
+class RedirectError(Exception):
+    pass
+
+
+HERE_STRING_INLINE_LIMIT = 1 << 16  # Larger here-strings are fed by a thread
+
+# Commands are started with posix_spawn() straight from the path found in the
+# command table; subprocess is only used where posix_spawn is unavailable.
+HAVE_POSIX_SPAWN = hasattr(os, "posix_spawn")
+CHILD_DEFAULT_SIGNALS = (
+    signal.SIGPIPE,
+    signal.SIGXFSZ,
+    signal.SIGINT,
+    signal.SIGQUIT,
+    signal.SIGTSTP,
+    signal.SIGTTIN,
+    signal.SIGTTOU,
+)
+child_env = None  # Encoded copy of os.environ handed to posix_spawn
+shell_options = {"pipefail": False}  # Toggled with set -o / set +o
+
+
+def environ_changed():
+    """Drop what is cached from os.environ after it was modified"""
+    global child_env, trace_path
+    child_env = None
+    trace_path = False
+
+
+def write_all(fd, data):
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    except BrokenPipeError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def here_string_fd(text):
+    """Return the read end of a pipe that yields text plus a newline"""
+    data = (text + "\n").encode(errors="surrogateescape")
+    read_fd, write_fd = os.pipe()
+    if len(data) <= HERE_STRING_INLINE_LIMIT:
+        write_all(write_fd, data)  # Fits in the pipe buffer
+    else:
+        import threading
+
+        threading.Thread(target=write_all, args=(write_fd, data), daemon=True).start()
+    return read_fd
+
+
+def open_redirects(redirects, fds, opened):
+    """Apply redirections in order on top of the fd map `fds`.
+
+    Every fd opened here is appended to `opened` for the caller to close
+    once the command has been started. A closed fd maps to None.
+    """
+    for redirect in redirects:
+        op = redirect.op
+        target = redirect.text
+        if target is None:
+            target = redirect_target(redirect, fds)
+        try:
+            if op in ("<", "<<<"):
+                if op == "<":
+                    fd = os.open(target, os.O_RDONLY)
+                else:
+                    fd = here_string_fd(target)
+                opened.append(fd)
+                fds[redirect.fd] = fd
+            elif op in (">&", "<&") and (target.isdigit() or target == "-"):
+                if target == "-":
+                    fds[redirect.fd] = None
+                    continue
+                source = int(target)
+                if source > 2 and source not in fds or fds.get(source, source) is None:
+                    raise RedirectError(f"{target}: Bad file descriptor")
+                fds[redirect.fd] = fds.get(source, source)
+            elif op == "<&" or op == ">&" and redirect.fd != 1:
+                # Only `>&file` names a file to write stdout and stderr to
+                raise RedirectError(f"{target}: ambiguous redirect")
+            else:
+                flags = os.O_WRONLY | os.O_CREAT
+                flags |= os.O_APPEND if op.endswith(">>") else os.O_TRUNC
+                fd = os.open(target, flags, 0o666)
+                opened.append(fd)
+                if op in ("&>", "&>>", ">&"):
+                    # Both stdout and stderr
+                    fds[1] = fds[2] = fd
+                else:
+                    fds[redirect.fd] = fd
+        except OSError as e:
+            raise RedirectError(f"{target}: {e.strerror}")
+    return fds
+
+
+def redirect_target(redirect, fds):
+    # A here-string is one string; anything else must expand to one field
+    if redirect.op == "<<<":
+        return expand_text(redirect.target, fds)
+    fields = list(expand_word(redirect.target, fds))
+    if len(fields) != 1:
+        raise RedirectError(f"{word_text(redirect.target)}: ambiguous redirect")
+    return fields[0]
+
+
+def streams_for(fds):
+    """Wrap an fd map in Streams for a builtin, reusing sys.std* for the
+    shell's own fds so output ordering with earlier prints is kept."""
+    if fds[0] == 0 and fds[1] == 1 and fds[2] == 2:
+        return Streams()  # The common case, e.g. every builtin in a loop body
+    own = {0: sys.stdin, 1: sys.stdout, 2: sys.stderr}
+    wrapped = []
+    for fd, mode in ((0, "r"), (1, "w"), (2, "w")):
+        source = fds[fd]
+        if source in own and mode == ("r" if source == 0 else "w"):
+            wrapped.append(own[source])
+        elif source is None:
+            wrapped.append(open(os.devnull, mode))
+        else:
+            wrapped.append(open(source, mode, closefd=False))
+    return Streams(*wrapped)
+
+
+def close_streams(streams):
+    for stream in (streams.stdout, streams.stderr):
+        try:
+            stream.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+    for stream in (streams.stdin, streams.stdout, streams.stderr):
+        if stream not in (sys.stdin, sys.stdout, sys.stderr):
+            try:
+                stream.close()
+            except BrokenPipeError:
+                pass
+
+
+def run_builtin(argv, fds):
+    """Run a builtin on an fd map, reporting a closed pipe as SIGPIPE"""
+    streams = streams_for(fds)
+    try:
+        return BUILTINS[argv[0]](argv[1:], streams)
+    except BrokenPipeError:
+        return 141
+    finally:
+        close_streams(streams)
+
+
+# Builtins that change the shell's state (or fork, which a thread must not
+# do), so in a pipeline stage other than the last they run in a child like
+# in a subshell, where the changes are lost as they are in bash
+FORKED_STAGE_BUILTINS = frozenset(
+    ("cd", "export", "unset", "local", "shift", "set", "read", "enable", "parallel")
+)
+
+
+def writes_only(argv):
+    """Whether a builtin can run in a pipeline's writer thread: all it does
+    is write output"""
+    name = argv[0]
+    if name == "hash":
+        return len(argv) == 1  # -r and names change the table
+    if name == "history":
+        return not any(arg.startswith("-") for arg in argv[1:])
+    return name not in FORKED_STAGE_BUILTINS
+
+
+def may_fork(command):
+    """Whether running a stage in the shell may fork(): compound commands,
+    functions, parallel, and words or redirections left to expand, which
+    may hold a $(...)"""
+    if (
+        not isinstance(command, SimpleCommand)
+        or command.argv is None
+        or command.values is None
+        or any(redirect.text is None for redirect in command.redirects)
+    ):
+        return True
+    return bool(command.argv) and command.argv[0] in functions or command.argv[:1] == ["parallel"]
+
+
+def builtin_stage(argv, fds, owned, result, index):
+    # Runs in a writer thread: the builtin's output goes straight into the
+    # pipe, so the next stage consumes it while it is being produced
+    try:
+        result[index] = run_builtin(argv, fds)
+    except (ExitShell, FunctionReturn) as e:
+        result[index] = e.status  # exit in a pipeline only ends that stage
+    except ControlFlow:
+        result[index] = 0
+    finally:
+        for fd in owned:
+            os.close(fd)
+
+
+def child_setup(fds):
+    """preexec_fn wiring fds above 2 and closed fds in the child"""
+    extra = [(fd, source) for fd, source in fds.items() if fd > 2 or source is None]
+    if not extra:
+        return None
+
+    def setup():
+        for fd, source in extra:
+            if source is None:
+                os.close(fd)
+            else:
+                os.dup2(source, fd)
+
+    return setup
+
+
+def spawn_subprocess(argv, full_path, fds, pgid=None, env=None):
+    # Fallback launcher for platforms without os.posix_spawn
+    import subprocess
+
+    std = [fds[fd] if fds[fd] is not None else subprocess.DEVNULL for fd in (0, 1, 2)]
+    return subprocess.Popen(
+        argv,
+        executable=full_path,
+        stdin=std[0],
+        stdout=std[1],
+        stderr=std[2],
+        pass_fds=[s for fd, s in fds.items() if fd > 2 and s is not None],
+        preexec_fn=child_setup(fds),
+        process_group=pgid,
+        env=env,
+    ).pid
+
+
+def spawn_file_actions(fds, parked):
+    """Turn an fd map into posix_spawn file actions.
+
+    Actions run in order in the child, so a source fd that an earlier action
+    may overwrite is first parked on a high close-on-exec duplicate (added to
+    `parked` for the caller to close).
+    """
+    floor = max(10, max(fds) + 1)
+    actions = []
+    for target, source in sorted(fds.items()):
+        if source is None:
+            actions.append((os.POSIX_SPAWN_CLOSE, target))
+            continue
+        if source in fds and fds[source] != source or source == target > 2:
+            # dup2() onto itself would also keep the fd close-on-exec
+            source = fcntl.fcntl(source, fcntl.F_DUPFD_CLOEXEC, floor)
+            parked.append(source)
+        if source != target:
+            actions.append((os.POSIX_SPAWN_DUP2, source, target))
+    return actions
+
+
+def encoded_environ():
+    global child_env
+    if child_env is None:
+        # Encoding os.environ on every spawn costs more than the spawn itself
+        child_env = {os.fsencode(k): os.fsencode(v) for k, v in os.environ.items()}
+    return child_env
+
+
+def command_env(assignments):
+    """The environment of a command run with NAME=value prefixes"""
+    env = dict(encoded_environ())
+    for name, value in assignments:
+        env[os.fsencode(name)] = os.fsencode(value)
+    return env
+
+
+def spawn(argv, full_path, fds, pgid=None, env=None):
+    """Start argv from its already resolved path with the given fd map and
+    return the pid. Reaping is left to the caller (see wait_child).
+
+    With pgid set the child joins that process group (0 starts a new one).
+    env replaces the (encoded) environment.
+    """
+    if not HAVE_POSIX_SPAWN:
+        return spawn_subprocess(argv, full_path, fds, pgid, env)
+    parked = []
+    extra = {} if pgid is None else {"setpgroup": pgid}
+    try:
+        return os.posix_spawn(
+            full_path,
+            argv,
+            encoded_environ() if env is None else env,
+            file_actions=spawn_file_actions(fds, parked),
+            # Python ignores these, children expect the default disposition
+            setsigdef=CHILD_DEFAULT_SIGNALS,
+            **extra,
+        )
+    finally:
+        for fd in parked:
+            os.close(fd)
+
+
+def exec_command(argv, full_path, fds, env=None):
+    """Replace the process with argv, the fd map applied the way spawn()
+    would. Only returns by raising OSError."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for action in spawn_file_actions(fds, []):
+        if action[0] == os.POSIX_SPAWN_CLOSE:
+            os.close(action[1])
+        else:
+            os.dup2(action[1], action[2])
+    for sig in CHILD_DEFAULT_SIGNALS:
+        signal.signal(sig, signal.SIG_DFL)
+    os.execve(full_path, argv, encoded_environ() if env is None else env)
+
+
+def close_fds_except(keep):
+    # Listing /dev/fd is much cheaper than closing every possible fd
+    try:
+        open_fds = [int(name) for name in os.listdir("/dev/fd")]
+    except OSError:
+        open_fds = range(3, 256)
+    for fd in open_fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def fork_child(run, keep=(), pgid=None):
+    """Fork a child that runs shell code and exits with the status run()
+    returns. Used for subshells, command substitutions and compound
+    commands or functions in the middle of a pipeline.
+
+    The child closes every fd other than 0-2 and those in keep, so it
+    doesn't hold on to pipe ends that other stages wait to see closed.
+    With pgid set the child joins that process group (0 starts a new one).
+    """
+    global interactive, job_control
+    sys.stdout.flush()
+    sys.stderr.flush()
+    keep = {fd for fd in keep if fd is not None}
+    if trace_file is not None:
+        keep.add(trace_file[1].fileno())
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            if pgid is not None:
+                os.setpgid(0, pgid)
+            jobs.clear()
+            interactive = job_control = False
+            for sig in (
+                signal.SIGCHLD,
+                signal.SIGINT,
+                signal.SIGQUIT,
+                signal.SIGTSTP,
+                signal.SIGTTIN,
+                signal.SIGTTOU,
+            ):
+                signal.signal(sig, signal.SIG_DFL)
+            close_fds_except(keep)
+            status = run()
+        except (ExitShell, FunctionReturn) as e:
+            status = e.status
+        except ControlFlow:
+            status = 0
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+    if pgid is not None:
+        try:
+            os.setpgid(pid, pgid or pid)  # Also done by the child
+        except OSError:
+            pass
+    return pid
+
+
+def exit_status(status):
+    """Convert a raw wait status to the shell's $? convention"""
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.waitstatus_to_exitcode(status)
+
+
+def report_error(fds, message):
+    """Write the shell's own error about a stage to that stage's stderr"""
+    fd = fds.get(2)
+    if fd == 2:
+        sys.stderr.write(message)
+    elif fd is not None:
+        try:
+            os.write(fd, message.encode(errors="surrogateescape"))
+        except OSError:
+            pass
+
+
+def wait_child(pid, usage=None):
+    """Reap a child and return its status the way shells report it.
+    The child's resource usage is stored in usage[pid] if usage is given."""
+    _, status, rusage = os.wait4(pid, 0)
+    if usage is not None:
+        usage[pid] = rusage
+    return exit_status(status)
+
+
+def run_pipeline(pipeline, base_fds=None, trace=None, replace=False):
+    """Run the commands of a pipeline and return the status of every stage.
+
+    Stages are connected with os.pipe(). External stages get their fd map
+    passed straight to the child; builtin stages other than the last run in
+    a writer thread that feeds the next stage through the pipe, and other
+    compound commands and functions there run in a forked child. The last
+    stage always runs in the shell itself, so `... | while read x` can set
+    variables. base_fds replaces the shell's own 0/1/2 as the pipeline's
+    outer fds. Phase timings and children's resource usage go to trace, if
+    given. With replace set, a pipeline of one external command execs it
+    instead, for a forked child with nothing left to do afterwards.
+
+    Writer threads are only started once every other stage is set up, so a
+    builtin never fills a pipe nobody reads yet; from then on the pipe
+    itself is the backpressure. Every fd the shell opens is closed on all
+    paths, including a failed stage setup or ^C.
+    """
+    global substitution_status
+    trace = trace or NULL_TRACE
+    # Buffered builtin output must reach the fd before the children's
+    sys.stdout.flush()
+    commands = pipeline.commands
+    statuses = [0] * len(commands)
+    names = [None] * len(commands)  # argv[0] of each stage
+    processes = []  # (stage index, pid)
+    usage = {}  # pid -> rusage of the reaped children
+    # With job control the stages share a new process group that owns the
+    # terminal while they run, so ^C and ^Z reach them and not the shell.
+    # Pipelines run by other threads (parallel workers) never take it.
+    use_job_control = job_control and on_main_thread()
+    pgid = 0 if use_job_control else None
+    outer = base_fds or {0: 0, 1: 1, 2: 2}
+    threads = []  # Builtin writer threads, started with the last stage
+    producers = []  # (thread, fds it closes) of threads not started yet
+    prev_read = None  # Read end of the pipe feeding the current stage
+
+    try:
+        for i, command in enumerate(commands):
+            is_last = i == len(commands) - 1
+            if is_last:
+                for thread, _ in producers:
+                    thread.start()
+                producers = []
+            read_fd = write_fd = None
+            if not is_last:
+                read_fd, write_fd = os.pipe()
+            fds = {
+                0: prev_read if prev_read is not None else outer[0],
+                1: write_fd if write_fd is not None else outer[1],
+                2: outer[2],
+            }
+            owned = [fd for fd in (prev_read, write_fd) if fd is not None]
+            prev_read = read_fd
+
+            argv = None
+            try:
+                t = trace.clock()
+                simple = isinstance(command, SimpleCommand)
+                if simple:
+                    substitution_status = 0
+                    argv = command.argv
+                    if argv is None:
+                        argv = list(expand_words(command.words, fds))
+                    assignments = command.values
+                    if assignments is None:
+                        assignments = [
+                            (name, expand_text(value, fds)) for name, value in command.assignments
+                        ]
+                    names[i] = argv[0] if argv else None
+                    t = trace.phase("expand", t)
+                else:
+                    names[i] = "subshell"
+                open_redirects(command.redirects, fds, owned)
+                t = trace.phase("redirect", t)
+                if not simple:
+                    if is_last:
+                        statuses[i] = run_compound(command, fds)
+                    else:
+                        pid = fork_child(
+                            lambda command=command, fds=fds: run_compound(command, fds),
+                            fds.values(),
+                            pgid,
+                        )
+                        processes.append((i, pid))
+                        if pgid == 0:
+                            pgid = pid
+                            give_terminal_to(pgid)
+                elif not argv:
+                    # Only assignments and redirections: files are created
+                    # and variables set (in the last stage), nothing runs
+                    if is_last:
+                        for name, value in assignments:
+                            set_var(name, value)
+                        statuses[i] = substitution_status
+                elif argv[0] in functions or argv[0] in BUILTINS and runs_in_process(argv):
+                    if is_last:
+                        statuses[i] = run_in_shell(argv, assignments, fds)
+                        trace.phase("builtin", t)
+                    elif (
+                        assignments
+                        or argv[0] in functions
+                        or not writes_only(argv)
+                        # Forks while the thread runs would copy a process
+                        # that has more than one thread
+                        or may_fork(commands[-1])
+                    ):
+                        pid = fork_child(
+                            lambda argv=argv, assignments=assignments, fds=fds: run_in_shell(
+                                argv, assignments, fds
+                            ),
+                            fds.values(),
+                            pgid,
+                        )
+                        processes.append((i, pid))
+                        if pgid == 0:
+                            pgid = pid
+                            give_terminal_to(pgid)
+                    else:
+                        import threading
+
+                        thread = threading.Thread(
+                            target=builtin_stage,
+                            args=(argv, fds, owned, statuses, i),
+                            daemon=True,
+                        )
+                        threads.append(thread)
+                        producers.append((thread, owned))
+                        owned = []  # Closed by the thread when it's done
+                else:
+                    full_path = find_in_path(argv[0], remember=True)
+                    t = trace.phase("lookup", t)
+                    if full_path is None:
+                        report_error(fds, f"{argv[0]}: command not found\n")
+                        statuses[i] = 127
+                    else:
+                        # Create process, resolved through the command table
+                        env = command_env(assignments) if assignments else None
+                        if replace and len(commands) == 1:
+                            exec_command(argv, full_path, fds, env)
+                        pid = spawn(argv, full_path, fds, pgid, env)
+                        trace.phase("spawn", t)
+                        processes.append((i, pid))
+                        if pgid == 0:
+                            pgid = pid
+                            give_terminal_to(pgid)
+            except (RedirectError, ExpansionError) as e:
+                report_error(fds, f"shell: {e}\n")
+                statuses[i] = 1
+            except OSError as e:
+                report_error(fds, f"shell: {argv[0] if argv else ''}: {e.strerror}\n")
+                statuses[i] = 126
+            finally:
+                # The child (or thread) holds its own copies of these now
+                for fd in owned:
+                    os.close(fd)
+
+    except OSError as e:
+        sys.stderr.write(f"Error in pipeline: {e}\n")
+        statuses[-1] = 126
+    finally:
+        # Setup stopped early: close what no stage took over
+        if prev_read is not None:
+            os.close(prev_read)
+        for thread, owned in producers:
+            threads.remove(thread)
+            for fd in owned:
+                os.close(fd)
+        # Wait for all stages to complete
+        t = trace.clock()
+        if use_job_control and processes:
+            job = Job(pgid, [pid for i, pid in processes], pipeline.text)
+            usage = job.usage
+            wait_job(job)
+            give_terminal_to(shell_pgid)
+            if job.state == "Stopped":
+                # ^Z: keep it in the job table and return to the prompt
+                add_job(job)
+                job.reported = job.state
+                print()
+                print(job.describe())
+                return [128 + signal.SIGTSTP] * len(commands)
+            for i, pid in processes:
+                statuses[i] = job.pids[pid]
+            if statuses[-1] == 128 + signal.SIGINT:
+                print()  # Keep the next prompt off the ^C line
+        else:
+            for i, pid in processes:
+                statuses[i] = wait_child(pid, usage)
+        for thread in threads:
+            thread.join()
+        trace.phase("wait", t)
+        for i, pid in processes:
+            trace.child(names[i], pid, statuses[i], usage.get(pid))
+
+    return statuses
+
+
+def execute(tree, fds=None):
+    """Execute a parsed CommandList and return the last exit status.
+
+    fds optionally maps 0/1/2 to other fds, e.g. to capture the output.
+    """
+    status = 0
+    for and_or, background in tree.items:
+        if background:
+            status = run_background(and_or, fds)
+        else:
+            status = execute_and_or(and_or, fds)
+    return status
+
+
+def execute_and_or(and_or, fds=None, replace=False):
+    """Run an and/or list. With replace set, its last pipeline may exec
+    its command (see run_pipeline)."""
+    first, last = and_or.pipelines[0], and_or.pipelines[-1]
+    status = execute_pipeline(first, fds, replace and first is last)
+    for op, pipeline in zip(and_or.ops, and_or.pipelines[1:]):
+        if (op == "&&") == (status == 0):
+            status = execute_pipeline(pipeline, fds, replace and pipeline is last)
+    return status
+
+
+def execute_pipeline(pipeline, fds=None, replace=False):
+    global last_status
+    start = time.perf_counter()
+    trace = None
+    tracefile = trace_path if trace_path is not False else traced_file()
+    if pipeline.timed or tracefile:
+        trace = CommandTrace()
+    # Exec'ing would skip what's left to do here after the command
+    replace = replace and not pipeline.negated and trace is None
+    statuses = run_pipeline(pipeline, fds, trace, replace) if pipeline.commands else [0]
+    status = statuses[-1]
+    if shell_options["pipefail"]:
+        # The last stage that failed decides
+        status = next((s for s in reversed(statuses) if s), 0)
+    set_var("PIPESTATUS", " ".join(map(str, statuses)))
+    if pipeline.negated:
+        status = 0 if status else 1
+    record_command(pipeline.text, time.perf_counter() - start)
+    if trace is not None:
+        trace.finish()
+        if pipeline.timed:
+            report_time(trace, pipeline.timed, fds)
+        if tracefile:
+            write_trace(tracefile, trace.record(pipeline.text, status))
+    last_status = status
+    return status
+
+
+# --- Control flow ------------------------------------------------------------
+#
+# Compound commands run straight from their AST, so a loop body is parsed
+# once however many times it runs. break, continue and return unwind with
+# exceptions; functions get their own positional parameters and a frame of
+# the variables made `local`.
+
+loop_depth = 0  # Loops currently running, for break and continue
+
+
+class ControlFlow(Exception):
+    pass
+
+
+class LoopControl(ControlFlow):
+    def __init__(self, kind, levels):
+        super().__init__(kind)
+        self.kind = kind  # "break" or "continue"
+        self.levels = levels
+
+
+class FunctionReturn(ControlFlow):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def on_main_thread():
+    import threading
+
+    return threading.current_thread() is threading.main_thread()
+
+
+def check_interrupt(status):
+    # A loop whose command was killed by ^C stops as well, like in bash
+    if interactive and status == 128 + signal.SIGINT:
+        raise KeyboardInterrupt("reported")
+
+
+def run_compound(command, fds):
+    """Run a compound command in the shell and return its status"""
+    if isinstance(command, If):
+        for condition, body in command.clauses:
+            if execute(condition, fds) == 0:
+                return execute(body, fds)
+        return execute(command.else_body, fds) if command.else_body else 0
+    if isinstance(command, (For, While)):
+        return run_loop(command, fds)
+    if isinstance(command, Group):
+        return execute(command.body, fds)
+    if isinstance(command, Subshell):
+        return wait_child(
+            fork_child(lambda: execute(command.body, fds), fds.values() if fds else ())
+        )
+    functions[command.name] = command.body  # FunctionDef
+    return 0
+
+
+def run_loop(loop, fds):
+    global loop_depth
+    status = 0
+    if isinstance(loop, For):
+        items = loop.items
+        if items is None:
+            items = expand_words(loop.words, fds) if loop.words is not None else list(positional)
+        items = iter(items)
+    loop_depth += 1
+    try:
+        while True:
+            try:
+                if isinstance(loop, For):
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    set_var(loop.name, item)
+                else:
+                    condition = execute(loop.condition, fds)
+                    check_interrupt(condition)
+                    if (condition == 0) == loop.until:
+                        break
+                status = execute(loop.body, fds)
+            except LoopControl as e:
+                if e.levels > 1:
+                    e.levels -= 1
+                    raise
+                status = 0
+                if e.kind == "break":
+                    break
+            check_interrupt(status)
+    finally:
+        loop_depth -= 1
+    return status
+
+
+def call_function(body, argv, fds):
+    """Run a function body with argv[1:] as the positional parameters"""
+    global positional
+    saved = positional
+    positional = argv[1:]
+    local_frames.append({})
+    opened = []
+    try:
+        if body.redirects:
+            fds = open_redirects(body.redirects, dict(fds or {0: 0, 1: 1, 2: 2}), opened)
+        return run_compound(body, fds)
+    except FunctionReturn as e:
+        return e.status
+    finally:
+        for fd in opened:
+            os.close(fd)
+        positional = saved
+        for name, value in local_frames.pop().items():
+            if value is None:
+                unset_var(name)
+            else:
+                set_var(name, value)
+
+
+def run_in_shell(argv, assignments, fds):
+    """Run a function or builtin in the shell itself. NAME=value prefixes
+    only hold while it runs."""
+    saved = [(name, get_var(name)) for name, _ in assignments]
+    for name, value in assignments:
+        set_var(name, value)
+    try:
+        body = functions.get(argv[0])
+        if body is not None:
+            return call_function(body, argv, fds)
+        return run_builtin(argv, fds)
+    finally:
+        for name, value in reversed(saved):
+            if value is None:
+                unset_var(name)
+            else:
+                set_var(name, value)
+
+
+@builtin(":")
+def builtin_colon(args, streams):
+    return 0
+
+
+def loop_control(kind, args, streams):
+    if not loop_depth:
+        streams.stderr.write(f"{kind}: only meaningful in a `for', `while', or `until' loop\n")
+        return 0
+    try:
+        levels = int(args[0]) if args else 1
+    except ValueError:
+        streams.stderr.write(f"{kind}: {args[0]}: numeric argument required\n")
+        return 1
+    if levels < 1:
+        streams.stderr.write(f"{kind}: {levels}: loop count out of range\n")
+        return 1
+    raise LoopControl(kind, min(levels, loop_depth))
+
+
+@builtin("break")
+def builtin_break(args, streams):
+    return loop_control("break", args, streams)
+
+
+@builtin("continue")
+def builtin_continue(args, streams):
+    return loop_control("continue", args, streams)
+
+
+@builtin("return")
+def builtin_return(args, streams):
+    if not local_frames:
+        streams.stderr.write("return: can only `return' from a function\n")
+        return 1
+    try:
+        raise FunctionReturn(int(args[0]) & 0xFF if args else last_status)
+    except ValueError:
+        streams.stderr.write(f"return: {args[0]}: numeric argument required\n")
+        raise FunctionReturn(2)
+
+
+def split_assignment(arg, name, streams):
+    """NAME[=value] argument of export/local: (name, value or None), or
+    None after reporting an invalid name"""
+    var, eq, value = arg.partition("=")
+    if not is_name(var):
+        streams.stderr.write(f"{name}: `{arg}': not a valid identifier\n")
+        return None
+    return var, value if eq else None
+
+
+@builtin("export")
+def builtin_export(args, streams):
+    unexport = args[:1] == ["-n"]
+    if args[:1] in (["-n"], ["-p"]):
+        args = args[1:]
+    if not args:
+        for name in sorted(os.environ):
+            streams.stdout.write(f"export {name}={shell_quote(os.environ[name])}\n")
+        return 0
+    status = 0
+    for arg in args:
+        assignment = split_assignment(arg, "export", streams)
+        if assignment is None:
+            status = 1
+        elif unexport:
+            name, value = assignment
+            value = os.environ.get(name) if value is None else value
+            unset_var(name)
+            if value is not None:
+                shell_vars[name] = value
+        else:
+            export_var(*assignment)
+    return status
+
+
+@builtin("unset")
+def builtin_unset(args, streams):
+    function = args[:1] == ["-f"]
+    if args[:1] in (["-f"], ["-v"]):
+        args = args[1:]
+    for name in args:
+        if function:
+            functions.pop(name, None)
+        else:
+            unset_var(name)
+    return 0
+
+
+@builtin("local")
+def builtin_local(args, streams):
+    if not local_frames:
+        streams.stderr.write("local: can only be used in a function\n")
+        return 1
+    frame = local_frames[-1]
+    status = 0
+    for arg in args:
+        assignment = split_assignment(arg, "local", streams)
+        if assignment is None:
+            status = 1
+            continue
+        name, value = assignment
+        if name not in frame:
+            frame[name] = get_var(name)  # Put back when the function returns
+        if value is None:
+            unset_var(name)
+        else:
+            set_var(name, value)
+    return status
+
+
+@builtin("shift")
+def builtin_shift(args, streams):
+    global positional
+    try:
+        count = int(args[0]) if args else 1
+    except ValueError:
+        streams.stderr.write(f"shift: {args[0]}: numeric argument required\n")
+        return 1
+    if count < 0 or count > len(positional):
+        return 1
+    positional = positional[count:]
+    return 0
+
+
+@builtin("set")
+def builtin_set(args, streams):
+    global positional
+    if not args:
+        for name in sorted(shell_vars.keys() | os.environ.keys()):
+            streams.stdout.write(f"{name}={shell_quote(get_var(name))}\n")
+        return 0
+    args = list(args)
+    while args and args[0] in ("-o", "+o"):
+        enable = args.pop(0) == "-o"
+        if not args:
+            for name in sorted(shell_options):
+                state = "on" if shell_options[name] else "off"
+                streams.stdout.write(f"{name:<15}\t{state}\n")
+            return 0
+        name = args.pop(0)
+        if name not in shell_options:
+            streams.stderr.write(f"set: {name}: invalid option name\n")
+            return 2
+        shell_options[name] = enable
+    if args[:1] == ["--"]:
+        positional = args[1:]
+    elif args:
+        if args[0].startswith(("-", "+")):
+            streams.stderr.write(f"set: {args[0]}: invalid option\n")
+            return 2
+        positional = args
+    return 0
+
+
+READ_CHUNK_SIZE = 4096
+
+
+def read_line(fd):
+    """Read one line from fd without consuming anything after it: regular
+    files are read in chunks and the offset is put back after the newline,
+    anything else is read a byte at a time. Returns (bytes, found newline)."""
+    line = bytearray()
+    try:
+        regular = stat.S_ISREG(os.fstat(fd).st_mode)
+    except OSError:
+        regular = False
+    while True:
+        chunk = os.read(fd, READ_CHUNK_SIZE if regular else 1)
+        if not chunk:
+            return bytes(line), False
+        end = chunk.find(b"\n")
+        if end == -1:
+            line += chunk
+            continue
+        line += chunk[:end]
+        if end + 1 < len(chunk):
+            os.lseek(fd, end + 1 - len(chunk), os.SEEK_CUR)
+        return bytes(line), True
+
+
+@builtin("read")
+def builtin_read(args, streams):
+    raw = False
+    names = list(args)
+    while names and names[0].startswith("-"):
+        option = names.pop(0)
+        if option == "-r":
+            raw = True
+        elif option == "--":
+            break
+        else:
+            streams.stderr.write(f"read: {option}: invalid option\n")
+            streams.stderr.write("read: usage: read [-r] [name ...]\n")
+            return 2
+    for name in names:
+        if not is_name(name):
+            streams.stderr.write(f"read: `{name}': not a valid identifier\n")
+            return 1
+
+    fd = streams.stdin.fileno()
+    text = ""
+    while True:
+        data, found = read_line(fd)
+        chunk = data.decode(errors="surrogateescape")
+        if not raw and chunk.endswith("\\") and not chunk.endswith("\\\\") and found:
+            text += chunk[:-1]  # Backslash-newline continues the line
+            continue
+        text += chunk
+        break
+    if not raw:
+        # Without -r a backslash quotes the next character
+        out = []
+        escaped = False
+        for c in text:
+            if escaped or c != "\\":
+                out.append(c)
+                escaped = False
+            else:
+                escaped = True
+        text = "".join(out)
+
+    if not names:
+        set_var("REPLY", text)
+    else:
+        ifs = get_var("IFS")
+        ifs = DEFAULT_IFS if ifs is None else ifs
+        white = "".join(c for c in ifs if c in DEFAULT_IFS)
+        rest = text.strip(white)
+        for name in names[:-1]:
+            end = next((k for k, c in enumerate(rest) if c in ifs), len(rest))
+            set_var(name, rest[:end])
+            rest = rest[end:].lstrip(white)
+            if rest[:1] and rest[0] in ifs:
+                rest = rest[1:].lstrip(white)  # One non-blank separator
+        set_var(names[-1], rest)
+    return 0 if found else 1
+
+
+# --- Profiling ---------------------------------------------------------------
+#
+# Every pipeline's wall time is added to a per-command table for `stats`.
+# Pipelines run under the `time` keyword, or all of them while TRACEFILE is
+# set, also get a CommandTrace: time per phase (parse, expansion,
+# redirections, PATH lookup, spawn, builtin, wait), the rusage of each child
+# from os.wait4 and the PATH lookups that hit the cache. TRACEFILE receives
+# one JSON record per pipeline.
+#
+# A child's ru_maxrss counts the shell's own pages from before the exec, so
+# it is only a peak of the command when it exceeds the shell's high-water
+# mark; otherwise the record has null for it.
+
+TRACE_PHASES = ("parse", "expand", "redirect", "lookup", "spawn", "builtin", "wait")
+COMMAND_STATS_LIMIT = 10000  # Distinct command lines kept for `stats`
+
+command_stats = {}  # pipeline text -> [runs, total seconds, max seconds]
+trace_path = False  # Cached TRACEFILE (None if unset), False until looked up
+trace_file = None  # (path, file) the trace records are appended to
+
+
+def traced_file():
+    # A missing key costs microseconds in os.environ, so it is looked up
+    # once and then again after environ_changed()
+    global trace_path
+    trace_path = get_var("TRACEFILE")
+    return trace_path
+
+
+class NullTrace:
+    """Stands in for a CommandTrace when nothing is being measured"""
+
+    def clock(self):
+        return None
+
+    def phase(self, name, since):
+        return None
+
+    def child(self, name, pid, status, rusage):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class CommandTrace(NullTrace):
+    """Where the time of one pipeline went"""
+
+    def __init__(self):
+        global last_parse_time
+        self.phases = dict.fromkeys(TRACE_PHASES, 0.0)
+        # The line was parsed just before its first pipeline runs
+        self.phases["parse"] = last_parse_time
+        last_parse_time = 0.0
+        self.children = []  # (argv[0], pid, status, rusage or None)
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.times = os.times()
+        self.lookups = dict(path_lookups)
+        self.real = self.user = self.sys = 0.0
+
+    def clock(self):
+        return time.perf_counter()
+
+    def phase(self, name, since):
+        """Add the time since `since` to a phase; returns the current time"""
+        now = time.perf_counter()
+        self.phases[name] += now - since
+        return now
+
+    def child(self, name, pid, status, rusage):
+        self.children.append((name, pid, status, rusage))
+
+    def finish(self):
+        # CPU time is the shell's own (builtins) plus that of the children
+        self.real = time.perf_counter() - self.start
+        times = os.times()
+        usages = [rusage for _, _, _, rusage in self.children if rusage]
+        self.user = times.user - self.times.user + sum(u.ru_utime for u in usages)
+        self.sys = times.system - self.times.system + sum(u.ru_stime for u in usages)
+
+    def record(self, text, status):
+        import resource
+
+        shell_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = [
+            {
+                "command": name,
+                "pid": pid,
+                "status": child_status,
+                "user": rusage.ru_utime if rusage else None,
+                "sys": rusage.ru_stime if rusage else None,
+                # Not above the shell's own: the pre-exec shell's, not its peak
+                "max_rss_kb": (
+                    rusage.ru_maxrss if rusage and rusage.ru_maxrss > shell_rss else None
+                ),
+            }
+            for name, pid, child_status, rusage in self.children
+        ]
+        rss = [child["max_rss_kb"] for child in children if child["max_rss_kb"]]
+        return {
+            "start": self.started_at,
+            "command": text,
+            "status": status,
+            "real": self.real,
+            "user": self.user,
+            "sys": self.sys,
+            "phases": self.phases,
+            "children": children,
+            "max_rss_kb": max(rss, default=None),
+            "path_hits": path_lookups["hits"] - self.lookups["hits"],
+            "path_misses": path_lookups["misses"] - self.lookups["misses"],
+        }
+
+
+def format_minutes(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes)}m{seconds:.3f}s"
+
+
+def report_time(trace, timed, fds=None):
+    """Print the `time` keyword's report on the shell's stderr"""
+    if timed == "time -p":
+        text = f"real {trace.real:.2f}\nuser {trace.user:.2f}\nsys {trace.sys:.2f}\n"
+    else:
+        text = (
+            f"\nreal\t{format_minutes(trace.real)}\n"
+            f"user\t{format_minutes(trace.user)}\n"
+            f"sys\t{format_minutes(trace.sys)}\n"
+        )
+    if fds is None:
+        sys.stderr.write(text)
+        sys.stderr.flush()
+    elif fds[2] is not None:
+        write_all(os.dup(fds[2]), text.encode())
+
+
+def write_trace(path, record):
+    """Append one JSON record to the trace file"""
+    global trace_file
+    import json
+
+    path = os.path.expanduser(path)
+    try:
+        if trace_file is None or trace_file[0] != path:
+            if trace_file is not None:
+                trace_file[1].close()
+            trace_file = None
+            trace_file = (path, open(path, "a"))
+        trace_file[1].write(json.dumps(record) + "\n")
+        trace_file[1].flush()
+    except OSError as e:
+        sys.stderr.write(f"shell: {path}: {e.strerror}\n")
+
+
+def record_command(text, seconds):
+    entry = command_stats.get(text)
+    if entry is None:
+        if len(command_stats) >= COMMAND_STATS_LIMIT:
+            # Keep the costlier half, so long sessions remember what matters
+            keep = heapq.nlargest(
+                COMMAND_STATS_LIMIT // 2, command_stats.items(), key=lambda item: item[1][1]
+            )
+            command_stats.clear()
+            command_stats.update(keep)
+        entry = command_stats[text] = [0, 0.0, 0.0]
+    entry[0] += 1
+    entry[1] += seconds
+    if seconds > entry[2]:
+        entry[2] = seconds
+
+
+@builtin("stats")
+def builtin_stats(args, streams):
+    limit = 10
+    sort_key = 1  # Total time; -m sorts by the slowest single run
+    args = list(args)
+    while args:
+        option = args.pop(0)
+        if option == "-r":
+            command_stats.clear()
+            return 0
+        if option == "-m":
+            sort_key = 2
+        elif option == "-n" and args and args[0].isdigit():
+            limit = int(args.pop(0))
+        else:
+            streams.stderr.write("stats: usage: stats [-m] [-n count] | -r\n")
+            return 2
+
+    slowest = heapq.nlargest(limit, command_stats.items(), key=lambda item: item[1][sort_key])
+    write = streams.stdout.write
+    write(f"{'runs':>6}  {'total ms':>10}  {'mean ms':>10}  {'max ms':>10}  command\n")
+    for text, (runs, total, longest) in slowest:
+        write(
+            f"{runs:>6}  {total * 1000:>10.2f}  {total / runs * 1000:>10.2f}"
+            f"  {longest * 1000:>10.2f}  {text}\n"
+        )
+    return 0
+
+
+# --- Jobs --------------------------------------------------------------------
+#
+# `cmd &` runs the and/or list in a forked subshell that leads its own process
+# group, and which execs the list's last command when that is an external
+# one, so $! is the command's own pid and `kill $!` reaches it. A lone
+# external command with nothing to expand is spawned directly instead, which
+# also saves the fork of the shell. Background children are reaped by a
+# SIGCHLD handler, which only ever waits for pids that belong to a job, so
+# foreground waits are not disturbed. State changes are reported just before
+# the next prompt.
+
+jobs = {}  # job number -> Job
+interactive = False
+job_control = False  # Foreground pipelines get their own group and the tty
+shell_pgid = None
+terminal_fd = None
+
+
+class Job:
+    def __init__(self, pgid, pids, text):
+        self.number = None  # Assigned by add_job
+        self.pgid = pgid
+        self.pids = dict.fromkeys(pids)  # pid -> exit status once reaped
+        self.text = text
+        self.state = "Running"  # Running, Stopped or Done
+        self.reported = "Running"  # Last state shown to the user
+        self.usage = {}  # pid -> rusage, for the pids reaped by wait_job
+
+    def status(self):
+        # Like a pipeline, a job's status is the status of its last process
+        return list(self.pids.values())[-1] or 0
+
+    def update(self, pid, raw):
+        """Record a raw wait status reported for one of the job's pids"""
+        if os.WIFSTOPPED(raw):
+            self.state = "Stopped"
+        elif os.WIFCONTINUED(raw):
+            self.state = "Running"
+        else:
+            self.pids[pid] = exit_status(raw)
+            if None not in self.pids.values():
+                self.state = "Done"
+
+    def describe(self):
+        if self.state == "Done" and self.status() > 128:
+            state = signal.strsignal(self.status() - 128) or f"Exit {self.status()}"
+        elif self.state == "Done" and self.status():
+            state = f"Exit {self.status()}"
+        else:
+            state = self.state
+        suffix = " &" if self.state == "Running" else ""
+        return f"[{self.number}]{job_mark(self)}  {state:<24}{self.text}{suffix}"
+
+
+def job_mark(job):
+    # "+" marks the current (most recent) job, "-" the previous one
+    numbers = sorted(jobs)
+    if numbers and job.number == numbers[-1]:
+        return "+"
+    if len(numbers) > 1 and job.number == numbers[-2]:
+        return "-"
+    return " "
+
+
+def add_job(job):
+    job.number = max(jobs, default=0) + 1
+    jobs[job.number] = job
+    return job
+
+
+def reap_jobs(signum=None, frame=None):
+    """SIGCHLD handler: collect state changes of background jobs"""
+    for job in list(jobs.values()):
+        for pid, status in job.pids.items():
+            if status is not None:
+                continue
+            try:
+                reaped, raw = os.waitpid(
+                    pid, os.WNOHANG | os.WUNTRACED | os.WCONTINUED
+                )
+            except ChildProcessError:
+                job.pids[pid] = 0  # Already reaped elsewhere
+                continue
+            if reaped:
+                job.update(pid, raw)
+        if None not in job.pids.values():
+            job.state = "Done"
+
+
+def wait_job(job):
+    """Block until every process of the job has exited or the job stopped"""
+    for pid in job.pids:
+        while job.pids[pid] is None and job.state != "Stopped":
+            try:
+                _, raw, job.usage[pid] = os.wait4(pid, os.WUNTRACED)
+            except ChildProcessError:
+                break  # The SIGCHLD handler got there first
+            job.update(pid, raw)
+    return job.status()
+
+
+def notify_jobs():
+    """Report jobs that changed state since the last prompt"""
+    for number, job in list(jobs.items()):
+        if job.state != job.reported:
+            print(job.describe())
+            job.reported = job.state
+        if job.state == "Done":
+            del jobs[number]
+
+
+def give_terminal_to(pgid):
+    if job_control:
+        try:
+            os.tcsetpgrp(terminal_fd, pgid)
+        except OSError:
+            pass
+
+
+def run_background(and_or, fds=None):
+    """Run an and/or list in a forked subshell and register it as a job"""
+    global last_background
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = spawn_background(and_or, fds)
+    if pid is None:
+        pid = fork_background(and_or, fds)
+    last_background = pid
+    job = add_job(Job(pid, [pid], and_or.text))
+    if interactive:
+        print(f"[{job.number}] {pid}")
+    return 0
+
+
+def spawn_background(and_or, fds):
+    """Spawn an and/or list that is one external command in its own process
+    group, or return None when it needs a subshell"""
+    pipelines = and_or.pipelines
+    if len(pipelines) != 1 or len(pipelines[0].commands) != 1:
+        return None
+    pipeline = pipelines[0]
+    command = pipeline.commands[0]
+    if (
+        pipeline.negated
+        or pipeline.timed
+        or not isinstance(command, SimpleCommand)
+        or not command.argv
+        or command.values is None
+        or any(redirect.text is None for redirect in command.redirects)
+    ):
+        return None  # Expanding could have side effects the shell mustn't see
+    argv = command.argv
+    if argv[0] in functions or argv[0] in BUILTINS and runs_in_process(argv):
+        return None
+    full_path = find_in_path(argv[0], remember=True)
+    if full_path is None:
+        return None  # The subshell reports it
+    fds = dict(fds or {0: 0, 1: 1, 2: 2})
+    opened = []
+    try:
+        if not job_control:
+            # Like run_as_subshell: no terminal stdin for async commands
+            fds[0] = os.open(os.devnull, os.O_RDONLY)
+            opened.append(fds[0])
+        open_redirects(command.redirects, fds, opened)
+        env = command_env(command.values) if command.values else None
+        return spawn(argv, full_path, fds, 0, env)
+    except (RedirectError, OSError):
+        return None  # Let the subshell report it the usual way
+    finally:
+        for fd in opened:
+            os.close(fd)
+
+
+def fork_background(and_or, fds):
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            run_as_subshell()
+            status = execute_and_or(and_or, fds, replace=True)
+        except ExitShell as e:
+            status = e.status
+        except KeyboardInterrupt:
+            status = 128 + signal.SIGINT
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+
+    try:
+        os.setpgid(pid, pid)  # Also done by the child, whoever runs first wins
+    except OSError:
+        pass
+    return pid
+
+
+def run_as_subshell():
+    # State a forked child must not share with the interactive shell
+    global interactive, job_control
+    jobs.clear()
+    if not job_control:
+        # Without job control, async commands don't get the terminal's stdin
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+    interactive = job_control = False
+
+
+def find_job(spec, streams, name):
+    """Look up a job by %n / %+ / %- spec (current job when spec is None)"""
+    numbers = sorted(jobs)
+    try:
+        if spec in (None, "%", "%%", "%+"):
+            return jobs[numbers[-1]]
+        if spec == "%-":
+            return jobs[numbers[-2]]
+        return jobs[int(spec.lstrip("%"))]
+    except (IndexError, KeyError, ValueError):
+        streams.stderr.write(f"{name}: {spec or 'current'}: no such job\n")
+        return None
+
+
+@builtin("jobs")
+def builtin_jobs(args, streams):
+    reap_jobs()
+    for job in sorted(jobs.values(), key=lambda job: job.number):
+        line = job.describe()
+        if "-l" in args:
+            # After the number and its +/- mark: "[1]+ 31063  Running ..."
+            head = f"[{job.number}]{job_mark(job)}"
+            line = f"{head} {job.pgid}{line[len(head):]}"
+        streams.stdout.write(line + "\n")
+        job.reported = job.state
+    return 0
+
+
+@builtin("fg")
+def builtin_fg(args, streams):
+    job = find_job(args[0] if args else None, streams, "fg")
+    if job is None:
+        return 1
+    streams.stdout.write(job.text + "\n")
+    streams.stdout.flush()
+    give_terminal_to(job.pgid)
+    try:
+        job.state = "Running"
+        os.killpg(job.pgid, signal.SIGCONT)
+        wait_job(job)
+    finally:
+        give_terminal_to(shell_pgid)
+    if job.state == "Stopped":
+        job.reported = "Stopped"
+        streams.stdout.write("\n" + job.describe() + "\n")
+        return 128 + signal.SIGTSTP
+    del jobs[job.number]
+    if job.status() == 128 + signal.SIGINT:
+        streams.stdout.write("\n")
+    return job.status()
+
+
+@builtin("bg")
+def builtin_bg(args, streams):
+    job = find_job(args[0] if args else None, streams, "bg")
+    if job is None:
+        return 1
+    job.state = job.reported = "Running"
+    os.killpg(job.pgid, signal.SIGCONT)
+    streams.stdout.write(f"[{job.number}]{job_mark(job)} {job.text} &\n")
+    return 0
+
+
+@builtin("wait")
+def builtin_wait(args, streams):
+    targets = []
+    for arg in args:
+        if arg.startswith("%"):
+            job = find_job(arg, streams, "wait")
+        else:
+            job = next(
+                (job for job in jobs.values() if arg.isdigit() and int(arg) in job.pids),
+                None,
+            )
+            if job is None:
+                streams.stderr.write(f"wait: pid {arg} is not a child of this shell\n")
+        if job is None:
+            return 127
+        targets.append(job)
+
+    status = 0
+    for job in targets or list(jobs.values()):
+        status = wait_job(job)
+        if job.state == "Done":
+            jobs.pop(job.number, None)
+    return status
+
+
+def signal_number(name):
+    name = name.upper()
+    if name.isdigit():
+        return int(name)
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+    return getattr(signal, name).value
+
+
+@builtin("kill")
+def builtin_kill(args, streams):
+    if args and args[0] == "-l":
+        names = sorted(signal.Signals, key=lambda sig: sig.value)
+        streams.stdout.write(" ".join(sig.name[3:] for sig in names) + "\n")
+        return 0
+
+    sig = signal.SIGTERM
+    try:
+        if args and args[0] in ("-s", "-n") and len(args) > 1:
+            sig = signal_number(args[1])
+            args = args[2:]
+        elif args and args[0].startswith("-") and len(args[0]) > 1:
+            sig = signal_number(args[0][1:])
+            args = args[1:]
+    except AttributeError:
+        streams.stderr.write("kill: invalid signal specification\n")
+        return 1
+    if not args:
+        streams.stderr.write("kill: usage: kill [-s sigspec | -sigspec] pid | %job ...\n")
+        return 2
+
+    status = 0
+    for target in args:
+        try:
+            if target.startswith("%"):
+                job = find_job(target, streams, "kill")
+                if job is None:
+                    status = 1
+                    continue
+                os.killpg(job.pgid, sig)
+            else:
+                os.kill(int(target), sig)
+        except ValueError:
+            streams.stderr.write(f"kill: {target}: arguments must be process or job IDs\n")
+            status = 1
+        except OSError as e:
+            streams.stderr.write(f"kill: ({target}) - {e.strerror}\n")
+            status = 1
+    return status
+
+
+# --- Parallel ----------------------------------------------------------------
+#
+# `parallel [-j N] [-k] [-a file] template [::: inputs...]` runs the template
+# once per input, at most N jobs at a time. Each job is an ordinary command
+# line (PATH lookup, redirections and pipelines all apply) run in a forked
+# child, so a job's `cd`, assignments and $? stay its own. Everything runs on
+# the shell's one thread: a selector loop spools the jobs' stdout and stderr
+# pipes to temporary files, and a job is reaped once both reach end of file.
+# Its output is then copied out whole, so that of different jobs never
+# interleaves.
+
+SAFE_CHARS = frozenset(
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789@%+=:,./-_"
+)
+
+
+def shell_quote(text):
+    """Quote text so the parser reads it back as a single word"""
+    if text and SAFE_CHARS.issuperset(text):
+        return text
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+def fill_template(template, value, number):
+    """Substitute one input into a command template, GNU parallel style:
+    {} input, {.} without extension, {/} basename, {#} job number.
+    Without any placeholder the input is appended as the last argument."""
+    quoted = shell_quote(value)
+    replacements = {
+        "{}": quoted,
+        "{.}": shell_quote(os.path.splitext(value)[0]),
+        "{/}": shell_quote(os.path.basename(value)),
+        "{#}": str(number),
+    }
+    if not any(key in template for key in replacements):
+        return f"{template} {quoted}"
+    for key, replacement in replacements.items():
+        template = template.replace(key, replacement)
+    return template
+
+
+class ParallelJob:
+    """A job of parallel running in a child, its output pipes spooled to
+    temporary files until it is done"""
+
+    def __init__(self, tree):
+        import tempfile
+
+        self.out = tempfile.TemporaryFile()
+        self.err = tempfile.TemporaryFile()
+        self.status = None
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        fds = {0: devnull, 1: out_w, 2: err_w}
+        try:
+            self.pid = fork_child(lambda: execute(tree, fds), fds.values())
+        except OSError:
+            os.close(out_r)
+            os.close(err_r)
+            raise
+        finally:
+            for fd in (devnull, out_w, err_w):
+                os.close(fd)
+        self.pipes = {out_r: self.out, err_r: self.err}
+
+    def drain(self, fd):
+        """Spool what one of the pipes has; at its end close it, and reap
+        the child once both are closed. Returns False at the end."""
+        data = os.read(fd, SCRIPT_CHUNK_SIZE)
+        if data:
+            self.pipes[fd].write(data)
+            return True
+        os.close(fd)
+        del self.pipes[fd]
+        if not self.pipes:
+            self.status = wait_child(self.pid)
+        return False
+
+
+def copy_spooled(spool, stream):
+    # Copy a finished job's output in chunks, then drop the temp file
+    stream.flush()
+    spool.seek(0)
+    while True:
+        chunk = spool.read(SCRIPT_CHUNK_SIZE)
+        if not chunk:
+            break
+        stream.buffer.write(chunk)
+    stream.buffer.flush()
+    spool.close()
+
+
+@builtin("parallel")
+def builtin_parallel(args, streams):
+    import selectors
+
+    jobs_limit = os.cpu_count() or 1
+    keep_order = False
+    input_file = None
+    args = list(args)
+    try:
+        while args and args[0].startswith("-") and args[0] != ":::":
+            option = args.pop(0)
+            if option == "-k":
+                keep_order = True
+            elif option == "-j":
+                jobs_limit = max(1, int(args.pop(0)))
+            elif option.startswith("-j"):
+                jobs_limit = max(1, int(option[2:]))
+            elif option == "-a":
+                input_file = args.pop(0)
+            elif option == "--":
+                break
+            else:
+                streams.stderr.write(f"parallel: {option}: invalid option\n")
+                return 2
+    except (IndexError, ValueError):
+        streams.stderr.write("parallel: option requires a valid argument\n")
+        return 2
+
+    if ":::" in args:
+        split = args.index(":::")
+        template, inputs = args[:split], iter(args[split + 1 :])
+    elif input_file is not None:
+        template = args
+        try:
+            inputs = (line.rstrip("\n") for line in open(input_file))
+        except OSError as e:
+            streams.stderr.write(f"parallel: {input_file}: {e.strerror}\n")
+            return 1
+    else:
+        template = args
+        inputs = (line.rstrip("\n") for line in streams.stdin)
+    if not template:
+        streams.stderr.write(
+            "usage: parallel [-j N] [-k] [-a file] command [::: args...]\n"
+        )
+        return 2
+    template = " ".join(template)
+
+    failed = 0
+    next_to_print = 0
+    finished = {}  # Job index -> job, held back until its turn with -k
+    running = 0
+    error = None  # Status to return instead, once the running jobs are done
+    selector = selectors.DefaultSelector()
+    inputs = enumerate(inputs)
+
+    def emit(job):
+        nonlocal failed
+        copy_spooled(job.out, streams.stdout)
+        copy_spooled(job.err, streams.stderr)
+        if job.status:
+            failed += 1
+
+    try:
+        while True:
+            # Start jobs up to the limit; inputs are read as slots free up
+            while running < jobs_limit and error is None:
+                index, value = next(inputs, (None, None))
+                if index is None:
+                    break
+                try:
+                    job = ParallelJob(parse(fill_template(template, value, index + 1)))
+                except ShellSyntaxError as e:
+                    streams.stderr.write(f"parallel: {e}\n")
+                    error = 2
+                    break
+                except OSError as e:
+                    streams.stderr.write(f"parallel: {e.strerror}\n")
+                    error = 1
+                    break
+                for fd in job.pipes:
+                    selector.register(fd, selectors.EVENT_READ, (job, index))
+                running += 1
+            if not running:
+                break
+            for key, _ in selector.select():
+                job, index = key.data
+                if job.drain(key.fd):
+                    continue
+                selector.unregister(key.fd)
+                if job.status is None:
+                    continue  # The other pipe is still open
+                running -= 1
+                finished[index] = job
+                if keep_order:
+                    while next_to_print in finished:
+                        emit(finished.pop(next_to_print))
+                        next_to_print += 1
+                else:
+                    emit(finished.pop(index))
+    finally:
+        selector.close()
+    for index in sorted(finished):
+        emit(finished.pop(index))  # Held back behind a job that didn't start
+    if error is not None:
+        return error
+    # Like GNU parallel: the number of failed jobs, capped at 101
+    return min(failed, 101)
+
+
+# --- Coreutils -----------------------------------------------------------------
+#
+# In-process versions of the small utilities scripts run most often, saving a
+# process spawn per call. They are registered disabled: `enable name` (or the
+# --coreutils flag) switches them on and `enable -n name` off again. Each one
+# comes with a parser for the options it implements; given any other option
+# the real command on PATH runs instead, so enabling them never changes what
+# a script can do. File data is copied in chunks through one reusable buffer.
+
+COREUTIL_BUFFER_SIZE = 1 << 17
+COREUTIL_OPTIONS = {}  # name -> parse(args), None for unsupported options
+
+
+def coreutil(name, parse):
+    """Decorator registering a disabled builtin together with its parser"""
+
+    def register(func):
+        COREUTIL_OPTIONS[name] = parse
+        return builtin(name, enabled=False)(func)
+
+    return register
+
+
+def runs_in_process(argv):
+    """Whether a builtin handles argv itself rather than the PATH command"""
+    parse = COREUTIL_OPTIONS.get(argv[0])
+    return parse is None or parse(argv[1:]) is not None
+
+
+def parse_flags(args, letters):
+    """Split args into (flags, operands), or None if they use an option
+    letter outside `letters`"""
+    flags = set()
+    operands = []
+    args = iter(args)
+    for arg in args:
+        if arg == "--":
+            operands.extend(args)
+            break
+        if arg.startswith("-") and arg != "-":
+            if not letters.issuperset(arg[1:]):
+                return None
+            flags.update(arg[1:])
+        else:
+            operands.append(arg)
+    return flags, operands
+
+
+def any_args(args):
+    return args
+
+
+def output_fd(streams):
+    # Text the builtin wrote so far must come out before the raw writes
+    streams.stdout.flush()
+    return streams.stdout.fileno()
+
+
+def write_fully(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def open_input(name, streams):
+    """Unbuffered binary reader for a file operand ("-" is stdin)"""
+    if name == "-":
+        return io.FileIO(streams.stdin.fileno(), closefd=False)
+    return io.FileIO(name)
+
+
+@coreutil("true", any_args)
+def coreutil_true(args, streams):
+    return 0
+
+
+@coreutil("false", any_args)
+def coreutil_false(args, streams):
+    return 1
+
+
+@coreutil("cat", lambda args: parse_flags(args, {"u"}))
+def coreutil_cat(args, streams):
+    _, names = parse_flags(args, {"u"})
+    out = output_fd(streams)
+    buffer = bytearray(COREUTIL_BUFFER_SIZE)
+    view = memoryview(buffer)
+    status = 0
+    for name in names or ["-"]:
+        try:
+            with open_input(name, streams) as source:
+                while True:
+                    n = source.readinto(buffer)
+                    if not n:
+                        break
+                    write_fully(out, view[:n])
+        except BrokenPipeError:
+            raise
+        except OSError as e:
+            streams.stderr.write(f"cat: {name}: {e.strerror}\n")
+            status = 1
+    return status
+
+
+def parse_head(args):
+    """(count, by_bytes, names) for `head [-n N | -c N | -N] [file...]`"""
+    count, by_bytes, names = 10, False, []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg == "--":
+            names.extend(args[i:])
+            break
+        if arg in ("-n", "-c"):
+            if i == len(args):
+                return None
+            value = args[i]
+            i += 1
+        elif arg.startswith(("-n", "-c")):
+            arg, value = arg[:2], arg[2:]
+        elif arg.startswith("-") and arg[1:].isdigit():
+            arg, value = "-n", arg[1:]
+        elif arg.startswith("-") and arg != "-":
+            return None
+        else:
+            names.append(arg)
+            continue
+        if not value.isdigit():
+            return None  # Negative counts, size suffixes: the real head
+        count, by_bytes = int(value), arg == "-c"
+    return count, by_bytes, names
+
+
+@coreutil("head", parse_head)
+def coreutil_head(args, streams):
+    count, by_bytes, names = parse_head(args)
+    out = output_fd(streams)
+    buffer = bytearray(COREUTIL_BUFFER_SIZE)
+    view = memoryview(buffer)
+    status = 0
+    for number, name in enumerate(names or ["-"]):
+        if len(names) > 1:
+            # Like head: a header above each file, a blank line between them
+            label = "standard input" if name == "-" else name
+            header = f"==> {label} <==\n" if number == 0 else f"\n==> {label} <==\n"
+            write_fully(out, header.encode(errors="surrogateescape"))
+        try:
+            with open_input(name, streams) as source:
+                remaining = count
+                n = end = 0
+                while remaining:
+                    n = source.readinto(buffer)
+                    if not n:
+                        break
+                    if by_bytes:
+                        end = min(n, remaining)
+                        remaining -= end
+                    else:
+                        end = 0
+                        while remaining and end < n:
+                            newline = buffer.find(b"\n", end, n)
+                            if newline < 0:
+                                end = n
+                                break
+                            end = newline + 1
+                            remaining -= 1
+                    write_fully(out, view[:end])
+                if end < n and source.seekable():
+                    # Like head: leave a shared offset just past what was
+                    # printed, for `{ head -n 1; cat; } < file`
+                    source.seek(end - n, os.SEEK_CUR)
+        except BrokenPipeError:
+            raise
+        except OSError as e:
+            streams.stderr.write(f"head: cannot open '{name}' for reading: {e.strerror}\n")
+            status = 1
+    return status
+
+
+WC_WHITESPACE = b" \t\n\r\x0b\x0c"
+
+
+def wc_counts(source, buffer, words_needed):
+    """(lines, words, bytes) of a reader, counted chunk by chunk"""
+    lines = words = size = 0
+    in_word = False
+    while True:
+        n = source.readinto(buffer)
+        if not n:
+            break
+        size += n
+        lines += buffer.count(b"\n", 0, n)
+        if words_needed:
+            chunk = buffer if n == len(buffer) else buffer[:n]
+            words += len(chunk.split())
+            # A word running across the chunk boundary was counted twice
+            if in_word and chunk[0] not in WC_WHITESPACE:
+                words -= 1
+            in_word = chunk[-1] not in WC_WHITESPACE
+    return lines, words, size
+
+
+@coreutil("wc", lambda args: parse_flags(args, {"l", "w", "c"}))
+def coreutil_wc(args, streams):
+    flags, names = parse_flags(args, {"l", "w", "c"})
+    columns = [i for i, flag in enumerate("lwc") if flag in flags] or [0, 1, 2]
+    out = output_fd(streams)
+    buffer = bytearray(COREUTIL_BUFFER_SIZE)
+    results = []  # (counts, name) in operand order
+    regular_total = 0
+    any_irregular = False
+    status = 0
+    for name in names or ["-"]:
+        try:
+            with open_input(name, streams) as source:
+                st = os.fstat(source.fileno())
+                if stat.S_ISREG(st.st_mode):
+                    regular_total += st.st_size
+                else:
+                    any_irregular = True
+                if columns == [2] and stat.S_ISREG(st.st_mode) and name != "-":
+                    counts = (0, 0, st.st_size)  # Byte count needs no reading
+                else:
+                    counts = wc_counts(source, buffer, 1 in columns)
+        except BrokenPipeError:
+            raise
+        except OSError as e:
+            streams.stderr.write(f"wc: {name}: {e.strerror}\n")
+            status = 1
+            continue
+        results.append((counts, name if names else None))
+    if len(names) > 1:
+        totals = tuple(sum(counts[i] for counts, _ in results) for i in range(3))
+        results.append((totals, "total"))
+
+    # Column width as GNU wc picks it: from the total size of regular files,
+    # at least 7 when reading pipes or terminals, none for a lone count
+    if len(columns) == 1 and len(names) <= 1:
+        width = 1
+    else:
+        width = max(len(str(regular_total)), 7 if any_irregular else 1)
+    lines = []
+    for counts, name in results:
+        line = " ".join(f"{counts[i]:>{width}}" for i in columns)
+        lines.append(line + (f" {name}" if name is not None else "") + "\n")
+    write_fully(out, "".join(lines).encode(errors="surrogateescape"))
+    return status
+
+
+def parse_basename(args):
+    parsed = parse_flags(args, set())
+    return parsed if parsed and 1 <= len(parsed[1]) <= 2 else None
+
+
+@coreutil("basename", parse_basename)
+def coreutil_basename(args, streams):
+    _, operands = parse_basename(args)
+    path = operands[0]
+    stripped = path.rstrip("/")
+    if not stripped:
+        base = "/" if path else ""
+    else:
+        base = stripped[stripped.rfind("/") + 1 :]
+        suffix = operands[1] if len(operands) > 1 else ""
+        if suffix and base != suffix and base.endswith(suffix):
+            base = base[: -len(suffix)]
+    streams.stdout.write(base + "\n")
+    return 0
+
+
+def parse_dirname(args):
+    parsed = parse_flags(args, set())
+    return parsed if parsed and parsed[1] else None
+
+
+@coreutil("dirname", parse_dirname)
+def coreutil_dirname(args, streams):
+    for path in parse_dirname(args)[1]:
+        stripped = path.rstrip("/")
+        if not stripped:
+            parent = "/" if path else "."
+        elif "/" not in stripped:
+            parent = "."
+        else:
+            parent = stripped[: stripped.rfind("/")].rstrip("/") or "/"
+        streams.stdout.write(parent + "\n")
+    return 0
+
+
+PRINTF_ESCAPES = {
+    "a": "\a", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t",
+    "v": "\v", "\\": "\\", '"': '"', "'": "'",
+}
+
+
+def printf_unescape(text, in_format):
+    """Expand backslash escapes. Returns (text, stop): stop is set when a
+    \\c (only honoured in %b arguments) ends all output."""
+    if "\\" not in text:
+        return text, False
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c != "\\" or i + 1 == n:
+            out.append(c)
+            i += 1
+            continue
+        c = text[i + 1]
+        if c in PRINTF_ESCAPES:
+            out.append(PRINTF_ESCAPES[c])
+            i += 2
+        elif c == "c" and not in_format:
+            return "".join(out), True
+        elif c == "x":
+            end = i + 2
+            while end < min(n, i + 4) and text[end] in "0123456789abcdefABCDEF":
+                end += 1
+            if end > i + 2:
+                out.append(chr(int(text[i + 2 : end], 16)))
+            else:
+                out.append("\\x")
+            i = end
+        elif c in "01234567":
+            # \NNN in formats, \0NNN in %b arguments
+            start = i + 1 if in_format else i + 1 + (c == "0")
+            end = start
+            while end < min(n, start + 3) and text[end] in "01234567":
+                end += 1
+            out.append(chr(int(text[start:end] or "0", 8) & 0xFF))
+            i = end
+        else:
+            out.append("\\" + c)
+            i += 2
+    return "".join(out), False
+
+
+def parse_c_integer(text):
+    """Parse an integer like strtol with base 0: 0x.. is hex, 0.. octal"""
+    body = text.strip()
+    sign = 1
+    if body[:1] in ("+", "-") and body:
+        sign = -1 if body[0] == "-" else 1
+        body = body[1:]
+    if body[:2].lower() == "0x":
+        return sign * int(body[2:], 16)
+    if body.startswith("0") and len(body) > 1:
+        return sign * int(body[1:], 8)
+    return sign * int(body, 10)
+
+
+def printf_number(arg, streams, integer):
+    """Convert a printf numeric argument; returns (value, valid)"""
+    if arg[:1] in ("'", '"') and len(arg) > 1:
+        return ord(arg[1]), True  # 'c is the character's code
+    try:
+        return (parse_c_integer(arg) if integer else float(arg)), True
+    except ValueError:
+        streams.stderr.write(f"printf: '{arg}': expected a numeric value\n")
+        return 0, False
+
+
+@coreutil("printf", any_args)
+def coreutil_printf(args, streams):
+    import re
+
+    if not args:
+        streams.stderr.write("printf: usage: printf format [arguments]\n")
+        return 2
+    spec = re.compile(r"%([-+ #0]*)(\*|\d+)?(?:\.(\*|\d*))?([diouxXfFeEgGcsb%])?")
+    fmt, args = args[0], list(args[1:])
+    status = 0
+    out = []
+    while True:
+        used = 0
+        pos = 0
+        for match in spec.finditer(fmt):
+            literal, stop = printf_unescape(fmt[pos : match.start()], True)
+            out.append(literal)
+            pos = match.end()
+            flags, width, precision, conversion = match.groups()
+            if conversion == "%":
+                out.append("%")
+                continue
+            if conversion is None:
+                streams.stderr.write(f"printf: {match.group()}: invalid conversion\n")
+                status = 1
+                continue
+
+            def next_arg():
+                nonlocal used
+                if used < len(args):
+                    used += 1
+                    return args[used - 1]
+                return None
+
+            if width == "*":
+                width = str(printf_number(next_arg() or "0", streams, True)[0])
+            if precision == "*":
+                precision = str(printf_number(next_arg() or "0", streams, True)[0])
+            arg = next_arg()
+            directive = "%" + flags + (width or "") + ("." + precision if precision is not None else "")
+            if conversion in "sb":
+                text = arg or ""
+                if conversion == "b":
+                    text, stop = printf_unescape(text, False)
+                    if stop:
+                        out.append((directive + "s") % text)
+                        streams.stdout.write("".join(out))
+                        return status
+                out.append((directive + "s") % text)
+            elif conversion == "c":
+                out.append((directive.split(".")[0] + "s") % (arg or "")[:1])
+            else:
+                integer = conversion in "diouxX"
+                value, ok = printf_number(arg, streams, integer) if arg else (0, True)
+                if not ok:
+                    status = 1
+                if integer:
+                    value = int(value)
+                    conversion = "d" if conversion in "iu" else conversion
+                out.append((directive + conversion) % value)
+        out.append(printf_unescape(fmt[pos:], True)[0])
+        # The format is reused while arguments remain, like in other shells
+        args = args[used:]
+        if not args or not used:
+            break
+    streams.stdout.write("".join(out))
+    return status
+
+
+class TestError(Exception):
+    pass
+
+
+TEST_UNARY = set("-b -c -d -e -f -g -h -k -L -n -O -G -p -r -s -S -t -u -w -x -z".split())
+TEST_BINARY = set("= == != < > -eq -ne -gt -ge -lt -le -nt -ot -ef".split())
+TEST_FILE_TYPES = {
+    "-f": stat.S_ISREG,
+    "-d": stat.S_ISDIR,
+    "-h": stat.S_ISLNK,
+    "-L": stat.S_ISLNK,
+    "-p": stat.S_ISFIFO,
+    "-S": stat.S_ISSOCK,
+    "-b": stat.S_ISBLK,
+    "-c": stat.S_ISCHR,
+}
+
+
+def test_unary(op, arg):
+    if op == "-z":
+        return arg == ""
+    if op == "-n":
+        return arg != ""
+    if op == "-t":
+        try:
+            return os.isatty(int(arg))
+        except ValueError:
+            raise TestError(f"{arg}: integer expression expected")
+    if op in ("-r", "-w", "-x"):
+        return os.access(arg, {"-r": os.R_OK, "-w": os.W_OK, "-x": os.X_OK}[op])
+    try:
+        st = os.lstat(arg) if op in ("-h", "-L") else os.stat(arg)
+    except (OSError, ValueError):
+        return False
+    mode = st.st_mode
+    if op in TEST_FILE_TYPES:
+        return TEST_FILE_TYPES[op](mode)
+    return {
+        "-e": True,
+        "-s": st.st_size > 0,
+        "-g": bool(mode & stat.S_ISGID),
+        "-u": bool(mode & stat.S_ISUID),
+        "-k": bool(mode & stat.S_ISVTX),
+        "-O": st.st_uid == os.geteuid(),
+        "-G": st.st_gid == os.getegid(),
+    }[op]
+
+
+def test_integer(text):
+    try:
+        return int(text.strip())
+    except ValueError:
+        raise TestError(f"{text}: integer expression expected")
+
+
+def test_binary(left, op, right):
+    if op in ("=", "=="):
+        return left == right
+    if op == "!=":
+        return left != right
+    if op == "<":
+        return left < right
+    if op == ">":
+        return left > right
+    if op in ("-nt", "-ot", "-ef"):
+        try:
+            a = os.stat(left)
+        except OSError:
+            a = None
+        try:
+            b = os.stat(right)
+        except OSError:
+            b = None
+        if op == "-ef":
+            return bool(a and b) and (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+        if op == "-ot":
+            a, b = b, a
+        return a is not None and (b is None or a.st_mtime_ns > b.st_mtime_ns)
+    a, b = test_integer(left), test_integer(right)
+    return {"-eq": a == b, "-ne": a != b, "-gt": a > b, "-ge": a >= b, "-lt": a < b, "-le": a <= b}[op]
+
+
+def test_eval(args):
+    """Evaluate test's arguments: POSIX rules by argument count for up to
+    four arguments, then a recursive descent with ! ( ) -a -o"""
+    n = len(args)
+    if n == 0:
+        return False
+    if n == 1:
+        return args[0] != ""
+    if n == 2:
+        if args[0] == "!":
+            return args[1] == ""
+        if args[0] in TEST_UNARY:
+            return test_unary(args[0], args[1])
+        raise TestError(f"{args[0]}: unary operator expected")
+    if n == 3:
+        if args[1] in TEST_BINARY:
+            return test_binary(*args)
+        if args[1] == "-a":
+            return args[0] != "" and args[2] != ""
+        if args[1] == "-o":
+            return args[0] != "" or args[2] != ""
+        if args[0] == "!":
+            return not test_eval(args[1:])
+        if args[0] == "(" and args[2] == ")":
+            return args[1] != ""
+        raise TestError(f"{args[1]}: binary operator expected")
+    if n == 4:
+        if args[0] == "!":
+            return not test_eval(args[1:])
+        if args[0] == "(" and args[3] == ")":
+            return test_eval(args[1:3])
+    pos = 0
+
+    def peek():
+        return args[pos] if pos < n else None
+
+    def expr_or():
+        nonlocal pos
+        value = expr_and()
+        while peek() == "-o":
+            pos += 1
+            value = expr_and() or value
+        return value
+
+    def expr_and():
+        nonlocal pos
+        value = expr_not()
+        while peek() == "-a":
+            pos += 1
+            value = expr_not() and value
+        return value
+
+    def expr_not():
+        nonlocal pos
+        if peek() == "!":
+            pos += 1
+            return not expr_not()
+        return primary()
+
+    def primary():
+        nonlocal pos
+        token = peek()
+        if token is None:
+            raise TestError("argument expected")
+        if token == "(":
+            pos += 1
+            value = expr_or()
+            if peek() != ")":
+                raise TestError("')' expected")
+            pos += 1
+            return value
+        if pos + 2 < n and args[pos + 1] in TEST_BINARY:
+            pos += 3
+            return test_binary(args[pos - 3], args[pos - 2], args[pos - 1])
+        if token in TEST_UNARY and pos + 1 < n:
+            pos += 2
+            return test_unary(token, args[pos - 1])
+        pos += 1
+        return token != ""
+
+    value = expr_or()
+    if pos != n:
+        raise TestError(f"{args[pos]}: unexpected argument")
+    return value
+
+
+@coreutil("test", any_args)
+def coreutil_test(args, streams, name="test"):
+    try:
+        return 0 if test_eval(list(args)) else 1
+    except TestError as e:
+        streams.stderr.write(f"{name}: {e}\n")
+        return 2
+
+
+@coreutil("[", any_args)
+def coreutil_bracket(args, streams):
+    if not args or args[-1] != "]":
+        streams.stderr.write("[: missing `]'\n")
+        return 2
+    return coreutil_test(args[:-1], streams, "[")
+
+
+@builtin("enable")
+def builtin_enable(args, streams):
+    disable = False
+    names = []
+    for arg in args:
+        if arg == "-n":
+            disable = True
+        elif arg == "-a":
+            pass  # Listing shows every builtin anyway
+        elif arg.startswith("-"):
+            streams.stderr.write(f"enable: {arg}: invalid option\n")
+            return 2
+        else:
+            names.append(arg)
+
+    if not names:
+        for name in sorted(BUILTIN_HANDLERS):
+            flag = "" if name in BUILTINS else "-n "
+            streams.stdout.write(f"enable {flag}{name}\n")
+        return 0
+    status = 0
+    for name in names:
+        if name not in BUILTIN_HANDLERS:
+            streams.stderr.write(f"enable: {name}: not a shell builtin\n")
+            status = 1
+        elif disable:
+            BUILTINS.pop(name, None)
+        else:
+            BUILTINS[name] = BUILTIN_HANDLERS[name]
+    return status
+
+
+def enable_coreutils():
+    """--coreutils: run all the coreutils builtins in-process"""
+    for name in COREUTIL_OPTIONS:
+        BUILTINS[name] = BUILTIN_HANDLERS[name]
+
+
+def append_history_file():
+    # Only append commands added during this session
+    histfile = get_var("HISTFILE")
+    if histfile:
+        try:
+            command_history.append_file(os.path.expanduser(histfile))
+        except Exception:
+            pass  # Ignore errors silently
+
+
+def merge_history_file():
+    # Pick up the commands other sessions appended to HISTFILE
+    histfile = get_var("HISTFILE")
+    if histfile:
+        try:
+            command_history.merge_file(os.path.expanduser(histfile))
+        except Exception:
+            pass
+
+
+SCRIPT_CHUNK_SIZE = 1 << 16  # Bytes read at a time in script mode
+
+
+def read_script_lines(fd, shared=False):
+    """Yield the lines of a script read from fd in large chunks.
+
+    With shared set the script's commands read from fd too (a script on
+    stdin), so it is read like the read builtin does (see read_line) and
+    nothing past the line about to run is consumed.
+    """
+    if shared:
+        while True:
+            line, newline = read_line(fd)
+            if line or newline:
+                yield line.decode(errors="surrogateescape")
+            if not newline:
+                return
+    pending = b""
+    while True:
+        chunk = os.read(fd, SCRIPT_CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode(errors="surrogateescape")
+    if pending:
+        yield pending.decode(errors="surrogateescape")
+
+
+def parse_script(lines):
+    """Yield (line number, tree) for each command of a script as soon as it
+    is complete. A syntax error is yielded in place of the tree and ends
+    the script.
+
+    A compound command spanning several lines is collected and parsed once
+    it is complete.
+    """
+    pending = None  # Lines of an incomplete command so far
+    closers = None  # What a line needs to contain to possibly complete it
+    for lineno, line in enumerate(lines, start=1):
+        if pending is not None:
+            pending.append(line)
+            if closers and not any(closer in line for closer in closers):
+                continue  # Can't be complete yet, don't reparse
+            line = "\n".join(pending)
+        try:
+            tree = parse(line)
+        except IncompleteInput as e:
+            if pending is None:
+                pending = [line]
+                start = lineno
+            closers = e.closers
+            continue
+        except ShellSyntaxError as e:
+            yield (lineno if pending is None else start), e
+            return
+        pending = None
+        yield lineno, tree
+    if pending is not None:
+        yield start, ShellSyntaxError("syntax error: unexpected end of file")
+
+
+def run_script(lines, name):
+    """Run commands non-interactively and return the last exit status.
+
+    No prompt, readline or history is involved; a syntax error aborts the
+    script like it does in other shells.
+    """
+    status = 0
+    for lineno, tree in parse_script(lines):
+        if isinstance(tree, ShellSyntaxError):
+            print(f"{name}: line {lineno}: {tree}", file=sys.stderr)
+            return 2
+        try:
+            status = execute(tree)
+        except ExitShell as e:
+            return e.status
+    return status
+
+
+# Ctrl-R is bound to a readline macro that prefixes the line with this mark
+# and accepts it, handing control to reverse_search(). The mark starts with
+# "#" so that, should it ever reach the parser, it is just a comment.
+REVERSE_SEARCH_MARK = "#@rsearch@#"
+PROMPT = "$ "
+CONTINUATION_PROMPT = "> "
+
+
+def reverse_search(original, prompt=PROMPT):
+    """Incremental Ctrl-R search on the terminal, started from a prompt.
+
+    Returns ("run", line) when Enter was pressed and ("edit", line) when the
+    match (or the original line on ^G / ^C) should be put back on the prompt
+    for editing.
+    """
+    import termios, tty, shutil
+
+    fd = sys.stdin.fileno()
+    search = HistorySearch(command_history)
+    query = ""
+    matches = []
+    choice = 0
+    saved = termios.tcgetattr(fd)
+    # TCSANOW: keys typed right after ^R must not be flushed
+    tty.setcbreak(fd, termios.TCSANOW)
+    try:
+        # Cursor up over the line readline just accepted
+        sys.stdout.write("\x1b[A\r\x1b[K")
+        while True:
+            current = matches[choice] if matches else ""
+            label = "failed " if query and not matches else ("fuzzy " if search.fuzzy else "")
+            line = f"({label}reverse-i-search)`{query}': {current}"
+            width = shutil.get_terminal_size().columns
+            sys.stdout.write("\r\x1b[K" + line[: width - 1])
+            sys.stdout.flush()
+
+            keys = os.read(fd, 64).decode(errors="ignore")
+            for key in keys:
+                # Keys typed ahead arrive together, the match moves with them
+                current = matches[choice] if matches else ""
+                if key in "\r\n":
+                    sys.stdout.write("\r\x1b[K" + prompt + (current or original) + "\n")
+                    return "run", current or original
+                if key in "\x07\x03":  # ^G / ^C give up
+                    sys.stdout.write("\r\x1b[K")
+                    return "edit", original
+                if key == "\x12":  # ^R again: next older match
+                    if matches:
+                        choice = (choice + 1) % len(matches)
+                    continue
+                if key in "\x7f\x08":
+                    query = query[:-1]
+                elif key.isprintable():
+                    query += key
+                else:
+                    # Esc, arrows and other editing keys keep the match
+                    sys.stdout.write("\r\x1b[K")
+                    return "edit", current or original
+                matches = search.update(query) if query else []
+                choice = 0
+            else:
+                continue
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+        sys.stdout.flush()
+
+
+def read_input(prompt):
+    """input() that handles Ctrl-R: the chosen line is returned when the
+    search ends with Enter, or put back on the prompt for editing"""
+    import readline
+
+    while True:
+        line = input(prompt)
+        if not line.startswith(REVERSE_SEARCH_MARK):
+            return line
+        # The marked line must not stay in readline's own history
+        readline.remove_history_item(readline.get_current_history_length() - 1)
+        action, line = reverse_search(line[len(REVERSE_SEARCH_MARK) :], prompt)
+        if action == "run":
+            readline.add_history(line)
+            return line
+        prefill_next_prompt(line)
+
+
+def prefill_next_prompt(text):
+    """Put text in the line buffer the next time readline prompts"""
+    import readline
+
+    def hook():
+        readline.insert_text(text)
+        readline.redisplay()
+        readline.set_pre_input_hook(None)
+
+    readline.set_pre_input_hook(hook)
+
+
+def setup_job_control():
+    """Take over the terminal so foreground jobs can be given and taken back"""
+    global job_control, shell_pgid, terminal_fd
+    terminal_fd = sys.stdin.fileno()
+    shell_pgid = os.getpgrp()
+    if os.tcgetpgrp(terminal_fd) != shell_pgid:
+        return  # Started in the background, leave the terminal alone
+    # The shell itself must not be stopped by ^Z or by touching the terminal
+    for sig in (signal.SIGTSTP, signal.SIGTTIN, signal.SIGTTOU):
+        signal.signal(sig, signal.SIG_IGN)
+    job_control = True
+
+
+def remember_line(line):
+    if line.strip():
+        command_history.append(line)
+        # Written right away, so a crash or kill doesn't lose it
+        append_history_file()
+
+
+def run_interactive():
+    global interactive, last_status
+
+    # Map history from HISTFILE on startup if it exists; it is only split
+    # into entries once something needs them
+    histfile = get_var("HISTFILE")
+    if histfile:
+        histfile = os.path.expanduser(histfile)
+        try:
+            command_history.load(histfile)
+        except FileNotFoundError:
+            pass  # File doesn't exist yet, that's ok
+        except Exception:
+            pass  # Ignore other errors silently
+    startup_phase("history")
+
+    # Importing readline is what makes input() use it, so this is the only
+    # mode that pays for it (and for reading ~/.inputrc)
+    import readline
+
+    readline.set_completer(complete)
+    readline.parse_and_bind("tab: complete")
+    readline.set_completer_delims(" \t\n;|&<>()")
+    readline.set_completion_display_matches_hook(display_matches_hook)
+    readline.parse_and_bind(f'"\\C-r": "\\C-a{REVERSE_SEARCH_MARK}\\C-j"')
+    startup_phase("readline")
+
+    interactive = True
+    setup_job_control()
+    startup_phase("job control")
+    report_startup()
+
+    def warm_up():
+        # The command table and the history index are built in the
+        # background once the first prompt is up
+        readline.set_pre_input_hook(None)
+        command_history.warm_up(after=start_warmup())
+
+    readline.set_pre_input_hook(warm_up)
+
+    status = 0
+    while True:
+        notify_jobs()
+        merge_history_file()
+        # Read - get user input
+        try:
+            command = read_input(PROMPT)
+        except KeyboardInterrupt:
+            print()  # ^C at the prompt discards the line
+            continue
+        except EOFError:
+            # Append history on exit (Ctrl+D)
+            append_history_file()
+            return status
+
+        remember_line(command)
+
+        # Parse once into an AST, then evaluate it. An open quote or compound
+        # command continues on more lines.
+        try:
+            while True:
+                try:
+                    tree = parse(command)
+                    break
+                except IncompleteInput:
+                    more = read_input(CONTINUATION_PROMPT)
+                    remember_line(more)
+                    command += "\n" + more
+            status = execute(tree)
+        except ShellSyntaxError as e:
+            print(f"shell: {e}", file=sys.stderr)
+            status = 2
+        except EOFError:
+            print("shell: syntax error: unexpected end of file", file=sys.stderr)
+            status = 2
+        except KeyboardInterrupt as e:
+            if not e.args:
+                print()  # Not reported yet by the pipeline that got the ^C
+            status = 128 + signal.SIGINT
+        except ExitShell as e:
+            append_history_file()
+            return e.status
+        last_status = status
+
+    # Continue looping back to "Read"
+
+
+startup_profile = False  # --startup-profile: report the phases below
+startup_phases = []  # (phase, seconds) in the order they ran
+startup_mark = STARTUP_START
+
+
+def startup_phase(name):
+    """Record the time since the previous phase ended as phase `name`"""
+    global startup_mark
+    now = time.perf_counter()
+    startup_phases.append((name, now - startup_mark))
+    startup_mark = now
+
+
+def report_startup():
+    # Printed to stderr once, before the first prompt or when a script ends
+    global startup_profile
+    if not startup_profile:
+        return
+    startup_profile = False
+    for name, seconds in startup_phases:
+        print(f"{name:<14}{seconds * 1000:>8.2f} ms", file=sys.stderr)
+    total = time.perf_counter() - STARTUP_START
+    print(f"{'total':<14}{total * 1000:>8.2f} ms", file=sys.stderr)
+
+
+# --- Server ------------------------------------------------------------------
+#
+# `--server PATH` keeps one warm shell listening on a Unix socket, for callers
+# that would otherwise start a shell per command (see client.py for the
+# protocol and the drop-in client). A single selector loop receives the
+# requests, parses their commands into its own AST cache and forks one shell
+# per request, which starts from the warm command table and cache but with
+# its own cwd and environment, in its own process group and with pipes as
+# 0/1/2. The loop relays those pipes to the client as frames, pausing a
+# side that gets SERVER_BUFFER_LIMIT ahead, so requests run concurrently and
+# a slow client only holds up its own command.
+
+SERVER_BACKLOG = 128
+SERVER_BUFFER_LIMIT = 1 << 20  # Bytes buffered per direction of a session
+
+
+def serve(path):
+    """Serve requests on a Unix socket at path until interrupted"""
+    import gc
+
+    refresh_command_index(force=True)
+    gc.freeze()  # Children then don't copy pages for the GC's bookkeeping
+    try:
+        server = ShellServer(path)
+    except OSError as e:
+        print(f"shell: {path}: {e.strerror}", file=sys.stderr)
+        return 1
+    try:
+        server.run()
+    finally:
+        server.close()
+
+
+class ShellServer:
+    """The selector loop of --server. Callbacks are kept as selector data."""
+
+    def __init__(self, path):
+        import socket, selectors
+
+        self.path = path
+        self.READ, self.WRITE = selectors.EVENT_READ, selectors.EVENT_WRITE
+        self.selector = selectors.DefaultSelector()
+        self.children = {}  # pid -> Session of a shell still running
+        try:
+            if stat.S_ISSOCK(os.lstat(path).st_mode):
+                os.unlink(path)  # Left behind by a server that was killed
+        except FileNotFoundError:
+            pass
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Whoever can connect can run commands as us: owner only (0600)
+        umask = os.umask(0o177)
+        try:
+            self.listener.bind(path)
+        finally:
+            os.umask(umask)
+        self.listener.listen(SERVER_BACKLOG)
+        self.listener.setblocking(False)
+        self.watch(self.listener, self.READ, self.accept)
+        # SIGCHLD and SIGTERM wake the loop through this pipe
+        self.wakeup, wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w, warn_on_full_buffer=False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.watch(self.wakeup, self.READ, self.reap)
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select():
+                key.data(events)
+
+    def close(self):
+        self.listener.close()
+        os.unlink(self.path)
+
+    def watch(self, fileobj, events, callback=None):
+        """Set the events (0 for none) a file is watched for"""
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            key = None
+        if not events:
+            if key is not None:
+                self.selector.unregister(fileobj)
+        elif key is None:
+            self.selector.register(fileobj, events, callback)
+        elif key.events != events:
+            self.selector.modify(fileobj, events, key.data)
+
+    def accept(self, events):
+        try:
+            conn, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        Session(self, conn)
+
+    def reap(self, events):
+        try:
+            while os.read(self.wakeup, 512):
+                pass
+        except BlockingIOError:
+            pass
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            session = self.children.pop(pid, None)
+            if session is not None:
+                session.status = exit_status(status)
+                session.update()
+
+
+class Session:
+    """One client of the server: its request while it's being received,
+    then the shell running it, whose pipes are relayed until it is done"""
+
+    def __init__(self, server, conn):
+        import client
+
+        self.client = client
+        self.server = server
+        self.conn = conn
+        self.reader = client.FrameReader()
+        self.request = []  # Frames of the request so far
+        self.pid = None  # The shell running the request, once started
+        self.status = None  # Its exit status once reaped
+        self.stdin_fd = None  # Write end of its stdin pipe
+        self.stdin = bytearray()  # Received stdin not written to it yet
+        self.stdin_done = False  # All of stdin received, or no longer wanted
+        self.outputs = {}  # Read end of its stdout/stderr pipe -> frame kind
+        self.outgoing = bytearray()  # Frames not sent to the client yet
+        self.connected = True
+        self.update()
+
+    def update(self):
+        """Watch what this session waits for now, and end it when done"""
+        server = self.server
+        if self.stdin_fd is not None and self.stdin_done and not self.stdin:
+            server.watch(self.stdin_fd, 0)
+            os.close(self.stdin_fd)
+            self.stdin_fd = None
+        if self.stdin_fd is not None:
+            server.watch(self.stdin_fd, server.WRITE if self.stdin else 0, self.write_stdin)
+        paused = len(self.outgoing) >= SERVER_BUFFER_LIMIT
+        for fd in self.outputs:
+            server.watch(fd, 0 if paused else server.READ, lambda events, fd=fd: self.relay(fd))
+        if self.pid is not None and not self.outputs and self.status is not None:
+            if self.connected and self.status is not False:
+                self.outgoing += self.client.frame(b"X", str(self.status).encode())
+            self.status = False  # Reported
+            if not self.outgoing:
+                self.hang_up()
+        if self.connected:
+            events = 0
+            # Keep reading after stdin's end too, to notice the client leaving
+            if len(self.stdin) < SERVER_BUFFER_LIMIT:
+                events |= server.READ
+            if self.outgoing:
+                events |= server.WRITE
+            server.watch(self.conn, events, self.talk)
+
+    def talk(self, events):
+        # The client connection is readable and/or writable
+        if events & self.server.WRITE:
+            try:
+                del self.outgoing[: self.conn.send(self.outgoing)]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.hang_up()
+                return
+            if not self.outgoing and self.status is False:
+                self.hang_up()  # All sent
+                return
+        if events & self.server.READ:
+            try:
+                data = self.conn.recv(self.client.CHUNK_SIZE)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+            if not data:
+                self.hang_up()
+                return
+            for kind, payload in self.reader.feed(data):
+                if self.pid is not None:
+                    if kind == b"0" and not self.stdin_done:
+                        self.stdin += payload
+                        self.stdin_done = self.stdin_done or not payload
+                elif kind == b"R":
+                    try:
+                        self.start()
+                    except Exception as e:
+                        self.refuse(f"shell: {e}\n")
+                        break
+                else:
+                    self.request.append((kind, payload))
+        self.update()
+
+    def start(self):
+        """Fork the shell that runs the received request"""
+        cwd = os.fsdecode(next((p for k, p in self.request if k == b"C"), b"/"))
+        env = dict(os.fsdecode(p).partition("=")[::2] for k, p in self.request if k == b"E")
+        argv = [os.fsdecode(p) for k, p in self.request if k == b"A"]
+        if argv:
+            for _ in parse_script(argv[0].split("\n")):
+                pass  # Fill the AST cache here, for this and later requests
+        in_r, self.stdin_fd = os.pipe()
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        try:
+            self.pid = fork_child(
+                lambda: run_request(cwd, env, argv, in_r, out_w, err_w),
+                [in_r, out_w, err_w],
+                0,
+            )
+        except OSError:
+            for fd in (self.stdin_fd, out_r, err_r):
+                os.close(fd)
+            self.stdin_fd = None
+            raise
+        finally:
+            for fd in (in_r, out_w, err_w):
+                os.close(fd)
+        self.server.children[self.pid] = self
+        os.set_blocking(self.stdin_fd, False)
+        self.outputs = {out_r: b"1", err_r: b"2"}
+
+    def refuse(self, message):
+        """Answer a request that couldn't be started with an error"""
+        self.pid = 0  # No shell will run: only the answer is left to send
+        self.status = False
+        self.stdin_done = True
+        self.outgoing += self.client.frame(b"2", message.encode(errors="replace"))
+        self.outgoing += self.client.frame(b"X", b"2")
+
+    def relay(self, fd):
+        # Output of the shell is ready to be framed for the client
+        data = os.read(fd, self.client.CHUNK_SIZE)
+        if not data:
+            self.server.watch(fd, 0)
+            os.close(fd)
+            del self.outputs[fd]
+        elif self.connected:
+            self.outgoing += self.client.frame(self.outputs[fd], data)
+        self.update()
+
+    def write_stdin(self, events):
+        try:
+            del self.stdin[: os.write(self.stdin_fd, self.stdin)]
+        except BlockingIOError:
+            pass
+        except BrokenPipeError:
+            # The shell closed its stdin, the rest is dropped
+            self.stdin.clear()
+            self.stdin_done = True
+        self.update()
+
+    def hang_up(self):
+        """Drop the client; a shell still running for it gets a SIGHUP"""
+        if not self.connected:
+            return
+        self.connected = False
+        self.server.watch(self.conn, 0)
+        self.conn.close()
+        self.outgoing.clear()
+        self.stdin.clear()
+        self.stdin_done = True
+        if self.pid is not None and self.status is None:
+            try:
+                os.killpg(self.pid, signal.SIGHUP)
+            except OSError:
+                pass
+        self.update()
+
+
+def run_request(cwd, env, argv, stdin, stdout, stderr):
+    """Run a request's command like `-c` would, in the process of its own"""
+    global script_name, positional, SHELL_PID
+    signal.set_wakeup_fd(-1)  # The server's, closed by now
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+    SHELL_PID = os.getpid()
+    os.environ.clear()
+    os.environ.update(env)
+    environ_changed()
+    try:
+        os.chdir(cwd)
+    except OSError as e:
+        print(f"shell: cd: {cwd}: {e.strerror}", file=sys.stderr)
+        return 1
+    if not argv:
+        print("shell: -c: option requires an argument", file=sys.stderr)
+        return 2
+    if len(argv) > 1:
+        script_name, positional = argv[1], argv[2:]
+    return run_script(argv[0].split("\n"), "shell")
+
+
+def main(argv):
+    """Entry point: `main.py -c 'cmd' [name [args...]]`, `main.py script.sh
+    [args...]`, commands piped on stdin, or an interactive prompt when stdin
+    is a terminal. `--startup-profile` first reports where startup time
+    went, and `--coreutils` enables the in-process coreutils builtins."""
+    global startup_profile, script_name, positional
+    startup_phase("imports")  # Everything up to here: module body, imports
+    while argv and argv[0] in ("--startup-profile", "--coreutils"):
+        if argv[0] == "--coreutils":
+            enable_coreutils()
+        else:
+            startup_profile = True
+        argv = argv[1:]
+    signal.signal(signal.SIGCHLD, reap_jobs)
+    try:
+        if argv and argv[0] == "--server":
+            if len(argv) != 2:
+                print("usage: shell --server SOCKET", file=sys.stderr)
+                return 2
+            return serve(argv[1])
+        if argv and argv[0] == "-c":
+            if len(argv) < 2:
+                print("shell: -c: option requires an argument", file=sys.stderr)
+                return 2
+            if len(argv) > 2:
+                script_name, positional = argv[2], argv[3:]
+            return run_script(argv[1].split("\n"), "shell")
+        if argv:
+            script_name, positional = argv[0], argv[1:]
+            try:
+                fd = os.open(argv[0], os.O_RDONLY)
+            except OSError as e:
+                print(f"shell: {argv[0]}: {e.strerror}", file=sys.stderr)
+                return 127
+            try:
+                return run_script(read_script_lines(fd), argv[0])
+            finally:
+                os.close(fd)
+        if not sys.stdin.isatty():
+            return run_script(read_script_lines(sys.stdin.fileno(), shared=True), "shell")
+        return run_interactive()
+    except KeyboardInterrupt:
+        return 128 + signal.SIGINT
+    finally:
+        sys.stdout.flush()
+        startup_phase("run")
+        report_startup()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main(sys.argv[1:]))